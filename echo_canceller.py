@@ -0,0 +1,93 @@
+"""
+echo_canceller.py - 読み上げ音声のエコー除去（全二重の割り込み用）
+
+スピーカーから再生中の音声（参照信号）をマイク入力から差し引く。
+ブロック単位の正規化LMS（NLMS）適応フィルタをNumPyの行列演算で計算し、
+残ったエコーは非線形処理（残差がエコー推定値より十分小さいフレームを
+減衰）で抑える。
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def resample(signal, source_rate, target_rate):
+    """線形補間による簡易リサンプリング（参照信号用）"""
+    signal = np.asarray(signal, dtype=np.float32)
+    if source_rate == target_rate or not len(signal):
+        return signal
+    n = int(round(len(signal) * target_rate / source_rate))
+    positions = np.arange(n) * (source_rate / target_rate)
+    return np.interp(positions, np.arange(len(signal)), signal).astype(np.float32)
+
+
+class NLMSEchoCanceller:
+    """ブロックNLMSによるエコーキャンセラ
+
+    - filter_length: エコー経路の長さ（サンプル数）。再生と録音のずれと
+      部屋の残響を含む長さにする。
+    - step_size: 適応の速さ（0〜1）。大きいほど速く収束するが不安定。
+    - 収束後（エコー低減量が converged_erle を超えた後）は、近端話者
+      （利用者の声）が大きい間は適応を止め、フィルタが声をエコーとして
+      学習しないようにする（ダブルトーク検出）。
+    - suppression_ratio: 残差のエネルギーがエコー推定値のこの倍数より
+      小さいフレームは残留エコーとみなして suppression_gain 倍にする。
+    """
+
+    def __init__(self, filter_length=1600, step_size=0.1, double_talk_ratio=4.0, converged_erle=4.0,
+                 suppression_ratio=0.5, suppression_gain=0.1, eps=1e-6):
+        self.filter_length = filter_length
+        self.step_size = step_size
+        self.double_talk_ratio = double_talk_ratio
+        self.converged_erle = converged_erle
+        self.suppression_ratio = suppression_ratio
+        self.suppression_gain = suppression_gain
+        self.eps = eps
+
+        self.weights = np.zeros(filter_length, dtype=np.float32)
+        self.history = np.zeros(filter_length - 1, dtype=np.float32)
+        self.echo_energy = 0.0
+        self.residual_energy = 0.0
+        # エコー低減量（マイク入力/残差のエネルギー比）の移動平均
+        self.erle = 1.0
+
+    def reset(self):
+        """参照信号の履歴を消去（学習したエコー経路は保持）"""
+        self.history[:] = 0.0
+        self.echo_energy = 0.0
+        self.residual_energy = 0.0
+
+    def process(self, mic, reference):
+        """マイク入力のブロックから参照信号のエコーを除いて返す"""
+        mic = np.asarray(mic, dtype=np.float32)
+        reference = np.asarray(reference, dtype=np.float32)
+
+        x = np.concatenate((self.history, reference))
+        self.history = x[len(reference):].copy()
+        # 各行が1サンプル分の参照信号（新しい順）
+        frames = sliding_window_view(x, self.filter_length)[:, ::-1]
+
+        echo = frames @ self.weights
+        residual = mic - echo
+
+        mic_energy = float(np.mean(mic * mic))
+        self.echo_energy = float(np.mean(echo * echo))
+        self.residual_energy = float(np.mean(residual * residual))
+        reference_power = float(np.mean(x * x))
+
+        # 参照信号があり、利用者が話していない間だけ適応
+        double_talk = (self.erle > self.converged_erle
+                       and self.residual_energy > self.double_talk_ratio * self.echo_energy)
+        if reference_power > self.eps and not double_talk:
+            norm = self.filter_length * reference_power + self.eps
+            self.weights += (self.step_size / norm) * (frames.T @ residual)
+            self.erle += 0.1 * (mic_energy / max(self.residual_energy, self.eps) - self.erle)
+
+        if self.residual_energy < self.suppression_ratio * self.echo_energy:
+            residual = residual * self.suppression_gain
+        return residual.astype(np.float32)
+
+    @property
+    def near_end_ratio(self):
+        """残差とエコー推定値のエネルギー比（大きいほど利用者の声らしい）"""
+        return self.residual_energy / max(self.echo_energy, self.eps)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+replay_bench.py - 音声対話パイプラインのオフライン再生ベンチマーク
+
+マイク（sd.InputStream）の代わりにWAVファイルを実時間または倍速で流し、
+rokuon の record_improved → ImprovedVAD → RobustAIClient → ImprovedTTS を
+そのまま通してターンごとの所要時間をJSONLに出力する。/voice-chat/ は
+遅延を設定できるローカルのスタブサーバー、TTSは音を出さないシンクに置き換える。
+
+出力（1行1ターン、時間はミリ秒）:
+    vad_endpoint_ms  WAVの末尾から録音終了までの時間（音声時間換算）
+    encode_ms        アップロード用エンコード
+    upload_ms        送信開始から応答ヘッダーまでのうちサーバー処理以外
+    server_ms        サーバー処理（X-Server-Time ヘッダー）
+    tts_start_ms     録音終了から最初の読み上げ開始まで
+
+例:
+    python replay_bench.py data/turns/*.wav -o replay.jsonl
+    python replay_bench.py a.wav b.wav --speed 4 --server-latency 0.8 --codec opus
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import soundfile as sf
+
+import rokuon
+
+SAMPLE_RATE = 16000
+
+
+def load_wav(path):
+    """WAVを16kHzモノラルのfloat32で読み込み"""
+    audio, sample_rate = sf.read(path, dtype="float32", always_2d=True)
+    if sample_rate != SAMPLE_RATE:
+        raise ValueError(f"{path}: {SAMPLE_RATE}Hzのみ対応しています（{sample_rate}Hz）")
+    return audio.mean(axis=1)
+
+
+# ===========================================================================
+# マイクの代わりにWAVを流す入力ストリーム
+# ===========================================================================
+class ReplayInputStream:
+    """sd.InputStream と同じ呼び出し方でWAVを流す
+
+    先頭に lead_seconds の環境音（キャリブレーション用）を付け、WAVの後は
+    停止されるまで環境音を流し続ける。speed=2.0 なら2倍速で流す。
+    """
+
+    def __init__(self, audio, speed=1.0, lead_seconds=1.5, noise_level=0.001, seed=0,
+                 samplerate=SAMPLE_RATE, channels=1, dtype="float32", blocksize=480, callback=None):
+        self.audio = audio
+        self.speed = speed
+        self.lead_samples = int(lead_seconds * samplerate)
+        self.noise_level = noise_level
+        self.rng = np.random.default_rng(seed)
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.stopped = threading.Event()
+        self.thread = None
+        # WAVの最後のサンプルを渡し終えた時刻
+        self.speech_end_time = None
+
+    def _noise(self, n):
+        return (self.rng.normal(0, 1, n) * self.noise_level).astype(np.float32)
+
+    def _run(self):
+        signal = np.concatenate((self._noise(self.lead_samples), self.audio.astype(np.float32)))
+        block_seconds = self.blocksize / self.samplerate / self.speed
+        started = time.perf_counter()
+        position = 0
+        index = 0
+
+        while not self.stopped.is_set():
+            if position < len(signal):
+                block = signal[position:position + self.blocksize]
+                if len(block) < self.blocksize:
+                    block = np.concatenate((block, self._noise(self.blocksize - len(block))))
+            else:
+                block = self._noise(self.blocksize)
+            position += self.blocksize
+
+            # 実機と同じく一定間隔でブロックを届ける
+            index += 1
+            delay = started + index * block_seconds - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.callback(block.reshape(-1, 1), self.blocksize, None, None)
+            if self.speech_end_time is None and position >= len(signal):
+                self.speech_end_time = time.time()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+class ReplayDevice:
+    """rokuon.sd の代わり（InputStream だけを持つ）"""
+
+    def __init__(self, speed=1.0, lead_seconds=1.5, noise_level=0.001):
+        self.speed = speed
+        self.lead_seconds = lead_seconds
+        self.noise_level = noise_level
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.turn = 0
+        self.last_stream = None
+
+    def InputStream(self, **kwargs):
+        self.turn += 1
+        self.last_stream = ReplayInputStream(
+            self.audio, self.speed, self.lead_seconds, self.noise_level, seed=self.turn, **kwargs
+        )
+        return self.last_stream
+
+
+# ===========================================================================
+# 読み上げない TTS
+# ===========================================================================
+class NullEngine:
+    """pyttsx3エンジンの代わり（文字数に応じて待つだけ）"""
+
+    def __init__(self, seconds_per_char=0.0):
+        self.seconds_per_char = seconds_per_char
+        self.pending = ""
+
+    def say(self, text):
+        self.pending = text
+
+    def runAndWait(self):
+        time.sleep(len(self.pending) * self.seconds_per_char)
+        self.pending = ""
+
+    def stop(self):
+        pass
+
+
+class NullTTS(rokuon.ImprovedTTS):
+    """音を出さない ImprovedTTS（キュー・文分割・状態遷移はそのまま）"""
+
+    seconds_per_char = 0.0
+
+    def init_engine(self):
+        self.engine = NullEngine(self.seconds_per_char)
+        return True
+
+
+# ===========================================================================
+# /voice-chat/ のスタブサーバー
+# ===========================================================================
+class StubVoiceChatHandler(BaseHTTPRequestHandler):
+    """応答までの遅延を設定できる /voice-chat/（NDJSONで逐次返す）"""
+
+    latency = 0.5
+    delta_interval = 0.0
+    response_text = "こんにちは。今日はいい天気ですね。お散歩には行かれましたか？"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+
+        if self.path.rstrip("/") != "/voice-chat":
+            # 逐次アップロードには非対応（クライアントは一括送信に切り替える）
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        started = time.time()
+        time.sleep(self.latency)
+        # LLMのトークン出力を模して数文字ずつ返す
+        deltas = [self.response_text[i:i + 8] for i in range(0, len(self.response_text), 8)]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("X-Server-Time", f"{time.time() - started:.4f}")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for delta in deltas:
+            self.wfile.write((json.dumps({"delta": delta}, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            if self.delta_interval:
+                time.sleep(self.delta_interval)
+
+
+def start_stub_server(latency, delta_interval, port=0):
+    """スタブサーバーを別スレッドで起動し、(サーバー, URL) を返す"""
+    handler = type("Handler", (StubVoiceChatHandler,), {
+        "latency": latency, "delta_interval": delta_interval,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ===========================================================================
+# ベンチマーク本体
+# ===========================================================================
+def run_turn(device, client, tts, vad, path, audio):
+    """1ターン分を実行し、(計測結果, VAD) を返す"""
+    device.audio = audio
+    turn_start = time.time()
+    recording, sample_rate, vad = rokuon.record_improved(vad)
+    record_end = time.time()
+    stream = device.last_stream
+
+    result = {
+        "turn": device.turn,
+        "file": path,
+        "speed": device.speed,
+        "audio_seconds": round(len(audio) / SAMPLE_RATE, 3),
+        "detected": recording is not None,
+    }
+    if recording is None:
+        return result, vad
+
+    rokuon.system_state.transition(rokuon.ConversationState.UPLOADING)
+    response_stream, error = client.send_audio_streaming(recording, sample_rate)
+    if response_stream is None:
+        rokuon.system_state.transition(rokuon.ConversationState.IDLE, only_from=rokuon.ConversationState.UPLOADING)
+        result["error"] = error
+        return result, vad
+    tts.speak_stream(response_stream)
+
+    timings = client.last_timings
+    request = timings.get("request", 0.0)
+    server = timings.get("server", 0.0)
+    if stream.speech_end_time is not None:
+        result["vad_endpoint_ms"] = round((record_end - stream.speech_end_time) * device.speed * 1000, 1)
+    result.update(
+        recorded_seconds=round(len(recording) / sample_rate, 3),
+        upload_bytes=timings.get("bytes"),
+        encode_ms=round(timings.get("encode", 0.0) * 1000, 1),
+        upload_ms=round(max(0.0, request - server) * 1000, 1),
+        server_ms=round(server * 1000, 1),
+        tts_start_ms=round((tts.first_audio_time - record_end) * 1000, 1) if tts.first_audio_time else None,
+        turn_ms=round((time.time() - turn_start) * 1000, 1),
+    )
+    return result, vad
+
+
+def summarize(results):
+    """各項目の中央値とp95"""
+    summary = {}
+    for key in ("vad_endpoint_ms", "encode_ms", "upload_ms", "server_ms", "tts_start_ms"):
+        values = [r[key] for r in results if r.get(key) is not None]
+        if values:
+            summary[key] = {
+                "p50": round(float(np.percentile(values, 50)), 1),
+                "p95": round(float(np.percentile(values, 95)), 1),
+            }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="音声対話パイプラインのオフライン再生ベンチマーク")
+    parser.add_argument("wav", nargs="+", help="1ターン分の発話WAV（16kHz、1ファイル = 1ターン）")
+    parser.add_argument("--repeat", type=int, default=1, help="WAV一式を繰り返す回数")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度（1.0 = 実時間）")
+    parser.add_argument("--lead-seconds", type=float, default=1.5, help="各ターンの発話前に流す環境音の秒数")
+    parser.add_argument("--noise-level", type=float, default=0.001, help="環境音の振幅")
+    parser.add_argument("--server-latency", type=float, default=0.5, help="スタブサーバーの応答遅延（秒）")
+    parser.add_argument("--delta-interval", type=float, default=0.0, help="応答の文ごとの送信間隔（秒）")
+    parser.add_argument("--tts-seconds-per-char", type=float, default=0.0, help="読み上げ時間の模擬（秒/文字）")
+    parser.add_argument("--codec", choices=list(rokuon.AUDIO_CODECS), default=rokuon.AUDIO_CODEC,
+                        help="アップロードの音声コーデック")
+    parser.add_argument("-o", "--output", default="replay_bench.jsonl", help="結果JSONLの出力先")
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error("--speed は正の値を指定してください")
+
+    files = [(path, load_wav(path)) for path in args.wav]
+    server, url = start_stub_server(args.server_latency, args.delta_interval)
+    print(f"🧪 スタブサーバー: {url}（遅延 {args.server_latency}秒）")
+
+    device = ReplayDevice(args.speed, args.lead_seconds, args.noise_level)
+    rokuon.sd = device
+
+    client = rokuon.RobustAIClient(url)
+    client.audio_codec = client.select_codec(args.codec)
+    # スタブのURLを次回起動用にキャッシュしない
+    client.url_saved = True
+    NullTTS.seconds_per_char = args.tts_seconds_per_char
+    tts = NullTTS(use_cache=False)
+
+    results = []
+    vad = None
+    try:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for _ in range(args.repeat):
+                for path, audio in files:
+                    result, vad = run_turn(device, client, tts, vad, path, audio)
+                    results.append(result)
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    f.flush()
+    finally:
+        client.session.close()
+        server.shutdown()
+
+    print(f"\n📊 {len(results)}ターン（{os.path.basename(args.output)}）")
+    for key, stats in summarize(results).items():
+        print(f"  {key:<16} p50 {stats['p50']:>8.1f}  p95 {stats['p95']:>8.1f}")
+    missed = sum(1 for r in results if not r["detected"])
+    if missed:
+        print(f"  ⚠️ 発話を検出できなかったターン: {missed}")
+    print(f"💾 結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,162 +1,507 @@
+import time
+_PROCESS_START = time.perf_counter()
+
 import sounddevice as sd
 import soundfile as sf
 import numpy as np
 import queue
-import time
-from IPython.display import display, Audio
 import pyttsx3
 import requests
 import os
 import threading
 import io
-from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import tempfile
 import ssl
 import urllib3
+from vad_engine import AdaptiveVAD
+from echo_canceller import NLMSEchoCanceller, resample
 
 # SSL警告を抑制
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # ===========================================================================
-# ★ 1. サーバーURL設定（エラー処理強化）
+# ★ 1. 設定・サーバーURL検出（対話なし・前回のURLを優先）
 # ===========================================================================
-def detect_server_url():
-    """サーバーURLを検出します"""
-    # ローカルサーバーチェック
-    local_ports = [8000, 8001, 8002, 8003, 8004, 8005]
-    
-    def check_port(port):
-        try:
-            response = requests.get(f"http://localhost:{port}/docs", timeout=1)
-            if response.status_code == 200:
-                return f"http://localhost:{port}"
-        except:
-            pass
-        return None
-    
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        results = list(executor.map(check_port, local_ports))
-        for result in results:
-            if result:
-                print(f"✅ ローカルサーバーを発見: {result}")
-                return result
-    
-    # ngrok URLを手動入力
-    print("🌐 ローカルサーバーが見つかりません。")
-    print("📱 ngrok公開URLを入力してください（例: https://xxxxx.ngrok-free.app）")
-    print("   またはローカルで実行する場合は 'local' と入力してください")
-    
-    user_input = input("URL入力: ").strip()
-    
-    if user_input.lower() == 'local':
-        return "http://localhost:8000"
-    elif user_input:
-        ngrok_url = user_input
-        if not ngrok_url.startswith('http'):
-            ngrok_url = 'https://' + ngrok_url
-        
-        # ngrok URLの接続テスト
-        print(f"🔍 接続テスト中: {ngrok_url}")
+class StartupTimer:
+    """起動から待ち受け開始までの各段階の所要時間を記録"""
+
+    def __init__(self, start):
+        self.start = start
+        self.marks = []
+        self.reported = False
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def report(self, name="待ち受け開始"):
+        """最初の待ち受け開始時に一度だけ表示"""
+        if self.reported:
+            return
+        self.reported = True
+        self.mark(name)
+        print("⏱️ 起動時間レポート:")
+        previous = self.start
+        for mark_name, timestamp in self.marks:
+            print(f"  {mark_name:<16} {(timestamp - previous) * 1000:7.0f}ms")
+            previous = timestamp
+        print(f"  {'合計':<16} {(previous - self.start) * 1000:7.0f}ms")
+
+
+startup_timer = StartupTimer(_PROCESS_START)
+startup_timer.mark("ライブラリ読込")
+
+CONFIG_FILE = os.environ.get(
+    "CARETALKER_CONFIG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "rokuon_config.json")
+)
+
+# 設定の既定値（設定ファイル → 環境変数 CARETALKER_<キー大文字> の順に上書き）
+DEFAULT_CONFIG = {
+    # 指定があれば検出せずにこのURLを使う
+    "server_url": "",
+    "local_ports": [8000, 8001, 8002, 8003, 8004, 8005],
+    # 最後に接続できたサーバーURLの保存先
+    "server_cache_file": os.path.join(os.path.expanduser("~"), ".caretalker", "server_url"),
+    "fallback_server_url": "http://localhost:8000",
+    # 録音しながら音声を逐次アップロード（サーバーが /voice-chat/stream に対応している場合）
+    "stream_upload": False,
+    "audio_codec": "flac",
+    "turn_budget": 45.0,
+    "preroll_ms": 300,
+    # 読み上げ音声のキャッシュ（定型文・繰り返される応答を即座に再生）
+    "tts_cache": True,
+    "tts_cache_dir": os.path.join(os.path.expanduser("~"), ".caretalker", "tts_cache"),
+    "tts_cache_max_mb": 50,
+    # この回数以上読み上げた文をキャッシュする
+    "tts_cache_min_repeats": 2,
+    # 起動時に用意しておく定型文（エラー文言・あいさつは自動で含める）
+    "tts_warmup_phrases": [],
+    # 起動時のあいさつ（空なら読み上げない）
+    "greeting": "",
+    # ターンごとの所要時間の記録先（JSONL）と集計エンドポイント（例: http://host:8080/traces）
+    "trace_file": os.path.join(os.path.expanduser("~"), ".caretalker", "traces.jsonl"),
+    "trace_endpoint": "",
+    # 読み上げ中も聞き取り、話し始めたら読み上げを止める（エコー除去を使用）
+    "barge_in": False,
+    "aec_filter_ms": 100,
+    "aec_step_size": 0.1,
+    # 読み上げ中の発話開始に必要な残差/エコー推定のエネルギー比
+    "barge_in_ratio": 4.0,
+}
+
+def _coerce(value, default):
+    """環境変数の文字列を既定値と同じ型に変換"""
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, list):
+        items = [item.strip() for item in value.split(",") if item.strip()]
+        if default and isinstance(default[0], int):
+            return [int(item) for item in items]
+        return items
+    return value
+
+def load_config(path=CONFIG_FILE):
+    """設定を読み込み（ファイルがなくても既定値で動く）"""
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(path):
         try:
-            # ngrokの特殊ヘッダーを追加
-            headers = {
-                'ngrok-skip-browser-warning': 'true',
-                'User-Agent': 'Mozilla/5.0'
-            }
-            test_response = requests.get(
-                f"{ngrok_url}/docs", 
-                timeout=5, 
-                headers=headers,
-                verify=False  # SSL検証を一時的に無効化
-            )
-            if test_response.status_code in [200, 404, 405]:  # 接続は成功
-                print(f"✅ ngrok URLに接続成功: {ngrok_url}")
-                return ngrok_url
+            with open(path, encoding="utf-8") as f:
+                config.update(json.load(f))
         except Exception as e:
-            print(f"⚠️ 接続テスト失敗: {e}")
-            print("   URLを確認するか、新しいngrokトンネルを作成してください")
-            
-    return "http://localhost:8000"
+            print(f"⚠️ 設定ファイル読込エラー: {path}: {e}")
+
+    for key, default in DEFAULT_CONFIG.items():
+        value = os.environ.get(f"CARETALKER_{key.upper()}")
+        if value is not None:
+            try:
+                config[key] = _coerce(value, default)
+            except ValueError:
+                print(f"⚠️ 環境変数 CARETALKER_{key.upper()} の値が不正です: {value}")
+    return config
+
+CONFIG = load_config()
+startup_timer.mark("設定読込")
+
+STREAM_UPLOAD = CONFIG["stream_upload"]
+BARGE_IN = CONFIG["barge_in"]
+
+def _server_headers(url):
+    if 'ngrok' in url:
+        # ngrokの特殊ヘッダーを追加
+        return {'ngrok-skip-browser-warning': 'true', 'User-Agent': 'Mozilla/5.0'}
+    return None
+
+def probe_server(url, timeout=1.0):
+    """サーバーが応答するか確認"""
+    try:
+        response = requests.get(
+            f"{url}/docs",
+            timeout=timeout,
+            headers=_server_headers(url),
+            verify=False if 'ngrok' in url else True
+        )
+        return response.status_code in [200, 404, 405]  # 接続は成功
+    except Exception:
+        return False
+
+def load_cached_server_url():
+    try:
+        with open(CONFIG["server_cache_file"], encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def save_cached_server_url(url):
+    """接続できたURLを次回の起動用に保存"""
+    try:
+        os.makedirs(os.path.dirname(CONFIG["server_cache_file"]), exist_ok=True)
+        with open(CONFIG["server_cache_file"], "w", encoding="utf-8") as f:
+            f.write(url)
+    except OSError as e:
+        print(f"⚠️ サーバーURLの保存に失敗: {e}")
+
+def detect_server_url():
+    """サーバーURLを検出します（入力待ちはしない）
+
+    1. 設定ファイル・環境変数で指定されたURL
+    2. 前回接続できたURL
+    3. ローカルポートの並列探索（最初に応答したもの）
+    4. fallback_server_url
+    """
+    configured = CONFIG["server_url"]
+    if configured:
+        if not configured.startswith('http'):
+            configured = 'https://' + configured
+        print(f"✅ 設定のサーバーURLを使用: {configured}")
+        return configured
+
+    cached = load_cached_server_url()
+    if cached and probe_server(cached, timeout=2.0):
+        print(f"✅ 前回のサーバーに接続: {cached}")
+        return cached
+
+    local_urls = [f"http://localhost:{port}" for port in CONFIG["local_ports"]]
+    with ThreadPoolExecutor(max_workers=max(1, len(local_urls))) as executor:
+        futures = {executor.submit(probe_server, url): url for url in local_urls}
+        for future in as_completed(futures):
+            if future.result():
+                url = futures[future]
+                print(f"✅ ローカルサーバーを発見: {url}")
+                save_cached_server_url(url)
+                return url
+
+    fallback = cached or CONFIG["fallback_server_url"]
+    print(f"🌐 サーバーが見つかりません。{fallback} で待ち受けを開始します")
+    print("   URLは環境変数 CARETALKER_SERVER_URL または設定ファイルで指定できます")
+    return fallback
+
+_server_url = None
 
-SERVER_URL = detect_server_url()
-print(f"🎯 使用するサーバーURL: {SERVER_URL}")
+def get_server_url():
+    """サーバーURLを取得（初回呼び出し時に検出）"""
+    global _server_url
+    if _server_url is None:
+        _server_url = detect_server_url()
+        print(f"🎯 使用するサーバーURL: {_server_url}")
+    return _server_url
+
+def __getattr__(name):
+    # 互換性のため rokuon.SERVER_URL も遅延検出で提供
+    if name == "SERVER_URL":
+        return get_server_url()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ===========================================================================
 # ★ 2. グローバル状態管理
 # ===========================================================================
-class SystemState:
-    """システム全体の状態を管理"""
+class ConversationState:
+    """会話の状態機械（待機 → 聞き取り → 送信 → 読み上げ）
+
+    状態はフラグのポーリングではなく Condition で待ち合わせる。遷移すると
+    待っているスレッドと登録済みのリスナーへ即座に通知する。
+    """
+
+    IDLE = "idle"
+    LISTENING = "listening"
+    UPLOADING = "uploading"
+    SPEAKING = "speaking"
+
     def __init__(self):
-        self.is_tts_playing = False
-        self.is_recording = False
-        self.lock = threading.Lock()
-        
+        self.state = self.IDLE
+        self.condition = threading.Condition()
+        self.listeners = []
+        self.speaking_ended_at = 0.0
+
+    def add_listener(self, callback):
+        """遷移時に callback(旧状態, 新状態) を呼ぶ"""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def transition(self, new_state, only_from=None):
+        """状態を遷移（only_from を指定した場合はその状態からのみ）"""
+        with self.condition:
+            old_state = self.state
+            if only_from is not None and old_state != only_from:
+                return False
+            if old_state == new_state:
+                return True
+            self.state = new_state
+            if old_state == self.SPEAKING:
+                self.speaking_ended_at = time.time()
+            self.condition.notify_all()
+
+        for callback in list(self.listeners):
+            callback(old_state, new_state)
+        return True
+
+    def wait_until_not(self, state, timeout=None):
+        """指定の状態を抜けるまで待つ"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.state != state, timeout)
+
+    # --- 従来の SystemState と同じインターフェース ---
+    @property
+    def is_tts_playing(self):
+        return self.state == self.SPEAKING
+
+    @property
+    def is_recording(self):
+        return self.state == self.LISTENING
+
     def set_tts_playing(self, state):
-        with self.lock:
-            self.is_tts_playing = state
+        if state:
+            self.transition(self.SPEAKING)
+        else:
+            self.transition(self.IDLE, only_from=self.SPEAKING)
             
     def set_recording(self, state):
-        with self.lock:
-            self.is_recording = state
+        # 読み上げ中（割り込みモードでは別スレッドが SPEAKING にする）を上書きしない
+        if state:
+            self.transition(self.LISTENING, only_from=self.IDLE)
+        else:
+            self.transition(self.IDLE, only_from=self.LISTENING)
             
     def can_record(self):
-        with self.lock:
-            return not self.is_tts_playing
+        return not self.is_tts_playing
             
     def can_play_tts(self):
-        with self.lock:
-            return not self.is_recording
+        return not self.is_recording
 
-system_state = SystemState()
+# 互換性のための別名
+SystemState = ConversationState
+
+system_state = ConversationState()
 
 # ===========================================================================
 # ★ 3. 改善版VADクラス
 # ===========================================================================
-class ImprovedVAD:
-    """改善された音声活動検出"""
-    def __init__(self, calibration_seconds=3, voice_threshold_multiplier=3.0):
-        self.calibration_seconds = calibration_seconds
-        self.voice_threshold_multiplier = voice_threshold_multiplier
-        self.baseline_rms = None
-        self.calibration_samples = []
-        self.is_calibrated = False
-        self.voice_threshold = 0.01
-        self.samples_needed = calibration_seconds * 50
-        self.min_threshold = 0.001
-
-    def calibrate(self, rms_value):
-        """キャリブレーション"""
-        self.calibration_samples.append(rms_value)
-        
-        if len(self.calibration_samples) >= self.samples_needed:
-            sorted_samples = np.sort(self.calibration_samples)
-            trim_count = len(sorted_samples) // 10
-            trimmed_samples = sorted_samples[trim_count:-trim_count] if trim_count > 0 else sorted_samples
-            
-            self.baseline_rms = np.mean(trimmed_samples)
-            self.voice_threshold = max(
-                self.baseline_rms * self.voice_threshold_multiplier,
-                self.min_threshold
-            )
-            self.is_calibrated = True
-            print(f"\n[VAD] キャリブレーション完了！")
-            print(f"  ベースライン: {self.baseline_rms:.6f}")
-            print(f"  音声閾値: {self.voice_threshold:.6f}")
-            return True
-        return False
+class ImprovedVAD(AdaptiveVAD):
+    """改善された音声活動検出（騒音レベル追従型、割り込み無効時はTTS再生中は常に無音）"""
 
     def is_voice(self, rms_value):
-        if not self.is_calibrated:
-            return False
-        if system_state.is_tts_playing:
-            return False
-        if rms_value > self.voice_threshold * 10:
+        if system_state.is_tts_playing and not BARGE_IN:
             return False
-        return rms_value > self.voice_threshold
+        return super().is_voice(rms_value)
+
+    def process(self, frames):
+        if system_state.is_tts_playing and not BARGE_IN:
+            return np.zeros(len(np.atleast_2d(frames)), dtype=bool)
+        return super().process(frames)
 
 # ===========================================================================
 # ★ 4. 堅牢版AIクライアント（エラー処理強化）
 # ===========================================================================
+# アップロード時の音声コーデック（wav / flac / opus）
+AUDIO_CODEC = CONFIG["audio_codec"].lower()
+
+# コーデックごとの soundfile 形式・ファイル名・MIMEタイプ
+AUDIO_CODECS = {
+    'wav': ('WAV', 'PCM_16', 'recording.wav', 'audio/wav'),
+    'flac': ('FLAC', 'PCM_16', 'recording.flac', 'audio/flac'),
+    'opus': ('OGG', 'OPUS', 'recording.ogg', 'audio/ogg'),
+}
+
+# 1ターンあたりの通信時間の上限（リトライ・待機を含む）
+TURN_BUDGET_SECONDS = float(CONFIG["turn_budget"])
+CONNECT_TIMEOUT_SECONDS = 5
+# この時間以上アイドルだった接続は、発話中に事前に張り直しておく
+KEEPALIVE_IDLE_SECONDS = 30
+
+# サーバー停止中に読み上げる定型文
+SERVER_DOWN_MESSAGE = "ただいまサーバーにつながりません。少し待ってから、もう一度お話しください。"
+
+class CircuitBreaker:
+    """連続して失敗したらサーバー呼び出しを一時停止する（即時に失敗を返す）"""
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """呼び出してよいか（open中でも reset_timeout 経過後は1回だけ試す）
+
+        試行の結果が記録されないまま reset_timeout が過ぎた場合は、
+        半開状態のままにせず次の試行を許可する。
+        """
+        with self.lock:
+            if self.state in ('open', 'half_open') and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.opened_at = time.time()
+                return True
+            return self.state == 'closed'
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                print("✅ サーバー接続が回復しました")
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"🚫 サーバー呼び出しを{self.reset_timeout}秒間停止します（連続失敗 {self.failures}回）")
+                self.state = 'open'
+                self.opened_at = time.time()
+
+    @property
+    def is_open(self):
+        with self.lock:
+            return self.state == 'open'
+
+
+def backoff_delay(attempt, base=0.5, cap=4.0):
+    """指数バックオフ（フルジッター）"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+# サーバーが対応していれば応答をNDJSON（1行1 {"delta": "..."}）で逐次受信
+STREAM_RESPONSE_ACCEPT = 'application/x-ndjson, application/json'
+
+def iter_response_text(response):
+    """/voice-chat/ の応答テキストを届いた順に返す
+
+    NDJSON応答なら各行の delta（または response）を逐次返し、
+    通常のJSON応答なら response 全文を一度だけ返す。
+    """
+    try:
+        content_type = response.headers.get('Content-Type', '')
+        if 'ndjson' not in content_type:
+            yield response.json().get("response", "（AIから応答がありませんでした）")
+            return
+
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            text = item.get("delta") or item.get("response")
+            if text:
+                yield text
+    except Exception as e:
+        print(f"⚠️ 応答受信エラー: {type(e).__name__}: {str(e)[:100]}")
+    finally:
+        response.close()
+
+# Server-Timing の項目名 → スパン名
+SERVER_TIMING_SPANS = {
+    'stt': 'server_transcription',
+    'llm': 'inference',
+    'total': 'server',
+}
+
+def parse_server_timing(header):
+    """Server-Timing ヘッダー（例: "stt;dur=812, llm;dur=1530"）を秒の辞書に変換"""
+    timings = {}
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        for param in parts[1:]:
+            if param.startswith('dur='):
+                try:
+                    timings[parts[0]] = float(param[4:]) / 1000
+                except ValueError:
+                    pass
+    return timings
+
+class TurnTrace:
+    """1ターン分のトレース（トレースIDと各段階の所要時間）"""
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.spans = {}
+        self.error = None
+
+    def add(self, name, seconds):
+        if seconds is not None:
+            self.spans[name] = round(seconds * 1000, 1)
+
+    def wrap_response(self, text_chunks, since):
+        """応答テキストのイテレータを包み、受信完了までの時間を記録"""
+        for chunk in text_chunks:
+            yield chunk
+        self.add('response', time.time() - since)
+
+    def to_dict(self):
+        record = {
+            'trace_id': self.trace_id,
+            'timestamp': self.started_at,
+            'source': 'device',
+            'spans': self.spans,
+        }
+        if self.error:
+            record['error'] = self.error
+        return record
+
+class TraceRecorder:
+    """トレースをローカルのJSONLに追記し、集計エンドポイントへ送信"""
+
+    def __init__(self, path=None, endpoint=None):
+        self.path = CONFIG["trace_file"] if path is None else path
+        self.endpoint = CONFIG["trace_endpoint"] if endpoint is None else endpoint
+        self.lock = threading.Lock()
+
+    def record(self, trace):
+        record = trace.to_dict()
+        if self.path:
+            try:
+                with self.lock:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"⚠️ トレース保存エラー: {e}")
+        if self.endpoint:
+            # 会話を止めないようにバックグラウンドで送信（失敗は無視）
+            threading.Thread(target=self._post, args=(record,), daemon=True).start()
+
+    def _post(self, record):
+        try:
+            requests.post(self.endpoint, json=record, timeout=CONNECT_TIMEOUT_SECONDS).close()
+        except Exception:
+            pass
+
 class RobustAIClient:
     """堅牢版AIクライアント - 接続エラーに強い"""
     
@@ -165,6 +510,15 @@ class RobustAIClient:
         self.is_ngrok = 'ngrok' in server_url
         self.session = self.create_session()
         self.retry_count = 3
+        self.breaker = CircuitBreaker()
+        self.last_request_time = 0.0
+        self.url_saved = False
+        # /voice-chat/stream 非対応のサーバーでは以後WAV一括送信のみ
+        self.supports_stream_upload = True
+        self.audio_codec = self.select_codec(AUDIO_CODEC)
+        # 直近の送信の内訳（秒）: encode / request / server / bytes
+        self.last_timings = {}
+        self.trace = None
         
     def create_session(self):
         """セッションを作成（ngrok用の特別設定付き）"""
@@ -181,75 +535,603 @@ class RobustAIClient:
             })
             # SSL検証を緩和（開発環境のみ）
             session.verify = False
+
+        # 接続プールを使い回す（リトライはこのクラスで制御）
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
             
         return session
-        
-    def send_audio(self, audio_data, sample_rate=16000):
-        """音声データを送信（リトライ機能付き）"""
-        print("🚀 AI送信中...")
-        
-        for attempt in range(self.retry_count):
+
+    def start_trace(self):
+        """新しいターンのトレースを開始（以後のリクエストにトレースIDを付ける）"""
+        self.trace = TurnTrace()
+        return self.trace
+
+    def trace_headers(self, headers=None):
+        headers = dict(headers or {})
+        if self.trace is not None:
+            headers['X-Trace-Id'] = self.trace.trace_id
+        return headers
+
+    def record_response_timings(self, response):
+        """送信開始から応答ヘッダー受信まで（サーバーが申告すれば処理時間も）を記録"""
+        self.last_timings['request'] = response.elapsed.total_seconds()
+        server_time = response.headers.get('X-Server-Time')
+        if server_time:
             try:
-                # WAVファイルをメモリ内で作成
-                with io.BytesIO() as wav_buffer:
-                    sf.write(wav_buffer, audio_data, sample_rate, format='WAV', subtype='PCM_16')
-                    wav_buffer.seek(0)
-                    wav_data = wav_buffer.read()
-                
-                files = {'audio': ('recording.wav', wav_data, 'audio/wav')}
-                
-                # リクエスト送信
-                response = self.session.post(
-                    f"{self.server_url}/voice-chat/", 
-                    files=files, 
-                    timeout=30,
-                    verify=False if self.is_ngrok else True
-                )
-                
-                response.raise_for_status()
-                ai_response_data = response.json()
-                ai_response = ai_response_data.get("response", "（AIから応答がありませんでした）")
-                
-                print(f"🤖 応答受信完了")
-                return ai_response
+                self.last_timings['server'] = float(server_time)
+            except ValueError:
+                pass
+        for name, seconds in parse_server_timing(response.headers.get('Server-Timing', '')).items():
+            self.last_timings[SERVER_TIMING_SPANS.get(name, f'server_{name}')] = seconds
+
+    def reset_connections(self):
+        """プール内の接続だけを破棄（セッションやヘッダーは維持）"""
+        for adapter in self.session.adapters.values():
+            adapter.close()
+
+    def warmup(self):
+        """接続を事前に確立（TCP/TLSハンドシェイクを発話中に済ませる）"""
+        try:
+            self.session.get(
+                f"{self.server_url}/docs",
+                timeout=CONNECT_TIMEOUT_SECONDS,
+                verify=False if self.is_ngrok else True
+            ).close()
+            self.last_request_time = time.time()
+        except Exception:
+            pass
+
+    def warmup_async(self):
+        """アイドルが長い場合のみ、バックグラウンドで接続を温める"""
+        if time.time() - self.last_request_time < KEEPALIVE_IDLE_SECONDS or self.breaker.is_open:
+            return
+        threading.Thread(target=self.warmup, daemon=True).start()
+        
+    @staticmethod
+    def select_codec(codec):
+        """使用可能なコーデックを選択（libsndfileが非対応ならWAV）"""
+        if codec not in AUDIO_CODECS:
+            print(f"⚠️ 不明な音声コーデック: {codec}（WAVを使用）")
+            return 'wav'
+        file_format, subtype = AUDIO_CODECS[codec][:2]
+        if subtype not in sf.available_subtypes(file_format):
+            print(f"⚠️ このlibsndfileは {codec} に非対応です（WAVを使用）")
+            return 'wav'
+        return codec
+
+    def encode_audio(self, audio_data, sample_rate=16000, codec=None):
+        """音声データをアップロード用にエンコード
+
+        Returns:
+            (ファイル名, エンコード済みバイト列, MIMEタイプ)
+        """
+        codec = codec or self.audio_codec
+        file_format, subtype, filename, mime_type = AUDIO_CODECS[codec]
+
+        encode_start = time.time()
+        with io.BytesIO() as buffer:
+            sf.write(buffer, audio_data, sample_rate, format=file_format, subtype=subtype)
+            encoded = buffer.getvalue()
+        encode_time = time.time() - encode_start
+        self.last_timings.update(encode=encode_time, bytes=len(encoded))
+
+        # 16bit PCM WAV（ヘッダー44バイト）と比べた削減量
+        wav_size = 44 + len(audio_data) * 2
+        saved = wav_size - len(encoded)
+        print(f"🗜️ {codec}: {len(encoded) / 1024:.0f}KB（WAV比 {saved / 1024:.0f}KB削減, "
+              f"{len(encoded) / wav_size:.0%}）エンコード {encode_time * 1000:.0f}ms")
+        return filename, encoded, mime_type
+
+    def _post_audio(self, audio_data, sample_rate=16000, stream=False):
+        """音声データを送信（リトライ機能付き）
+
+        試行ごとの待ち時間はターン全体の残り時間（TURN_BUDGET_SECONDS）に
+        収め、失敗時はジッター付き指数バックオフで再試行する。サーバーが
+        落ちている間はサーキットブレーカーが即時に失敗を返す。
+
+        Returns:
+            (レスポンス, None) または (None, エラーメッセージ)
+        """
+        if not self.breaker.allow():
+            return None, SERVER_DOWN_MESSAGE
+
+        deadline = time.time() + TURN_BUDGET_SECONDS
+        self.last_timings = {}
+        # エンコードは試行ごとに繰り返さず一度だけ
+        try:
+            files = {'audio': self.encode_audio(audio_data, sample_rate)}
+        except Exception as e:
+            print(f"❌ 音声エンコードエラー: {type(e).__name__}: {str(e)[:100]}")
+            # 半開状態の試行を使ったまま戻らない
+            if self.breaker.state == 'half_open':
+                self.breaker.record_failure()
+            return None, f"エラー: {str(e)[:50]}..."
+        error = "複数回の試行に失敗しました。接続を確認してください。"
+
+        def post(files, remaining):
+            response = self.session.post(
+                f"{self.server_url}/voice-chat/", 
+                files=files, 
+                timeout=(CONNECT_TIMEOUT_SECONDS, remaining),
+                verify=False if self.is_ngrok else True,
+                headers=self.trace_headers({'Accept': STREAM_RESPONSE_ACCEPT} if stream else None),
+                stream=stream
+            )
+            self.last_request_time = time.time()
+            self.record_response_timings(response)
+            return response
+
+        # 成功・4xx以外で抜けた場合（予期しない例外を含む）は必ず失敗を記録し、
+        # ブレーカーを半開状態のまま残さない
+        settled = False
+        try:
+            for attempt in range(self.retry_count):
+                remaining = deadline - time.time()
+                if remaining <= CONNECT_TIMEOUT_SECONDS:
+                    break
+
+                try:
+                    # リクエスト送信
+                    response = post(files, remaining)
+
+                    # 圧縮形式を受け付けないサーバーにはWAVで送り直す
+                    # （形式の不一致なので試行回数には数えない）
+                    if response.status_code in (400, 415, 422) and self.audio_codec != 'wav':
+                        print(f"ℹ️ サーバーが {self.audio_codec} を受け付けないため、WAVに切り替えます")
+                        response.close()
+                        self.audio_codec = 'wav'
+                        files = {'audio': self.encode_audio(audio_data, sample_rate)}
+                        response = post(files, max(CONNECT_TIMEOUT_SECONDS, deadline - time.time()))
+
+                    # 5xxは一時的な障害として再試行
+                    if response.status_code >= 500:
+                        error = f"サーバーエラー（{response.status_code}）"
+                        print(f"⚠️ {error} (試行 {attempt + 1}/{self.retry_count})")
+                        response.close()
+                    else:
+                        response.raise_for_status()
+                        self.breaker.record_success()
+                        settled = True
+                        if not self.url_saved:
+                            # 次回起動時はこのURLを最初に試す
+                            save_cached_server_url(self.server_url)
+                            self.url_saved = True
+                        return response, None
                 
-            except requests.exceptions.SSLError as e:
-                print(f"⚠️ SSL エラー (試行 {attempt + 1}/{self.retry_count})")
-                if attempt < self.retry_count - 1:
-                    print("   再接続を試みます...")
-                    time.sleep(2)
-                    # セッションを再作成
-                    self.session.close()
-                    self.session = self.create_session()
-                else:
-                    return "SSL接続エラーが発生しました。ngrok URLを確認してください。"
+                except requests.exceptions.SSLError as e:
+                    print(f"⚠️ SSL エラー (試行 {attempt + 1}/{self.retry_count})")
+                    error = "SSL接続エラーが発生しました。ngrok URLを確認してください。"
+                    # プールの接続だけ張り直す
+                    self.reset_connections()
                     
-            except requests.exceptions.ConnectionError as e:
-                print(f"⚠️ 接続エラー (試行 {attempt + 1}/{self.retry_count})")
-                if attempt < self.retry_count - 1:
-                    print("   再接続を試みます...")
-                    time.sleep(2)
-                else:
-                    return "サーバーに接続できません。URLまたはngrokの状態を確認してください。"
+                except requests.exceptions.ConnectionError as e:
+                    print(f"⚠️ 接続エラー (試行 {attempt + 1}/{self.retry_count})")
+                    error = "サーバーに接続できません。URLまたはngrokの状態を確認してください。"
                     
-            except requests.exceptions.Timeout:
-                return "⏰ タイムアウト（30秒）"
+                except requests.exceptions.Timeout:
+                    print(f"⚠️ タイムアウト (試行 {attempt + 1}/{self.retry_count})")
+                    error = f"⏰ タイムアウト（{TURN_BUDGET_SECONDS:.0f}秒）"
+
+                except requests.exceptions.HTTPError as e:
+                    # 4xxは再試行しても結果が変わらない
+                    self.breaker.record_success()
+                    settled = True
+                    return None, f"エラー: {str(e)[:50]}..."
                 
-            except Exception as e:
-                print(f"❌ 予期しないエラー: {type(e).__name__}: {str(e)[:100]}")
-                return f"エラー: {str(e)[:50]}..."
+                except Exception as e:
+                    print(f"❌ 予期しないエラー: {type(e).__name__}: {str(e)[:100]}")
+                    return None, f"エラー: {str(e)[:50]}..."
+
+                if attempt < self.retry_count - 1:
+                    delay = min(backoff_delay(attempt), max(0.0, deadline - time.time() - CONNECT_TIMEOUT_SECONDS))
+                    print(f"   {delay:.1f}秒後に再試行します...")
+                    time.sleep(delay)
+        finally:
+            if not settled:
+                self.breaker.record_failure()
+        return None, error
+
+    def send_audio(self, audio_data, sample_rate=16000):
+        """音声データを送信し、AI応答の全文を返す"""
+        print("🚀 AI送信中...")
+        response, error = self._post_audio(audio_data, sample_rate)
+        if error:
+            return error
+
+        try:
+            ai_response_data = response.json()
+        except ValueError as e:
+            return f"エラー: {str(e)[:50]}..."
+        ai_response = ai_response_data.get("response", "（AIから応答がありませんでした）")
         
-        return "複数回の試行に失敗しました。接続を確認してください。"
+        print(f"🤖 応答受信完了")
+        return ai_response
+
+    def send_audio_streaming(self, audio_data, sample_rate=16000):
+        """音声データを送信し、AI応答を逐次受信するイテレータを返す
+
+        Returns:
+            (応答テキストのイテレータ, None) または (None, エラーメッセージ)
+        """
+        print("🚀 AI送信中...")
+        response, error = self._post_audio(audio_data, sample_rate, stream=True)
+        if error:
+            return None, error
+        return iter_response_text(response), None
+
+    def start_stream_upload(self, sample_rate=16000):
+        """録音中の逐次アップロードを準備（非対応サーバーならNone）"""
+        if not STREAM_UPLOAD or not self.supports_stream_upload or self.breaker.is_open:
+            return None
+        return StreamingUpload(self, sample_rate)
+
+
+class StreamingUpload:
+    """録音中の音声フレームをchunked転送で逐次アップロード
+
+    発話開始で start()、フレームごとに feed()、無音タイムアウトで finish() を
+    呼ぶ。アップロードは録音と並行して進むため、発話終了後に送るのは
+    終端だけになる。失敗時は result() が None を返し、呼び出し側は
+    従来のWAV一括送信にフォールバックする。
+    """
+
+    def __init__(self, client, sample_rate=16000):
+        self.client = client
+        self.sample_rate = sample_rate
+        self.frames = queue.Queue()
+        self.thread = None
+        self.response = None
+        self.error = None
+        self.bytes_sent = 0
+        self.finished = False
+        # result() がタイムアウトで諦めた（遅れて届いた応答は閉じる）
+        self.abandoned = False
+        self.lock = threading.Lock()
+        # 発話終了（finish）の時刻。応答時間はここから測る
+        self.finished_at = None
+
+    def start(self):
+        """アップロードを開始"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def feed(self, chunk):
+        """録音フレーム（float32）をLINEAR16に変換して送信キューへ"""
+        pcm = (np.clip(chunk, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+        self.frames.put(pcm)
+
+    def finish(self):
+        """発話終了（終端チャンクを送信）"""
+        if not self.finished:
+            self.finished = True
+            self.finished_at = time.time()
+            self.frames.put(None)
+
+    def _iter_body(self):
+        while True:
+            pcm = self.frames.get()
+            if pcm is None:
+                return
+            self.bytes_sent += len(pcm)
+            yield pcm
+
+    def _run(self):
+        try:
+            response = self.client.session.post(
+                f"{self.client.server_url}/voice-chat/stream",
+                data=self._iter_body(),
+                headers=self.client.trace_headers({
+                    'Content-Type': f'audio/L16; rate={self.sample_rate}; channels=1',
+                    'Accept': STREAM_RESPONSE_ACCEPT,
+                }),
+                timeout=30,
+                verify=False if self.client.is_ngrok else True,
+                stream=True
+            )
+            if response.status_code in (404, 405, 415):
+                print("ℹ️ サーバーが逐次アップロードに未対応のため、一括送信に切り替えます")
+                self.client.supports_stream_upload = False
+                response.close()
+                return
+            response.raise_for_status()
+            self.client.last_timings = {'bytes': self.bytes_sent}
+            self.client.record_response_timings(response)
+            # response.elapsed は発話開始からなので発話時間を含む。
+            # 発話終了から応答ヘッダー受信までに置き換える
+            if self.finished_at is not None:
+                self.client.last_timings['request'] = max(0.0, time.time() - self.finished_at)
+            with self.lock:
+                if self.abandoned:
+                    # 応答待ちがタイムアウトした後に届いた応答は使わない
+                    response.close()
+                    return
+                self.response = response
+
+        except Exception as e:
+            self.error = e
+            print(f"⚠️ 逐次アップロード失敗: {type(e).__name__}: {str(e)[:100]}")
+
+    def result(self, timeout=35):
+        """AI応答テキストのイテレータを取得
+
+        Returns:
+            (イテレータ, None)、一括送信に切り替える場合は (None, None)、
+            サーバーが発話を受け取ったまま応答しない場合は (None, エラーメッセージ)
+        """
+        if self.thread is None:
+            return None, None
+        self.finish()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            # サーバーは同じ発話を処理中なので、WAVで送り直さない
+            print("⚠️ 逐次アップロードの応答待ちがタイムアウトしました")
+            with self.lock:
+                self.abandoned = True
+                if self.response is not None:
+                    self.response.close()
+            self.client.breaker.record_failure()
+            return None, f"⏰ タイムアウト（{timeout}秒）"
+        if self.response is None:
+            return None, None
+        print(f"🤖 応答受信開始（逐次アップロード {self.bytes_sent / 1024:.0f}KB）")
+        return iter_response_text(self.response), None
 
 # ===========================================================================
 # ★ 5. 改善版TTS
 # ===========================================================================
+class SentenceSplitter:
+    """逐次届くテキストを日本語の文末（。！？）で文に区切る"""
+
+    SENTENCE_ENDINGS = "。！？!?\n"
+    CLOSING_CHARS = "」』）)"
+
+    def __init__(self, max_chars=80):
+        # 文末が来ないまま長くなった場合は読点で区切る
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        """テキストを追加し、完成した文を返す"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        i = 0
+        while i < len(self.buffer):
+            if self.buffer[i] in self.SENTENCE_ENDINGS:
+                # 文末に続く閉じ括弧は同じ文に含める
+                while i + 1 < len(self.buffer) and self.buffer[i + 1] in self.CLOSING_CHARS:
+                    i += 1
+                sentences.append(self.buffer[start:i + 1])
+                start = i + 1
+            i += 1
+        self.buffer = self.buffer[start:]
+
+        if len(self.buffer) > self.max_chars:
+            cut = self.buffer.rfind("、")
+            if cut > 0:
+                sentences.append(self.buffer[:cut + 1])
+                self.buffer = self.buffer[cut + 1:]
+
+        return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+    def flush(self):
+        """残りのテキストを返す"""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+
+class PhraseCache:
+    """読み上げ音声のディスクキャッシュ
+
+    文と声の設定（音声ID・速さ・音量）のハッシュをキーに、save_to_file で
+    合成した音声ファイルを保存する。合計サイズが上限を超えたら最後に
+    使われた時刻（mtime）が古いものから削除する。
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.voice_key = ""
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def set_voice(self, voice_id, rate, volume):
+        """声の設定が変われば別のキーになる"""
+        self.voice_key = f"{voice_id}|{rate}|{volume}"
+
+    def path(self, text):
+        digest = hashlib.sha256(f"{self.voice_key}\n{text}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.wav")
+
+    def get(self, text):
+        """キャッシュ済みならファイルパス（使用時刻を更新）、なければNone"""
+        path = self.path(text)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def render(self, engine, text):
+        """エンジンで音声ファイルに合成して保存（ワーカースレッドから呼ぶ）"""
+        path = self.path(text)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        try:
+            engine.save_to_file(text, tmp_path)
+            engine.runAndWait()
+            if not os.path.getsize(tmp_path):
+                raise OSError("空のファイル")
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"⚠️ 読み上げキャッシュ作成エラー: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        self.evict()
+        return path
+
+    def evict(self):
+        """上限を超えた分を古い順に削除"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".wav"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    @staticmethod
+    def play(path, reference=None, wait=True):
+        """キャッシュ済みの音声を直接再生し、再生時間（秒）を返す
+
+        wait=True なら再生終了か sd.stop() まで待つ。
+        """
+        data, sample_rate = sf.read(path, dtype='float32')
+        sd.play(data, sample_rate)
+        if reference is not None:
+            # 再生開始からスピーカーに届くまでの出力遅延を加える
+            reference.start(data, sample_rate, latency=output_latency())
+        if wait:
+            sd.wait()
+        return len(data) / sample_rate
+
+
+def output_latency():
+    """再生中の出力ストリームが報告する出力遅延（秒、取得できなければ0）"""
+    try:
+        latency = sd.get_stream().latency
+    except Exception:
+        return 0.0
+    if isinstance(latency, (tuple, list)):
+        latency = latency[-1]
+    return float(latency or 0.0)
+
+
+def capture_time(time_info, frames, sample_rate):
+    """録音ブロックの先頭がADCで取り込まれた時刻（time.monotonic 基準）
+
+    PortAudioの時刻（inputBufferAdcTime / currentTime）はストリーム独自の
+    時計なので、コールバック時点との差を time.monotonic() から引く。
+    時刻を報告しないバックエンドではブロックの長さから推定する。
+    """
+    now = time.monotonic()
+    try:
+        adc_time = time_info.inputBufferAdcTime
+        delay = time_info.currentTime - adc_time
+    except AttributeError:
+        adc_time, delay = 0.0, 0.0
+    if not adc_time or not 0.0 <= delay < 1.0:
+        return now - frames / sample_rate
+    return now - delay
+
+
+class PlaybackReference:
+    """再生中の読み上げ音声（エコー除去の参照信号）
+
+    再生開始時刻（出力遅延込み）と録音ブロックのADC時刻から、録音の
+    各ブロックに対応する再生音声を切り出す。
+    """
+
+    # 再生音声を録音より少し先行させ、時刻の誤差をフィルタの遅延で吸収する
+    LEAD_SECONDS = 0.02
+    # 再生終了後も残響が消えるまで参照信号（無音）を渡す
+    TAIL_SECONDS = 0.3
+
+    def __init__(self, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.signal = None
+        self.started_at = 0.0
+        self.ended_at = 0.0
+
+    def start(self, data, sample_rate, latency=0.0):
+        """再生開始を記録（latency: スピーカーから音が出るまでの出力遅延）"""
+        mono = data if data.ndim == 1 else data.mean(axis=1)
+        signal = resample(mono, sample_rate, self.sample_rate)
+        with self.lock:
+            self.signal = signal
+            self.started_at = time.monotonic() + latency
+            self.ended_at = self.started_at + len(signal) / self.sample_rate
+
+    def cut(self):
+        """再生を中断した時点で参照信号を打ち切る"""
+        with self.lock:
+            self.ended_at = min(self.ended_at, time.monotonic())
+
+    def segment(self, start_time, n):
+        """start_time（time.monotonic）から n サンプル分（再生と無関係ならNone）"""
+        start_time += self.LEAD_SECONDS
+        with self.lock:
+            if self.signal is None or not (
+                self.started_at - n / self.sample_rate <= start_time < self.ended_at + self.TAIL_SECONDS
+            ):
+                return None
+            offset = int(round((start_time - self.started_at) * self.sample_rate))
+            end = int(round((self.ended_at - self.started_at) * self.sample_rate))
+            segment = np.zeros(n, dtype=np.float32)
+            lo, hi = max(offset, 0), min(offset + n, end, len(self.signal))
+            if hi > lo:
+                segment[lo - offset:hi - offset] = self.signal[lo:hi]
+            return segment
+
+
+playback_reference = PlaybackReference()
+
+
+def warmup_phrases():
+    """起動時に合成しておく定型文"""
+    phrases = [SERVER_DOWN_MESSAGE, CONFIG["greeting"]] + list(CONFIG["tts_warmup_phrases"])
+    return [phrase for phrase in dict.fromkeys(phrases) if phrase]
+
+
 class ImprovedTTS:
-    """改善版TTS"""
-    
-    def __init__(self):
+    """改善版TTS
+
+    pyttsx3エンジンは専用のワーカースレッドで初期化・実行する。文ごとに
+    キューへ積むため、AI応答の残りを受信している間に最初の文を読み上げる。
+    定型文と繰り返し読み上げた文は PhraseCache から直接再生する。
+    """
+
+    _END = object()
+    # 読み上げがこの秒数なかった時だけキャッシュを作る（次の応答や挨拶を待たせない）
+    RENDER_IDLE_SECONDS = 2.0
+
+    def __init__(self, use_cache=None):
         self.engine = None
-        self.init_engine()
+        self.first_audio_time = None
+        if use_cache is None:
+            use_cache = CONFIG["tts_cache"]
+        self.cache = None
+        if use_cache:
+            try:
+                self.cache = PhraseCache(CONFIG["tts_cache_dir"], CONFIG["tts_cache_max_mb"] * 1024 * 1024)
+            except OSError as e:
+                print(f"⚠️ 読み上げキャッシュを使用できません: {e}")
+        # 割り込みモードでは全文をファイルに合成して再生する。一度きりの文で
+        # 定型文のキャッシュを追い出さないよう、一時ディレクトリに分ける
+        self.scratch = None
+        if BARGE_IN:
+            self.scratch = PhraseCache(tempfile.mkdtemp(prefix="caretalker_tts_"), 20 * 1024 * 1024)
+        # 再生中に先読みして合成済みの次の文
+        self.lookahead = None
+        self.interrupted = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.spoken_counts = {}
+        self.pending_renders = []
+        self.sentence_queue = queue.Queue()
+        self.ready = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.worker = threading.Thread(target=self._worker_loop, daemon=True)
+        self.worker.start()
+        self.ready.wait(timeout=10)
         
     def init_engine(self):
         """TTSエンジンを初期化"""
@@ -263,6 +1145,14 @@ class ImprovedTTS:
                 if 'japanese' in voice.id.lower() or 'ja' in voice.id.lower():
                     self.engine.setProperty('voice', voice.id)
                     break
+
+            for cache in (self.cache, self.scratch):
+                if cache is not None:
+                    cache.set_voice(
+                        self.engine.getProperty('voice'),
+                        self.engine.getProperty('rate'),
+                        self.engine.getProperty('volume'),
+                    )
                     
             print("✅ TTSエンジン準備完了")
             return True
@@ -270,15 +1160,96 @@ class ImprovedTTS:
             print(f"⚠️ TTSエンジン初期化エラー: {e}")
             self.engine = None
             return False
-    
-    def speak(self, text):
-        """同期的に読み上げ"""
-        if not text:
+
+    def _worker_loop(self):
+        """TTSワーカー: キューの文を順に読み上げる"""
+        self.init_engine()
+        self.ready.set()
+        if self.cache is not None and self.engine is not None:
+            self.pending_renders.extend(warmup_phrases())
+
+        while True:
+            if self.lookahead is not None:
+                item, self.lookahead = self.lookahead, None
+            elif self.pending_renders:
+                # しばらく読み上げがなく、応答の途中でもない時だけキャッシュを作る
+                try:
+                    item = self.sentence_queue.get(timeout=self.RENDER_IDLE_SECONDS)
+                except queue.Empty:
+                    if self.idle.is_set():
+                        self._render_cache(self.pending_renders.pop(0))
+                    continue
+            else:
+                item = self.sentence_queue.get()
+            if item is self._END:
+                self.idle.set()
+                continue
+            if self.interrupted.is_set():
+                continue
+            if self.first_audio_time is None:
+                self.first_audio_time = time.time()
+            self._say(item)
+
+    def _render_cache(self, text):
+        """未作成ならキャッシュに合成（ワーカースレッドから呼ぶ）"""
+        if self.engine is None or self.cache.get(text):
             return
-            
-        system_state.set_tts_playing(True)
-        print(f"🔊 読み上げ中: {text[:50]}...")
-        
+        render_start = time.time()
+        if self.cache.render(self.engine, text):
+            print(f"💽 読み上げキャッシュ作成: {text[:30]}（{(time.time() - render_start) * 1000:.0f}ms）")
+
+    def _rendered(self, text):
+        """割り込みモード用に合成済みの音声ファイル（定型文のキャッシュを優先）"""
+        cached = self.cache.get(text) if self.cache is not None else None
+        return cached or self.scratch.get(text) or self.scratch.render(self.engine, text)
+
+    def _prerender_next(self, duration):
+        """再生中に次の文が届いたら合成しておく（再生時間 duration 秒まで待つ）"""
+        deadline = time.monotonic() + duration
+        while not self.interrupted.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                item = self.sentence_queue.get(timeout=min(0.1, remaining))
+            except queue.Empty:
+                continue
+            self.lookahead = item
+            if item is not self._END and not self.interrupted.is_set():
+                self._rendered(item)
+            return
+
+    def _say(self, text):
+        """1文を読み上げ（ワーカースレッドから呼ぶ）"""
+        if BARGE_IN and self.engine is not None:
+            # 再生音声をエコー除去の参照にするため、合成してから sounddevice で再生
+            path = self._rendered(text)
+            if path:
+                try:
+                    duration = PhraseCache.play(path, playback_reference, wait=False)
+                    self._prerender_next(duration)
+                    sd.wait()
+                    return
+                except Exception as e:
+                    print(f"⚠️ 読み上げ再生エラー: {e}")
+
+        if self.cache is not None:
+            cached = self.cache.get(text)
+            if cached:
+                try:
+                    PhraseCache.play(cached)
+                    return
+                except Exception as e:
+                    print(f"⚠️ キャッシュ再生エラー: {e}")
+
+            # 繰り返し読み上げる文は次回からキャッシュで再生
+            if len(self.spoken_counts) > 1000:
+                self.spoken_counts.clear()
+            count = self.spoken_counts.get(text, 0) + 1
+            self.spoken_counts[text] = count
+            if count == CONFIG["tts_cache_min_repeats"]:
+                self.pending_renders.append(text)
+
         try:
             if self.engine is None:
                 if not self.init_engine():
@@ -287,26 +1258,280 @@ class ImprovedTTS:
             
             self.engine.say(text)
             self.engine.runAndWait()
-            time.sleep(0.5)
             
         except Exception as e:
             print(f"⚠️ TTS読み上げエラー: {e}")
             self.engine = None
-            
+    
+    def speak(self, text):
+        """同期的に読み上げ"""
+        if not text:
+            return
+        self.speak_stream([text])
+
+    def speak_stream(self, text_chunks):
+        """逐次届くテキストを文ごとに読み上げ、全文を返す
+
+        最初の文がそろった時点で読み上げを開始する。読み上げ中は
+        system_state でマイクを止め、最後の文の後に解除する。
+        interrupt() で中断された場合は残りの応答を受信せずに戻る。
+        """
+        splitter = SentenceSplitter()
+        full_text = ""
+        self.first_audio_time = None
+        self.interrupted.clear()
+
+        system_state.set_tts_playing(True)
+        self.idle.clear()
+        
+        try:
+            for chunk in text_chunks:
+                if self.interrupted.is_set():
+                    break
+                full_text += chunk
+                for sentence in splitter.feed(chunk):
+                    self._enqueue(sentence)
+            for sentence in splitter.flush():
+                self._enqueue(sentence)
+
         finally:
+            if hasattr(text_chunks, 'close'):
+                text_chunks.close()
+            self.sentence_queue.put(self._END)
+            self.idle.wait()
             system_state.set_tts_playing(False)
-            print("✅ 読み上げ完了")
+            print("✋ 読み上げを中断しました" if self.interrupted.is_set() else "✅ 読み上げ完了")
+
+        return full_text
+
+    def speak_stream_async(self, text_chunks):
+        """別スレッドで speak_stream を実行（Futureを返す）"""
+        return self.executor.submit(self.speak_stream, text_chunks)
+
+    def interrupt(self):
+        """読み上げを即座に中断（割り込み発話の検出時）"""
+        if not system_state.is_tts_playing:
+            return
+        self.interrupted.set()
+        playback_reference.cut()
+        try:
+            sd.stop()
+        except Exception:
+            pass
+
+    def _enqueue(self, sentence):
+        print(f"🔊 読み上げ中: {sentence[:50]}")
+        self.sentence_queue.put(sentence)
+
+    def stop(self):
+        """エンジンを停止"""
+        self.interrupt()
+        if self.cache is not None or self.scratch is not None:
+            try:
+                sd.stop()
+            except Exception:
+                pass
+        if self.engine:
+            try:
+                self.engine.stop()
+            except:
+                pass
 
 # ===========================================================================
 # ★ 6. 録音処理
 # ===========================================================================
-def record_improved(vad=None, output_filename="recording.wav"):
-    """改善された録音処理"""
+# 発話開始前に遡って残す音声（語頭の欠け防止）
+PREROLL_MS = int(CONFIG["preroll_ms"])
+# 読み上げ直後に捨てる音声（スピーカーの残響を拾わないため）
+TTS_TAIL_MS = 500
+# 直近の録音の内訳（秒）: vad_endpoint = 最後の有音ブロックから録音終了まで
+last_recording_timings = {}
+# 直近の録音で発生したエラー（入力デバイスがないなど、正常終了ならNone）
+last_recording_error = None
+
+class CaptureRingBuffer:
+    """録音用の事前確保リングバッファ（プリロール付き）
+
+    sounddeviceのコールバックが直接書き込む。待機中はリングとして
+    上書きし続け、mark_onset() で発話開始の少し前（プリロール）から
+    先頭に詰めて直線バッファに切り替えるため、発話全体をコピーなしの
+    ビューとして取り出せる。位置は録音開始からの通算サンプル数で扱う。
+    書き込み時に渡したADC時刻から、各位置の録音時刻を time_at() で求める。
+    """
+
+    def __init__(self, sample_rate=16000, max_seconds=30, preroll_ms=300, block_size=480):
+        self.sample_rate = sample_rate
+        self.preroll = int(sample_rate * preroll_ms / 1000)
+        self.capacity = int(sample_rate * max_seconds) + self.preroll + block_size * 4
+        self.buffer = np.zeros(self.capacity, dtype=np.float32)
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        """バッファを空にしてリングモードに戻す"""
+        with self.condition:
+            self.write_total = 0
+            self.read_total = 0
+            # 直線モードでの buffer[0] の通算位置（Noneならリングモード）
+            self.linear_origin = None
+            self.overflow = False
+            self.woken = False
+            # 直近の書き込みの先頭位置とそのADC時刻（time.monotonic 基準）
+            self.anchor_position = 0
+            self.anchor_time = None
+
+    def wake(self):
+        """read_blocks で待っているスレッドを起こす（状態遷移の通知用）"""
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def write(self, samples, timestamp=None):
+        """録音コールバックから呼ぶ（samplesはコピーせずにバッファへ書き込む）
+
+        timestamp: ブロックの先頭がADCで取り込まれた時刻（capture_time）
+        """
+        with self.condition:
+            if timestamp is not None:
+                self.anchor_position = self.write_total
+                self.anchor_time = timestamp
+            n = len(samples)
+            if self.linear_origin is None:
+                if n > self.capacity:
+                    self.write_total += n - self.capacity
+                    samples = samples[-self.capacity:]
+                    n = self.capacity
+                index = self.write_total % self.capacity
+                first = min(n, self.capacity - index)
+                self.buffer[index:index + first] = samples[:first]
+                if first < n:
+                    self.buffer[:n - first] = samples[first:]
+            else:
+                index = self.write_total - self.linear_origin
+                n = min(n, self.capacity - index)
+                if n <= 0:
+                    self.overflow = True
+                    return
+                self.buffer[index:index + n] = samples[:n]
+            self.write_total += n
+            self.condition.notify_all()
+
+    def _span(self, start, end):
+        """通算位置 [start, end) のサンプル（折り返す場合のみコピー）"""
+        if self.linear_origin is not None:
+            return self.buffer[start - self.linear_origin:end - self.linear_origin]
+        a = start % self.capacity
+        b = a + (end - start)
+        if b <= self.capacity:
+            return self.buffer[a:b]
+        return np.concatenate((self.buffer[a:], self.buffer[:b - self.capacity]))
+
+    def read_blocks(self, block_size, timeout=None):
+        """未読のブロックをまとめて取得
+
+        Returns:
+            (先頭ブロックの通算位置, ブロック行列) 。timeout までに1ブロックも
+            たまらないか wake() で起こされた場合は (位置, 空の行列)
+        """
+        with self.condition:
+            if self.write_total - self.read_total < block_size:
+                self.condition.wait_for(
+                    lambda: self.woken or self.write_total - self.read_total >= block_size, timeout
+                )
+            self.woken = False
+            # 読み出しが追いつかず上書きされた分は読み飛ばす
+            start = max(self.read_total, self.write_total - self.capacity)
+            n_blocks = (self.write_total - start) // block_size
+            end = start + n_blocks * block_size
+            self.read_total = end
+            return start, self._span(start, end).reshape(n_blocks, block_size)
+
+    def view(self, start, end):
+        """通算位置 [start, end) のサンプル"""
+        with self.condition:
+            return self._span(start, end)
+
+    def overwrite(self, start, samples):
+        """通算位置 start からのサンプルを書き換え（読み出し後に処理した結果を戻す）"""
+        with self.condition:
+            n = len(samples)
+            if self.linear_origin is not None:
+                index = start - self.linear_origin
+                if index >= 0:
+                    self.buffer[index:index + n] = samples[:max(0, self.capacity - index)]
+                return
+            if start < self.write_total - self.capacity:
+                return
+            index = start % self.capacity
+            first = min(n, self.capacity - index)
+            self.buffer[index:index + first] = samples[:first]
+            if first < n:
+                self.buffer[:n - first] = samples[first:]
+
+    def time_at(self, position):
+        """通算位置のサンプルが録音された時刻（時刻が渡されていなければNone）"""
+        with self.condition:
+            if self.anchor_time is None:
+                return None
+            return self.anchor_time + (position - self.anchor_position) / self.sample_rate
+
+    def mark_onset(self, position):
+        """発話開始位置を確定し、プリロールを含めて直線モードに切り替える
+
+        Returns:
+            発話データの先頭の通算位置
+        """
+        with self.condition:
+            oldest = max(0, self.write_total - self.capacity)
+            origin = max(oldest, position - self.preroll)
+            pending = self._span(origin, self.write_total).copy()
+            self.buffer[:len(pending)] = pending
+            self.linear_origin = origin
+            return origin
+
+    def utterance(self, end):
+        """発話データ（先頭から通算位置 end まで）のビュー"""
+        with self.condition:
+            return self.buffer[:end - self.linear_origin]
+
+
+_capture_buffer = None
+
+def get_capture_buffer(sample_rate, block_size, max_seconds):
+    """録音バッファを取得（ターンごとに確保し直さず再利用）"""
+    global _capture_buffer
+    if _capture_buffer is None or _capture_buffer.sample_rate != sample_rate:
+        _capture_buffer = CaptureRingBuffer(sample_rate, max_seconds, PREROLL_MS, block_size)
+    return _capture_buffer
+
+_echo_canceller = None
+
+def get_echo_canceller(sample_rate):
+    """エコーキャンセラを取得（学習したエコー経路をターンをまたいで使う）"""
+    global _echo_canceller
+    if _echo_canceller is None:
+        _echo_canceller = NLMSEchoCanceller(
+            filter_length=int(sample_rate * CONFIG["aec_filter_ms"] / 1000),
+            step_size=CONFIG["aec_step_size"],
+        )
+    return _echo_canceller
+
+def record_improved(vad=None, output_filename="recording.wav", stream=None, tts=None):
+    """改善された録音処理
+
+    stream に StreamingUpload を渡すと、発話開始から録音フレームを
+    逐次アップロードする。返す録音データは録音バッファのビューなので、
+    次の record_improved 呼び出しまでに使い終えること。
+    割り込みモード（barge_in）では読み上げ中も録音を続け、再生音声の
+    エコーを除いた上で発話を検出したら tts の読み上げを止める。
+    """
     SAMPLERATE = 16000
     BLOCK_DURATION_MS = 30
     BLOCKSIZE = int(SAMPLERATE * BLOCK_DURATION_MS / 1000)
     SILENCE_SECONDS = 1.5
     MAX_RECORDING_SECONDS = 30
+    SILENCE_BLOCKS = int(SILENCE_SECONDS * 1000 / BLOCK_DURATION_MS)
+    MAX_RECORDING_SAMPLES = MAX_RECORDING_SECONDS * SAMPLERATE
 
     # VADが渡されていない場合は新規作成（初回のみ）
     if vad is None:
@@ -314,101 +1539,164 @@ def record_improved(vad=None, output_filename="recording.wav"):
         need_calibration = True
     else:
         need_calibration = False
-        
-    audio_queue = queue.Queue()
-    recording_started = False
+
+    global last_recording_error
+    last_recording_error = None
+    capture = get_capture_buffer(SAMPLERATE, BLOCKSIZE, MAX_RECORDING_SECONDS)
+    capture.reset()
+    last_recording_timings.clear()
+    last_voice_time = None
+
+    canceller = get_echo_canceller(SAMPLERATE) if BARGE_IN else None
 
     def audio_callback(indata, frames, time_info, status):
         if status:
             print(f"⚠️ 録音: {status}")
-        audio_queue.put(indata.copy())
+        # コールバックでは書き込みだけ行い、エコー除去は読み出し側で行う
+        timestamp = capture_time(time_info, frames, SAMPLERATE) if canceller is not None else None
+        capture.write(indata[:, 0], timestamp)
+
+    def cancel_echo(position, blocks):
+        """再生中のブロックからエコーを除き、ブロックごとの近端比（再生と無関係ならNone）を返す"""
+        ratios = [None] * len(blocks)
+        if canceller is None:
+            return blocks, ratios
+        cleaned = None
+        for i, block in enumerate(blocks):
+            start_time = capture.time_at(position + i * BLOCKSIZE)
+            reference = None if start_time is None else playback_reference.segment(start_time, BLOCKSIZE)
+            if reference is None:
+                continue
+            if cleaned is None:
+                cleaned = blocks.copy()
+            cleaned[i] = canceller.process(block, reference)
+            ratios[i] = canceller.near_end_ratio
+        if cleaned is None:
+            return blocks, ratios
+        # 発話データ・ストリーミング送信にもエコー除去後の音声を使う
+        capture.overwrite(position, cleaned.reshape(-1))
+        return cleaned, ratios
+
+    # 読み上げが始まったら録音待ちのスレッドを即座に起こす
+    def on_transition(old_state, new_state):
+        if new_state == ConversationState.SPEAKING:
+            capture.wake()
+
+    system_state.add_listener(on_transition)
 
     try:
         with sd.InputStream(samplerate=SAMPLERATE, channels=1, dtype='float32', 
                           blocksize=BLOCKSIZE, callback=audio_callback):
             
-            while system_state.is_tts_playing:
+            if system_state.is_tts_playing and not BARGE_IN:
                 print("⏸️ TTS再生中... 待機しています")
-                time.sleep(0.5)
+                system_state.wait_until_not(ConversationState.SPEAKING)
             
             system_state.set_recording(True)
             
             # 初回のみキャリブレーション
             if need_calibration:
-                print("📊 環境音をキャリブレーション中（3秒）...")
+                print(f"📊 環境音をキャリブレーション中（{vad.calibration_seconds:g}秒）...")
                 print("静かにしてください...")
                 
-                while not audio_queue.empty():
-                    try:
-                        audio_queue.get_nowait()
-                    except:
-                        break
-                
+                capture.reset()
                 while not vad.is_calibrated:
-                    try:
-                        audio_chunk = audio_queue.get(timeout=1)
-                        rms = np.sqrt(np.mean(audio_chunk**2))
-                        if vad.calibrate(rms):
-                            break
-                    except queue.Empty:
-                        pass
-            else:
-                # キューをクリア
-                while not audio_queue.empty():
-                    try:
-                        audio_queue.get_nowait()
-                    except:
+                    _, blocks = capture.read_blocks(BLOCKSIZE, timeout=1)
+                    if len(blocks) and vad.calibrate_frames(blocks):
                         break
+
+            # 待機中・キャリブレーション中の音声を捨てる
+            capture.reset()
+
+            # 読み上げ終了直後の残響区間は判定に使わない
+            tail_remaining = TTS_TAIL_MS / 1000 - (time.time() - system_state.speaking_ended_at)
+            listen_from = 0 if BARGE_IN else int(max(0.0, tail_remaining) * SAMPLERATE)
             
             print("🎤 話してください...")
-            recorded_frames = []
-            is_recording = False
-            last_voice_time = None
-            recording_start_time = None
+            startup_timer.report()
+            vad.reset()
+            onset = None
+            end = None
+            silent_blocks = 0
 
-            while True:
-                if system_state.is_tts_playing:
+            while end is None:
+                if system_state.is_tts_playing and not BARGE_IN:
                     print("⚠️ TTS再生を検出。録音を中断します。")
                     break
-                    
-                try:
-                    audio_chunk = audio_queue.get(timeout=0.1)
-                    rms = np.sqrt(np.mean(audio_chunk**2))
+                # 割り込みモードで読み上げが終わっていれば聞き取りに戻る
+                system_state.set_recording(True)
+
+                # 音声ブロックの到着か状態遷移で起きる（タイムアウトは録音停止の監視用）
+                position, blocks = capture.read_blocks(BLOCKSIZE, timeout=1.0)
+                if position < listen_from and len(blocks):
+                    skip = min(len(blocks), -(-(listen_from - position) // BLOCKSIZE))
+                    blocks = blocks[skip:]
+                    position += skip * BLOCKSIZE
+                if not len(blocks):
+                    continue
 
-                    if vad.is_voice(rms):
-                        if not is_recording:
+                blocks, near_end_ratios = cancel_echo(position, blocks)
+
+                # 溜まっているブロックをまとめてVADで一括判定
+                decisions = vad.process(blocks)
+
+                for i, voiced in enumerate(decisions):
+                    block_start = position + i * BLOCKSIZE
+                    block_end = block_start + BLOCKSIZE
+
+                    if voiced:
+                        if onset is None and system_state.is_tts_playing:
+                            # 読み上げ中はエコーより十分大きい声だけを割り込みとみなす
+                            ratio = near_end_ratios[i]
+                            if ratio is not None and ratio < CONFIG["barge_in_ratio"]:
+                                continue
+                            print("✋ 割り込み発話を検出。読み上げを停止します")
+                            if tts is not None:
+                                tts.interrupt()
+                        if onset is None:
                             print("🔴 音声を検出！録音開始")
-                            is_recording = True
-                            recording_started = True
-                            recording_start_time = time.time()
-                        recorded_frames.append(audio_chunk)
+                            onset = capture.mark_onset(block_start)
+                            if stream is not None:
+                                stream.start()
+                                stream.feed(capture.view(onset, block_start))
+                        silent_blocks = 0
                         last_voice_time = time.time()
-                    
-                    elif is_recording:
-                        recorded_frames.append(audio_chunk)
-                        
-                        if time.time() - last_voice_time > SILENCE_SECONDS:
-                            print("⏹️ 録音終了")
-                            break
-                        
-                        if time.time() - recording_start_time > MAX_RECORDING_SECONDS:
-                            print("⏹️ 最大録音時間に達しました")
-                            break
-                            
-                except queue.Empty:
-                    if recording_started and is_recording and last_voice_time:
-                        if time.time() - last_voice_time > SILENCE_SECONDS:
-                            break
+                    elif onset is None:
+                        continue
+                    else:
+                        silent_blocks += 1
+
+                    if stream is not None:
+                        stream.feed(capture.view(block_start, block_end))
+
+                    if silent_blocks >= SILENCE_BLOCKS:
+                        print("⏹️ 録音終了")
+                        end = block_end
+                        break
+
+                    if block_end - onset >= MAX_RECORDING_SAMPLES or capture.overflow:
+                        print("⏹️ 最大録音時間に達しました")
+                        end = block_end
+                        break
 
             system_state.set_recording(False)
+            if stream is not None:
+                stream.finish()
+            if last_voice_time is not None:
+                last_recording_timings['vad_endpoint'] = time.time() - last_voice_time
+
+            # TTSで中断された場合もそこまでの発話を返す
+            if onset is not None and end is None:
+                end = capture.read_total
             
-            if recorded_frames:
-                recording = np.concatenate(recorded_frames, axis=0)
+            if onset is not None:
+                recording = capture.utterance(end)
                 duration = len(recording) / SAMPLERATE
                 print(f"💾 録音完了: {duration:.1f}秒 @ {SAMPLERATE}Hz")
                 
-                if np.max(np.abs(recording)) > 0:
-                    recording = recording / np.max(np.abs(recording))
+                peak = np.max(np.abs(recording))
+                if peak > 0:
+                    recording *= 1.0 / peak
                 
                 return recording, SAMPLERATE, vad  # VADも返す
             else:
@@ -417,13 +1705,23 @@ def record_improved(vad=None, output_filename="recording.wav"):
 
     except Exception as e:
         print(f"❌ 録音エラー: {e}")
+        last_recording_error = e
         return None, SAMPLERATE, vad  # VADも返す
     finally:
+        system_state.remove_listener(on_transition)
         system_state.set_recording(False)
+        if stream is not None:
+            stream.finish()
 
 # ===========================================================================
 # ★ 7. メイン処理
 # ===========================================================================
+# 連続エラー後に再開するまでの待ち時間
+ERROR_COOLDOWN_SECONDS = 30
+# 録音エラー（入力デバイスなし等）の再試行間隔。連続するたびに倍にする
+RECORDING_RETRY_SECONDS = 1.0
+RECORDING_RETRY_MAX_SECONDS = 30.0
+
 def main_voice_chat():
     """堅牢版AI音声チャットシステム"""
     
@@ -436,13 +1734,32 @@ def main_voice_chat():
     print("  • キャリブレーションは初回のみ")
     print("="*50)
     
-    ai_client = RobustAIClient(SERVER_URL)
-    tts = ImprovedTTS()
+    # サーバー検出とTTSエンジン初期化を並行して行う
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        server_future = executor.submit(get_server_url)
+        tts = ImprovedTTS()
+        startup_timer.mark("TTS初期化")
+        ai_client = RobustAIClient(server_future.result())
+        startup_timer.mark("サーバー検出")
+
+    if CONFIG["greeting"]:
+        tts.speak(CONFIG["greeting"])
     
     session_count = 1
     error_count = 0
     max_errors = 5
     vad = None  # VADを保持
+    recording_failures = 0
+    trace_recorder = TraceRecorder()
+
+    def finish_turn(ai_response, trace, start_time, send_start):
+        """読み上げ後の計測・表示（割り込みモードでは読み上げスレッドから呼ばれる）"""
+        if tts.first_audio_time:
+            print(f"⏱️ 最初の音声まで: {tts.first_audio_time - send_start:.1f}秒")
+            trace.add('tts_first_audio', tts.first_audio_time - send_start)
+        print(f"\n🤖 ケアトーカー: {ai_response}")
+        trace.add('turn', time.time() - start_time)
+        trace_recorder.record(trace)
     
     try:
         while True:
@@ -450,24 +1767,55 @@ def main_voice_chat():
             print(f"📍 セッション #{session_count}")
             
             start_time = time.time()
-            audio_data, sample_rate, vad = record_improved(vad)  # VADを渡す
+            # 発話を待つ間にサーバーへの接続を温めておく
+            ai_client.warmup_async()
+            trace = ai_client.start_trace()
+            upload = ai_client.start_stream_upload()
+            audio_data, sample_rate, vad = record_improved(vad, stream=upload, tts=tts)  # VADを渡す
             
             if audio_data is not None:
                 record_time = time.time() - start_time
-                print(f"⏱️ 録音時間: {record_time:.1f}秒")
+                print(f"⏱️ 録音時間: {record_time:.1f}秒 (trace {trace.trace_id})")
+                trace.add('vad_endpoint', last_recording_timings.get('vad_endpoint'))
                 
                 send_start = time.time()
-                ai_response = ai_client.send_audio(audio_data, sample_rate)
+                system_state.transition(ConversationState.UPLOADING)
+                response_stream, error = None, None
+                if upload is not None:
+                    response_stream, error = upload.result()
+                if response_stream is None and error is None:
+                    # 逐次アップロード非対応・失敗時はWAVで一括送信
+                    response_stream, error = ai_client.send_audio_streaming(audio_data, sample_rate)
                 ai_time = time.time() - send_start
                 
-                print(f"⏱️ AI応答時間: {ai_time:.1f}秒")
+                print(f"⏱️ AI応答時間（受信開始まで）: {ai_time:.1f}秒")
+                
+                timings = ai_client.last_timings
+                trace.add('encode', timings.get('encode'))
+                if 'request' in timings:
+                    trace.add('upload', max(0.0, timings['request'] - timings.get('server', 0.0)))
+                for name in ('server', 'server_transcription', 'inference'):
+                    trace.add(name, timings.get(name))
                 
-                if ai_response and not any(err in ai_response for err in ["エラー", "SSL", "接続", "タイムアウト"]):
-                    print(f"\n🤖 ケアトーカー: {ai_response}")
-                    tts.speak(ai_response)
+                if response_stream is not None:
+                    response_stream = trace.wrap_response(response_stream, time.time())
+                    if BARGE_IN:
+                        # 読み上げ中に次の録音を始め、話しかけられたら読み上げを止める
+                        speech = tts.speak_stream_async(response_stream)
+                        speech.add_done_callback(
+                            lambda future, trace=trace, start_time=start_time, send_start=send_start:
+                                finish_turn(future.result(), trace, start_time, send_start)
+                        )
+                    else:
+                        finish_turn(tts.speak_stream(response_stream), trace, start_time, send_start)
                     error_count = 0  # エラーカウントをリセット
                 else:
-                    print(f"⚠️ 応答エラー: {ai_response}")
+                    system_state.transition(ConversationState.IDLE, only_from=ConversationState.UPLOADING)
+                    print(f"⚠️ 応答エラー: {error}")
+                    trace.error = error
+                    if ai_client.breaker.is_open:
+                        # サーバー停止中は待たせずに定型文で知らせる
+                        tts.speak(SERVER_DOWN_MESSAGE)
                     error_count += 1
                     
                     if error_count >= max_errors:
@@ -477,19 +1825,30 @@ def main_voice_chat():
                         print("2. ngrok URLが正しいか")
                         print("3. ngrokトンネルが有効か")
                         
-                        retry = input("\n再試行しますか？ (y/n): ")
-                        if retry.lower() != 'y':
-                            break
+                        # 無人運用のため入力は待たず、少し休んでから再開
+                        print(f"⏳ {ERROR_COOLDOWN_SECONDS}秒後に再開します...")
+                        time.sleep(ERROR_COOLDOWN_SECONDS)
                         error_count = 0
+
+                    trace.add('turn', time.time() - start_time)
+                    trace_recorder.record(trace)
                 
                 session_count += 1
                 
+            elif last_recording_error is not None:
+                # 録音できない間は間隔を空けて再試行（CPUを使い続けない）
+                recording_failures += 1
+                delay = min(RECORDING_RETRY_MAX_SECONDS, RECORDING_RETRY_SECONDS * 2 ** (recording_failures - 1))
+                print(f"⏳ 録音できません。{delay:.0f}秒後に再試行します...")
+                time.sleep(delay)
+                continue
+                
             else:
                 print("⚠️ 録音データがありません。")
             
-            # 待機時間を短縮
+            recording_failures = 0
+            # 状態遷移は即時に行うため、次の録音まで待機しない
             print("\n⏸️ 次の録音を開始... (Ctrl+C で終了)")
-            time.sleep(1)  # 2秒から1秒に短縮
 
     except KeyboardInterrupt:
         print("\n\n👋 対話を終了しました。お疲れさまでした！")
@@ -498,11 +1857,7 @@ def main_voice_chat():
     finally:
         if ai_client.session:
             ai_client.session.close()
-        if tts.engine:
-            try:
-                tts.engine.stop()
-            except:
-                pass
+        tts.stop()
 
 # ===========================================================================
 # ★ 8. 起動
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+conversation_worker.py - 常駐の会話ワーカー
+
+会話モジュール（既定は standby.py）を起動時に一度だけ読み込んで待機し、
+detection.py から Unix ソケットで合図を受けたら同じプロセス内で会話を
+開始する。人検知のたびにインタプリタの起動や音声・TTS・モデルの
+読み込みを繰り返さないので、検知から挨拶までの待ち時間がなくなる。
+
+会話モジュールは run_session()（なければ main()）を持つこと。
+warmup() があれば起動時に一度呼ぶ。run_session() が返した値は
+JSONに変換できれば会話結果として検知側に返す。
+
+プロトコル（1行1メッセージのJSON）:
+    検知側 → ワーカー: {"cmd": "start" | "ping" | "stop"}（start には検知したカメラ名 "camera" が付く）
+    ワーカー → 検知側: {"type": "log", "stream": "stdout", "text": ...}（会話中の出力を逐次）
+                       {"type": "result", "ok": true, "exit_code": 0, "duration": 12.3, ...}
+"""
+
+import contextlib
+import importlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+SOCKET_PATH = os.environ.get("CARETALKER_WORKER_SOCKET", "/tmp/caretalker-conversation.sock")
+CONVERSATION_MODULE = os.environ.get("CARETALKER_CONVERSATION_MODULE", "standby")
+
+
+def send_message(conn, message):
+    """1行のJSONとして送信"""
+    conn.sendall((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+class SocketLogWriter:
+    """print の出力を検知側に流す（切断後はワーカー自身の出力へ）"""
+
+    def __init__(self, conn, stream_name, echo, lock):
+        self.conn = conn
+        self.stream_name = stream_name
+        self.echo = echo
+        self.lock = lock
+        self.connected = True
+
+    def write(self, text):
+        if not text:
+            return 0
+        with self.lock:
+            if self.connected:
+                try:
+                    send_message(self.conn, {"type": "log", "stream": self.stream_name, "text": text})
+                    return len(text)
+                except OSError:
+                    # 検知側が切断しても会話は最後まで続ける
+                    self.connected = False
+        self.echo.write(text)
+        return len(text)
+
+    def flush(self):
+        self.echo.flush()
+
+    def isatty(self):
+        return False
+
+
+class ConversationWorker:
+    """会話モジュールを読み込んだまま、合図ごとに会話を1回実行"""
+
+    def __init__(self, module_name=CONVERSATION_MODULE, socket_path=SOCKET_PATH):
+        self.module_name = module_name
+        self.socket_path = socket_path
+        self.entry = None
+        self.sessions = 0
+
+    def load(self):
+        """会話モジュールを読み込み、あればウォームアップ"""
+        started = time.perf_counter()
+        # standby.py と同じくカレントディレクトリのスクリプトを読み込む
+        if os.getcwd() not in sys.path:
+            sys.path.insert(0, os.getcwd())
+        module = importlib.import_module(self.module_name)
+        self.entry = getattr(module, "run_session", None) or getattr(module, "main")
+        warmup = getattr(module, "warmup", None)
+        if warmup is not None:
+            warmup()
+        print(f"🔥 会話モジュール {self.module_name} を読み込みました（{time.perf_counter() - started:.1f}秒）")
+
+    def run_session(self, conn):
+        """会話を1回実行して結果を返す"""
+        self.sessions += 1
+        lock = threading.Lock()
+        stdout = SocketLogWriter(conn, "stdout", sys.__stdout__, lock)
+        stderr = SocketLogWriter(conn, "stderr", sys.__stderr__, lock)
+
+        started = time.time()
+        exit_code, error, session = 0, None, None
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                session = self.entry()
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception as e:
+                exit_code, error = 1, str(e)
+                traceback.print_exc()
+
+        result = {
+            "type": "result",
+            "ok": exit_code == 0,
+            "exit_code": exit_code,
+            "duration": round(time.time() - started, 2),
+            "session_number": self.sessions,
+            "error": error,
+        }
+        try:
+            json.dumps(session)
+            result["session"] = session
+        except (TypeError, ValueError):
+            result["session"] = None
+        return result
+
+    def handle(self, conn):
+        """1接続分のコマンドを処理（stop なら False）"""
+        with conn, conn.makefile("r", encoding="utf-8") as reader:
+            line = reader.readline()
+            if not line:
+                return True
+            request = json.loads(line)
+            command = request.get("cmd")
+            if command == "ping":
+                send_message(conn, {"type": "pong", "sessions": self.sessions})
+            elif command == "start":
+                camera = request.get("camera")
+                print(f"🗣️ 会話セッション開始（{self.sessions + 1}回目{f', カメラ: {camera}' if camera else ''}）")
+                result = self.run_session(conn)
+                result["camera"] = camera
+                print(f"📋 会話セッション終了: {'成功' if result['ok'] else '失敗'}（{result['duration']}秒）")
+                try:
+                    send_message(conn, result)
+                except OSError:
+                    pass
+            elif command == "stop":
+                send_message(conn, {"type": "bye"})
+                return False
+            else:
+                send_message(conn, {"type": "error", "error": f"不明なコマンド: {command}"})
+        return True
+
+    def serve(self):
+        """ソケットで合図を待ち、会話を1つずつ実行"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(1)
+        print(f"⏳ 会話ワーカー待機中: {self.socket_path}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                try:
+                    if not self.handle(conn):
+                        break
+                except Exception as e:
+                    print(f"❌ ワーカー処理エラー: {e}")
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            print("🛑 会話ワーカー終了")
+
+
+def main():
+    worker = ConversationWorker()
+    try:
+        worker.load()
+    except Exception as e:
+        print(f"❌ 会話モジュール読込エラー: {e}")
+        sys.exit(1)
+    try:
+        worker.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,189 +1,900 @@
 #!/usr/bin/env python3
 """
 detection.py - 人検知専用モジュール（改良版）
-一度検知したら終了してstandby.pyを起動
+検知したらstandby.pyを起動し、会話中は検知を一時停止する
+（カメラとカスケードは起動時に一度だけ準備して使い回す）
 """
 
 import cv2
+import json
+import os
+import queue
+import socket
 import time
 import subprocess
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from detector_backends import DetectorBackend, create_backend
+
+# 常駐の会話ワーカー（conversation_worker.py）
+WORKER_SOCKET = os.environ.get("CARETALKER_WORKER_SOCKET", "/tmp/caretalker-conversation.sock")
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversation_worker.py")
+
+class FpsCounter:
+    """直近のフレーム間隔からfpsを計算"""
+    
+    def __init__(self, window=60):
+        self.times = deque(maxlen=window)
+    
+    def tick(self):
+        self.times.append(time.perf_counter())
+    
+    def rate(self):
+        if len(self.times) < 2:
+            return 0.0
+        return (len(self.times) - 1) / max(self.times[-1] - self.times[0], 1e-6)
+
+class FrameScheduler:
+    """時間帯と動きの有無から検知の間隔を決める
+    
+    動きがない状態が idle_after 秒続いたら idle_fps に下げ、動きを検出したら
+    すぐに active_fps に戻す。時間帯ごとの設定は JSON で指定できる:
+    
+        [{"start": "22:00", "end": "06:00", "active_fps": 5, "idle_fps": 0.5, "idle_after": 20},
+         {"active_fps": 8, "idle_fps": 1}]
+    
+    start / end のない設定はどの時間帯にも当てはまらない時の既定値になる
+    （なければ DEFAULT_PROFILE）。
+    """
+    
+    DEFAULT_PROFILE = {"start": "00:00", "end": "24:00", "active_fps": 10, "idle_fps": 2, "idle_after": 30}
+    MIN_FPS = 0.2
+    
+    def __init__(self, profiles=None):
+        profiles = profiles or []
+        self.profiles = [dict(self.DEFAULT_PROFILE, **p) for p in profiles if "start" in p or "end" in p]
+        defaults = [p for p in profiles if "start" not in p and "end" not in p]
+        self.default = dict(self.DEFAULT_PROFILE, **(defaults[-1] if defaults else {}))
+    
+    @classmethod
+    def load(cls, path=None):
+        """設定ファイル（環境変数 CARETALKER_DETECTION_PROFILES）を読み込み、なければ既定値"""
+        path = path or os.environ.get(
+            "CARETALKER_DETECTION_PROFILES",
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "detection_profiles.json")
+        )
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding="utf-8") as f:
+                profiles = json.load(f)
+            print(f"🕒 検知スケジュールを読み込みました: {path}（{len(profiles)}件）")
+            return cls(profiles)
+        except Exception as e:
+            print(f"⚠️ 検知スケジュール読込エラー: {path}: {e}")
+            return cls()
+    
+    @staticmethod
+    def _minutes(text):
+        hours, minutes = text.split(":")
+        return int(hours) * 60 + int(minutes)
+    
+    def profile(self, now=None):
+        """現在の時刻に当てはまる設定（日をまたぐ範囲にも対応）"""
+        current = datetime.fromtimestamp(now or time.time())
+        minute = current.hour * 60 + current.minute
+        for profile in self.profiles:
+            start, end = self._minutes(profile["start"]), self._minutes(profile["end"])
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return profile
+        return self.default
+    
+    def interval(self, last_motion_time, now=None):
+        """次の検知までの間隔（秒）とモード（active / idle）"""
+        now = now or time.time()
+        profile = self.profile(now)
+        if now - last_motion_time < profile["idle_after"]:
+            return 1.0 / max(profile["active_fps"], self.MIN_FPS), "active"
+        return 1.0 / max(profile["idle_fps"], self.MIN_FPS), "idle"
+
+class CpuMonitor:
+    """このプロセスのCPU使用率と、取得できればSoCの温度"""
+    
+    THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+    
+    def __init__(self):
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.process_time()
+    
+    def cpu_percent(self):
+        """前回呼び出しからのCPU使用率（1コアを100%とする）"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        percent = (cpu - self.last_cpu) / max(wall - self.last_wall, 1e-6) * 100
+        self.last_wall, self.last_cpu = wall, cpu
+        return percent
+    
+    def temperature(self):
+        """SoCの温度（℃、取得できなければNone）"""
+        try:
+            with open(self.THERMAL_ZONE) as f:
+                return int(f.read().strip()) / 1000
+        except (OSError, ValueError):
+            return None
+    
+    def summary(self):
+        text = f"CPU {self.cpu_percent():.0f}%"
+        if hasattr(os, "getloadavg"):
+            text += f"（load {os.getloadavg()[0]:.2f}）"
+        temperature = self.temperature()
+        if temperature is not None:
+            text += f" / {temperature:.1f}℃"
+        return text
+
+class FrameGrabber:
+    """カメラからフレームを取り込み続け、最新の1枚だけを保持するスレッド
+    
+    検知が遅れてもドライバに古いフレームが溜まらず、検知側は常に
+    最新のフレームを処理する。取り込み（grab）は常に続け、デコード
+    （retrieve）は検知側がフレームを要求した時だけ行うので、検知の
+    間隔を空けている間はデコードのCPU負荷がかからない。
+    
+    motion_probe を渡すと、probing の間は MOTION_PROBE_SECONDS ごとに
+    フレームをデコードして軽量な動き判定を行い、検知側の待機を起こせる。
+    """
+    
+    # この回数続けてフレーム取得に失敗したらカメラを開き直す
+    MAX_READ_FAILURES = 30
+    # 待機中の動き判定の間隔（秒）
+    MOTION_PROBE_SECONDS = 0.2
+    
+    def __init__(self, camera, reopen=None, motion_probe=None):
+        self.camera = camera
+        self.reopen = reopen
+        self.motion_probe = motion_probe
+        self.probing = threading.Event()
+        self.condition = threading.Condition()
+        self.frame = None
+        self.seq = 0
+        self.decoding = threading.Event()
+        self.requested = threading.Event()
+        self.stopped = threading.Event()
+        self.capture_fps = FpsCounter()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+    
+    def start(self):
+        self.decoding.set()
+        self.thread.start()
+    
+    def set_decoding(self, enabled):
+        """False の間は取り込みだけ行い、フレームを更新しない"""
+        if enabled:
+            self.decoding.set()
+        else:
+            self.decoding.clear()
+    
+    def _run(self):
+        failures = 0
+        next_probe = 0.0
+        while not self.stopped.is_set():
+            ok, frame = self.camera.grab(), None
+            probe = (ok and self.motion_probe is not None and self.probing.is_set()
+                     and time.monotonic() >= next_probe)
+            if ok and self.decoding.is_set() and (self.requested.is_set() or probe):
+                self.requested.clear()
+                ok, frame = self.camera.retrieve()
+                if ok and probe:
+                    next_probe = time.monotonic() + self.MOTION_PROBE_SECONDS
+                    try:
+                        self.motion_probe(frame)
+                    except Exception as e:
+                        print(f"⚠️ 動き判定エラー: {e}")
+            
+            if not ok:
+                failures += 1
+                if failures >= self.MAX_READ_FAILURES and self.reopen is not None:
+                    self.camera = self.reopen() or self.camera
+                    failures = 0
+                time.sleep(0.1)
+                continue
+            failures = 0
+            
+            self.capture_fps.tick()
+            if frame is not None:
+                with self.condition:
+                    self.frame = frame
+                    self.seq += 1
+                    self.condition.notify_all()
+    
+    def latest(self, after_seq, timeout=1.0):
+        """after_seq より新しいフレームを待って (番号, フレーム) を返す（タイムアウト時はフレームがNone）"""
+        self.requested.set()
+        with self.condition:
+            if self.condition.wait_for(lambda: self.seq > after_seq or self.stopped.is_set(), timeout):
+                return self.seq, self.frame
+            return after_seq, None
+    
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=2)
+
+class ConfirmationBuffer:
+    """連続検知の確定判定（直近 buffer_size フレーム中 required_detections 回以上）"""
+    
+    def __init__(self, buffer_size=5, required_detections=3):
+        self.buffer_size = buffer_size
+        self.required_detections = required_detections
+        self.buffer = deque(maxlen=buffer_size)
+    
+    def reset(self):
+        self.buffer.clear()
+    
+    def add(self, detected):
+        """1フレーム分の検知結果を追加し、確定したらTrue"""
+        self.buffer.append(bool(detected))
+        return len(self.buffer) >= self.buffer_size and self.count >= self.required_detections
+    
+    @property
+    def count(self):
+        return sum(self.buffer)
+
 class PersonDetector:
-    """人検知クラス（一回検知で終了版）"""
+    """人検知クラス（常駐版：カメラを開いたまま会話中は一時停止）"""
+    
+    # 取り込み・検知のfpsを表示する間隔（秒）
+    FPS_REPORT_SECONDS = 30
+    
+    # 動き検出は 1/4 に縮小した画像で行う（640x480 → 160x120）
+    MOTION_SCALE = 0.25
+    MOTION_THRESHOLD = 25
+    MOTION_MIN_AREA = 40  # 縮小画像でのピクセル数
+    # 背景の更新速度（小さいほど立ち止まった人を長く前景として扱う）
+    BACKGROUND_ALPHA = 0.05
+    # 動きが止まってもこの秒数は直前の領域で検知を続ける
+    MOTION_HOLD_SECONDS = 1.5
+    # 検知の待機中は取り込みスレッドが 1/8 に縮小した画像で動きを見張る
+    PROBE_SCALE = 0.125
+    PROBE_MIN_AREA = 10  # 縮小画像でのピクセル数
+    # 検出器は 1/2 に縮小した画像の動き領域だけに適用
+    DETECTION_SCALE = 0.5
+    ROI_PADDING = 0.25
     
-    def __init__(self, camera_id=0):
-        """初期化"""
+    def __init__(self, camera_id=0, backend=None, backend_options=None, buffer_size=5, required_detections=3,
+                 name=None):
+        """初期化（backend: haar / hog / dnn か読み込み済みの検出器、未指定なら環境変数 CARETALKER_DETECTOR）"""
         self.camera_id = camera_id
+        self.name = name
+        # 複数カメラの時にログの先頭に付けるカメラ名
+        self.label = f"[{name}] " if name else ""
         self.camera = None
+        self.grabber = None
+        self.detection_fps = FpsCounter()
+        self.scheduler = FrameScheduler.load()
+        self.cpu_monitor = CpuMonitor()
+        self.mode = None
+        
+        # 会話中など検知を止めている間はクリア（paused はその逆）
+        self.active = threading.Event()
+        self.paused = threading.Event()
+        # 検知の間隔待ちを中断する（一時停止か、取り込みスレッドが動きを見つけた時）
+        self.wake = threading.Event()
+        self.last_report = time.time()
         
         # 連続検知確認用
-        self.detection_buffer = []
-        self.buffer_size = 5
-        self.required_detections = 3
+        self.confirmation = ConfirmationBuffer(buffer_size, required_detections)
         
-        # OpenCV人検知用カスケード分類器
-        self.face_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-        )
-        self.body_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + 'haarcascade_fullbody.xml'
-        )
+        # 人検知の検出器（既定は従来のHaarカスケード、複数カメラでは共有）
+        if isinstance(backend, DetectorBackend):
+            self.backend = backend
+        else:
+            self.backend = self.create_backend(backend, backend_options)
+        
+        # 動き検出の状態
+        self.background = None
+        self.motion_roi = None
+        self.last_motion_time = 0.0
+        # 取り込みスレッドの動き判定の状態
+        self.probe_previous = None
+        self.probe_motion_time = 0.0
+        
+        # 段階ごとの処理時間（回数・合計秒）
+        self.stage_stats = {}
+        self.gated_frames = 0
+        self.total_frames = 0
         
-        print("🔍 PersonDetector 初期化完了（一回検知終了版）")
+        print(f"🔍 {self.label}PersonDetector 初期化完了（常駐版, 検出器: {self.backend.name}）")
     
-    def initialize_camera(self):
-        """カメラ初期化"""
+    @classmethod
+    def create_backend(cls, backend=None, backend_options=None):
+        """検出器を読み込む（使えない場合はhaar）"""
+        backend = backend or os.environ.get("CARETALKER_DETECTOR", "haar")
         try:
-            self.camera = cv2.VideoCapture(self.camera_id)
-            if not self.camera.isOpened():
-                print("❌ カメラ接続エラー")
-                return False
+            return create_backend(backend, scale=cls.DETECTION_SCALE, **(backend_options or {}))
+        except (ValueError, FileNotFoundError, cv2.error) as e:
+            print(f"⚠️ 検出器 {backend} を使用できません: {e}（haarを使用）")
+            return create_backend("haar", scale=cls.DETECTION_SCALE)
+    
+    def open_camera(self):
+        """カメラを開いて設定（失敗時はNone）"""
+        try:
+            camera = cv2.VideoCapture(self.camera_id)
+            if not camera.isOpened():
+                print(f"❌ {self.label}カメラ接続エラー")
+                return None
             
             # カメラ設定
-            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-            self.camera.set(cv2.CAP_PROP_FPS, 30)
+            camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            camera.set(cv2.CAP_PROP_FPS, 30)
+            # ドライバ側のバッファも最小に（対応していないバックエンドでは無視される）
+            camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
             
-            print("✅ カメラ初期化完了")
-            return True
+            print(f"✅ {self.label}カメラ初期化完了")
+            return camera
             
         except Exception as e:
-            print(f"❌ カメラ初期化エラー: {e}")
+            print(f"❌ {self.label}カメラ初期化エラー: {e}")
+            return None
+    
+    def initialize_camera(self):
+        """カメラを開いて取り込みスレッドを開始（開始済みなら何もしない）"""
+        if self.grabber is not None:
+            return True
+        self.camera = self.open_camera()
+        if self.camera is None:
             return False
+        self.grabber = FrameGrabber(self.camera, reopen=self.reopen_camera, motion_probe=self.probe_motion)
+        self.grabber.start()
+        return True
+    
+    def _record_stage(self, name, started, elapsed=None):
+        """段階ごとの処理時間を記録"""
+        if elapsed is None:
+            elapsed = time.perf_counter() - started
+        count, total = self.stage_stats.get(name, (0, 0.0))
+        self.stage_stats[name] = (count + 1, total + elapsed)
+    
+    def reset_motion(self):
+        """背景モデルを作り直す（一時停止からの再開時）"""
+        self.background = None
+        self.motion_roi = None
+        self.probe_previous = None
+        # 再開直後は人が近くにいることが多いので active から始める
+        self.last_motion_time = time.time()
     
-    def detect_person(self, frame):
-        """フレームから人を検知"""
+    def probe_motion(self, frame):
+        """取り込みスレッドから呼ぶ軽量な動き判定（前回の判定とのフレーム差分）
+        
+        動きがあれば検知の間隔待ちを起こし、検知モードを active に戻す。
+        """
+        small = cv2.resize(frame, None, fx=self.PROBE_SCALE, fy=self.PROBE_SCALE, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        previous, self.probe_previous = self.probe_previous, gray
+        if previous is None or previous.shape != gray.shape:
+            return False
+        _, mask = cv2.threshold(cv2.absdiff(gray, previous), self.MOTION_THRESHOLD, 255, cv2.THRESH_BINARY)
+        if cv2.countNonZero(mask) < self.PROBE_MIN_AREA:
+            return False
+        self.probe_motion_time = time.time()
+        self.wake.set()
+        return True
+    
+    def detect_motion(self, gray):
+        """背景差分で動き領域を求める（縮小画像の座標を元の比率で返す、なければNone）"""
+        small = cv2.resize(gray, None, fx=self.MOTION_SCALE, fy=self.MOTION_SCALE, interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+        
+        if self.background is None:
+            self.background = small.astype("float32")
+            return None
+        
+        diff = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(small, self.background, self.BACKGROUND_ALPHA)
+        _, mask = cv2.threshold(diff, self.MOTION_THRESHOLD, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, None, iterations=2)
+        
+        # OpenCV 3 / 4 で戻り値の数が違うため後ろから取る
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        boxes = [cv2.boundingRect(c) for c in contours if cv2.contourArea(c) >= self.MOTION_MIN_AREA]
+        if not boxes:
+            return None
+        
+        # 全ての動き領域を囲む矩形（0〜1の比率）
+        h, w = small.shape
+        x1 = min(x for x, _, _, _ in boxes)
+        y1 = min(y for _, y, _, _ in boxes)
+        x2 = max(x + bw for x, _, bw, _ in boxes)
+        y2 = max(y + bh for _, y, _, bh in boxes)
+        return (x1 / w, y1 / h, x2 / w, y2 / h)
+    
+    def _roi_image(self, image, roi):
+        """縮小した検知用画像から動き領域（余白付き）を切り出す"""
+        small = cv2.resize(image, None, fx=self.DETECTION_SCALE, fy=self.DETECTION_SCALE, interpolation=cv2.INTER_AREA)
+        h, w = small.shape[:2]
+        x1, y1, x2, y2 = roi
+        pad_x = (x2 - x1) * self.ROI_PADDING
+        pad_y = (y2 - y1) * self.ROI_PADDING
+        left, top = int(max(0.0, x1 - pad_x) * w), int(max(0.0, y1 - pad_y) * h)
+        right, bottom = int(min(1.0, x2 + pad_x) * w), int(min(1.0, y2 + pad_y) * h)
+        return small[top:bottom, left:right]
+    
+    def detect_person(self, frame, now=None, backend=None):
+        """フレームから人を検知（now: フレームの時刻、録画の評価用、backend: ワーカーが借りた検出器）
+        
+        動き検出 → 動き領域だけ縮小画像で検出器を実行、の順に進み、
+        動きがなければ検出器は実行しない。
+        """
+        backend = backend or self.backend
         try:
+            self.total_frames += 1
             gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
             
-            # 顔検知（厳しい条件）
-            faces = self.face_cascade.detectMultiScale(
-                gray, 
-                scaleFactor=1.2,
-                minNeighbors=8,
-                minSize=(60, 60),
-                maxSize=(300, 300),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
+            # 動き検出（動きがない部屋ではここで終わる）
+            started = time.perf_counter()
+            roi = self.detect_motion(gray)
+            self._record_stage("motion", started)
+            if now is None:
+                now = time.time()
+            if roi is not None:
+                self.motion_roi = roi
+                self.last_motion_time = now
+            elif self.motion_roi is None or now - self.last_motion_time > self.MOTION_HOLD_SECONDS:
+                self.motion_roi = None
+                self.gated_frames += 1
+                return False
             
-            # 人体検知（厳しい条件）
-            bodies = self.body_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.3,
-                minNeighbors=6,
-                minSize=(80, 120),
-                maxSize=(400, 600),
-                flags=cv2.CASCADE_SCALE_IMAGE
-            )
+            image = self._roi_image(gray, self.motion_roi)
+            color = self._roi_image(frame, self.motion_roi) if backend.needs_color else None
             
-            valid_faces = len(faces)
-            valid_bodies = len(bodies)
+            result = backend.detect(image, color)
+            self._record_stage(backend.name, None, result.cost_ms / 1000)
+            for name, seconds in result.stages.items():
+                self._record_stage(f"{backend.name}.{name}", None, seconds)
             
-            if valid_faces > 0 or valid_bodies > 0:
-                confidence_score = valid_faces * 2 + valid_bodies
-                if confidence_score >= 2:
-                    print(f"👤 人検知（信頼度:{confidence_score}): 顔={valid_faces}, 体={valid_bodies}")
-                    return True
+            if result.found:
+                print(f"👤 {self.label}人検知（{backend.name} 信頼度:{result.confidence:.2f}): {result.summary}")
+                return True
             
             return False
             
         except Exception as e:
-            print(f"❌ 人検知エラー: {e}")
+            print(f"❌ {self.label}人検知エラー: {e}")
             return False
     
-    def wait_for_person(self):
-        """人を待機（一度検知したら終了）"""
+    def report_stats(self):
+        """段階ごとの処理時間を表示"""
+        if not self.total_frames:
+            return
+        print(f"📊 {self.label}処理フレーム: {self.total_frames}（動きなしで省略: {self.gated_frames}）")
+        self.report_fps()
+        for name, (count, total) in self.stage_stats.items():
+            print(f"   {name}: {count}回, 平均 {total / count * 1000:.1f}ms, 合計 {total:.1f}秒")
+    
+    def request_pause(self):
+        """検知ループに停止を合図（処理中のフレームは最後まで処理される）"""
+        self.active.clear()
+        self.paused.set()
+        self.wake.set()
+        if self.grabber is not None:
+            self.grabber.set_decoding(False)
+    
+    def pause(self):
+        """検知を一時停止（カメラとカスケードは保持、検知ループが止まってから呼ぶ）"""
+        self.request_pause()
+        self.confirmation.reset()
+        print(f"⏸️ {self.label}人検知を一時停止")
+        self.report_stats()
+    
+    def resume(self):
+        """検知を再開（取り込みスレッドが古いフレームを捨て続けているので即座に再開）"""
         if not self.initialize_camera():
             return False
+        self.grabber.set_decoding(True)
+        self.confirmation.reset()
+        self.reset_motion()
+        self.paused.clear()
+        self.wake.clear()
+        self.active.set()
+        return True
+    
+    def reopen_camera(self):
+        """カメラを開き直す（接続が切れた場合、取り込みスレッドから呼ばれる）"""
+        print(f"🔄 {self.label}カメラを再接続します")
+        if self.camera:
+            self.camera.release()
+        self.camera = self.open_camera()
+        return self.camera
+    
+    def report_fps(self):
+        """取り込みと検知のfps、CPU使用率・温度を表示"""
+        if self.grabber is not None:
+            print(f"📷 {self.label}取り込み {self.grabber.capture_fps.rate():.1f}fps / 検知 {self.detection_fps.rate():.1f}fps"
+                  f"（{self.mode or '-'}） / {self.cpu_monitor.summary()}")
+    
+    def process_next_frame(self, last_seq, detect=None):
+        """最新フレームを1枚処理して (フレーム番号, 確定したか) を返す
+        
+        detect は検知処理の差し替え用（複数カメラではワーカープールに渡す）。
+        確定しなかった場合は検知モードに応じた間隔まで待ってから戻る。
+        """
+        loop_start = time.time()
+        # 前回処理した後の最新フレームだけを処理（途中のフレームは捨てる）
+        seq, frame = self.grabber.latest(last_seq, timeout=1.0)
+        if frame is None:
+            print(f"❌ {self.label}カメラフレーム取得失敗")
+            return last_seq, False
+        
+        # 人検知
+        self.detection_fps.tick()
+        person_found = (detect or self.detect_person)(frame)
+        
+        # 連続検知判定
+        if self.confirmation.add(person_found):
+            print(f"✅ {self.label}人検知確定！({self.confirmation.count}/{self.confirmation.buffer_size}フレーム)")
+            return seq, True
+        
+        if time.time() - self.last_report >= self.FPS_REPORT_SECONDS:
+            self.report_fps()
+            self.last_report = time.time()
+        
+        # 動きがなければ間隔を空け、動きがあればすぐに全速へ戻す
+        interval, mode = self.scheduler.interval(max(self.last_motion_time, self.probe_motion_time))
+        if mode != self.mode:
+            print(f"⚙️ {self.label}検知モード: {mode}（{1 / interval:.1f}fps）")
+            self.mode = mode
+            # idle の間だけ取り込みスレッドに動きを見張らせる
+            if mode == "idle":
+                self.grabber.probing.set()
+            else:
+                self.grabber.probing.clear()
+        delay = interval - (time.time() - loop_start)
+        if delay > 0:
+            # 一時停止されたか、取り込みスレッドが動きを見つけたらすぐに戻る
+            self.wake.wait(delay)
+        if self.active.is_set():
+            self.wake.clear()
+        return seq, False
+    
+    def wait_for_person(self):
+        """人を待機（検知したら一時停止して戻る）"""
+        if not self.resume():
+            return False
         
         print("🔍 人検知待機開始...")
         print("👤 ユーザーが通りかかるのをお待ちしています...")
         
+        last_seq = self.grabber.seq
         try:
-            while True:
-                ret, frame = self.camera.read()
-                if not ret:
-                    print("❌ カメラフレーム取得失敗")
-                    time.sleep(0.1)
-                    continue
-                
-                # 人検知
-                person_found = self.detect_person(frame)
-                
-                # 検知バッファ更新
-                self.detection_buffer.append(person_found)
-                
-                # バッファサイズ維持
-                if len(self.detection_buffer) > self.buffer_size:
-                    self.detection_buffer.pop(0)
-                
-                # 連続検知判定
-                if len(self.detection_buffer) >= self.buffer_size:
-                    recent_detections = sum(self.detection_buffer)
-                    
-                    if recent_detections >= self.required_detections:
-                        print(f"✅ 人検知確定！({recent_detections}/{self.buffer_size}フレーム)")
-                        print(f"🎯 {datetime.now().strftime('%H:%M:%S')} - ユーザー検知完了")
-                        self.cleanup()
-                        return True
-                
-                time.sleep(0.1)  # CPU負荷軽減
+            while self.active.is_set():
+                last_seq, confirmed = self.process_next_frame(last_seq)
+                if confirmed:
+                    print(f"🎯 {datetime.now().strftime('%H:%M:%S')} - ユーザー検知完了")
+                    self.pause()
+                    return True
+            
+            return False
                 
         except KeyboardInterrupt:
             print("\n🛑 検知中断")
-            self.cleanup()
-            return False
+            self.pause()
+            raise
         except Exception as e:
             print(f"❌ 検知エラー: {e}")
-            self.cleanup()
+            self.pause()
             return False
     
     def cleanup(self):
         """リソース解放"""
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
         if self.camera:
             self.camera.release()
         cv2.destroyAllWindows()
-        print("🔍 PersonDetector 終了")
+        print(f"🔍 {self.label}PersonDetector 終了")
+
+class DetectionEvent:
+    """人検知の確定（どのカメラで検知したか）"""
+    
+    def __init__(self, camera_id, name, detected_at=None):
+        self.camera_id = camera_id
+        self.name = name
+        self.detected_at = detected_at or time.time()
+    
+    def __repr__(self):
+        return f"DetectionEvent({self.name}, {datetime.fromtimestamp(self.detected_at).strftime('%H:%M:%S')})"
+
+def parse_cameras(text):
+    """カメラの指定を (名前, カメラID) のリストに変換
+    
+    "0,1" や "entrance=0,living=/dev/video2,porch=rtsp://..." の形式。
+    数字だけのIDはカメラ番号として扱う。
+    """
+    cameras = []
+    for i, item in enumerate(part.strip() for part in text.split(",") if part.strip()):
+        name, _, source = item.partition("=") if "=" in item.split("://")[0] else ("", "", item)
+        source = int(source) if source.isdigit() else source
+        cameras.append((name or f"camera{i}", source))
+    return cameras
+
+class MultiCameraDetector:
+    """複数カメラの人検知（検出器は共有し、検知は上限付きのワーカープールで実行）
+    
+    カメラごとに取り込みスレッドと動き検出・確定判定の状態を持ち、
+    検出器（カスケードやDNN）はワーカーの数だけ読み込む。カメラを
+    増やしてもモデルのメモリと同時に動く検知の数は増えない。
+    """
+    
+    def __init__(self, cameras, workers=None, backend=None, backend_options=None,
+                 buffer_size=5, required_detections=3):
+        """初期化（cameras: (名前, カメラID) のリスト、workers: 同時に実行する検知の数）"""
+        workers = workers or int(os.environ.get("CARETALKER_DETECTION_WORKERS", "1"))
+        self.workers = max(1, min(workers, len(cameras)))
+        
+        # ワーカーが検知のたびに借りて返す検出器
+        backends = [PersonDetector.create_backend(backend, backend_options) for _ in range(self.workers)]
+        self.backends = queue.Queue()
+        for instance in backends:
+            self.backends.put(instance)
+        
+        self.detectors = [
+            PersonDetector(camera_id, backend=backends[0], buffer_size=buffer_size,
+                           required_detections=required_detections, name=name)
+            for name, camera_id in cameras
+        ]
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="detect")
+        self.events = queue.Queue()
+        self.threads = []
+        print(f"🔍 MultiCameraDetector 初期化完了（カメラ {len(self.detectors)}台, ワーカー {self.workers}）")
+    
+    def _detect(self, detector, frame):
+        """プールの検出器を借りて1フレーム検知"""
+        backend = self.backends.get()
+        try:
+            return detector.detect_person(frame, backend=backend)
+        finally:
+            self.backends.put(backend)
+    
+    def _watch(self, detector):
+        """カメラ1台分の検知ループ（確定したらイベントを通知）"""
+        def detect(frame):
+            return self.executor.submit(self._detect, detector, frame).result()
+        
+        last_seq = detector.grabber.seq
+        while detector.active.is_set():
+            try:
+                last_seq, confirmed = detector.process_next_frame(last_seq, detect=detect)
+            except Exception as e:
+                print(f"❌ {detector.label}検知エラー: {e}")
+                detector.paused.wait(1.0)
+                continue
+            if confirmed:
+                self.events.put(DetectionEvent(detector.camera_id, detector.name))
+                return
+    
+    def pause(self):
+        """全カメラの検知を一時停止"""
+        # 検知ループを止めてから確定判定のリセットと統計の表示を行う
+        running = [detector for detector in self.detectors if detector.active.is_set()]
+        for detector in running:
+            detector.request_pause()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        self.threads = []
+        for detector in running:
+            detector.pause()
+    
+    def wait_for_person(self):
+        """いずれかのカメラで人を検知するまで待機（検知したカメラのイベント、失敗時はNone）"""
+        running = [detector for detector in self.detectors if detector.resume()]
+        if not running:
+            return None
+        
+        # 前回の会話中に重なって確定した分は捨てる
+        while not self.events.empty():
+            self.events.get_nowait()
+        
+        print(f"🔍 人検知待機開始...（{', '.join(d.name for d in running)}）")
+        print("👤 ユーザーが通りかかるのをお待ちしています...")
+        
+        self.threads = [
+            threading.Thread(target=self._watch, args=(detector,), daemon=True, name=f"camera-{detector.name}")
+            for detector in running
+        ]
+        for thread in self.threads:
+            thread.start()
+        
+        try:
+            while True:
+                try:
+                    event = self.events.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    if not any(thread.is_alive() for thread in self.threads):
+                        print("❌ 全カメラの検知が停止しました")
+                        self.pause()
+                        return None
+            print(f"🎯 {datetime.now().strftime('%H:%M:%S')} - ユーザー検知完了（カメラ: {event.name}）")
+            self.pause()
+            return event
+        except KeyboardInterrupt:
+            print("\n🛑 検知中断")
+            self.pause()
+            raise
+    
+    def cleanup(self):
+        """リソース解放"""
+        self.pause()
+        self.executor.shutdown(wait=False)
+        for detector in self.detectors:
+            detector.cleanup()
+        print("🔍 MultiCameraDetector 終了")
+
+class ConversationClient:
+    """常駐の会話ワーカーを起動し、検知のたびに会話開始を合図する"""
+    
+    # ワーカーが会話モジュールを読み込み終わるまで待つ最大時間
+    READY_TIMEOUT = 30
+    
+    def __init__(self, socket_path=WORKER_SOCKET):
+        self.socket_path = socket_path
+        self.process = None
+    
+    def _connect(self, command, timeout=None, **fields):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps({"cmd": command, **fields}, ensure_ascii=False) + "\n").encode("utf-8"))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    
+    def ping(self):
+        """ワーカーが待機中か確認"""
+        try:
+            with self._connect("ping", timeout=1.0) as sock, sock.makefile("r", encoding="utf-8") as reader:
+                return json.loads(reader.readline() or "{}").get("type") == "pong"
+        except (OSError, ValueError):
+            return False
+    
+    def start_worker(self):
+        """ワーカーを起動（検知を待つ間に会話モジュールを読み込ませる、起動できなければFalse）"""
+        if self.ping():
+            print("🔥 会話ワーカーは起動済みです")
+            return True
+        try:
+            # ログがそのまま流れるよう標準出力は引き継ぐ
+            self.process = subprocess.Popen([sys.executable, WORKER_SCRIPT])
+            print(f"🚀 会話ワーカーを起動しました (pid={self.process.pid})")
+            return True
+        except Exception as e:
+            print(f"⚠️ 会話ワーカー起動エラー: {e}")
+            self.process = None
+            return False
+    
+    def wait_ready(self):
+        """ワーカーの準備ができるまで待機（止まっていれば一度だけ起動し直し、使えなければFalse）"""
+        deadline = time.time() + self.READY_TIMEOUT
+        restarted = False
+        while not self.ping():
+            if self.process is None or self.process.poll() is not None:
+                if restarted:
+                    return False
+                restarted = True
+                if self.process is not None:
+                    print(f"⚠️ 会話ワーカーが終了していました（終了コード: {self.process.returncode}）。起動し直します")
+                else:
+                    print("⚠️ 会話ワーカーが応答しないため起動し直します")
+                self.process = None
+                if not self.start_worker():
+                    return False
+                deadline = time.time() + self.READY_TIMEOUT
+                continue
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+    
+    def run_session(self, camera=None):
+        """会話を1回実行し、ログを逐次表示して結果を返す（ワーカーが使えなければNone）"""
+        if not self.wait_ready():
+            return None
+        try:
+            with self._connect("start", camera=camera) as sock, sock.makefile("r", encoding="utf-8") as reader:
+                for line in reader:
+                    message = json.loads(line)
+                    if message["type"] == "log":
+                        print(message["text"], end="", flush=True)
+                    elif message["type"] == "result":
+                        return message
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 会話ワーカーとの通信エラー: {e}")
+            return {"ok": False, "error": str(e)}
+        return {"ok": False, "error": "会話ワーカーが結果を返さずに切断しました"}
+    
+    def stop(self):
+        """自分で起動したワーカーを終了"""
+        if self.process is None:
+            return
+        try:
+            with self._connect("stop", timeout=2.0) as sock:
+                sock.recv(64)
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.terminate()
+        self.process = None
 
 def launch_standby():
-    """standby.py を起動"""
+    """standby.py を起動（ワーカーが使えない時の従来の方式）"""
     try:
         print("🚀 standby.py を起動中...")
         
-        # standby.py を実行
-        result = subprocess.run([
+        # standby.py を実行し、出力は終了を待たずに表示
+        process = subprocess.Popen([
             sys.executable, "standby.py"
-        ], capture_output=True, text=True)
+        ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in process.stdout:
+            print(line, end="", flush=True)
+        returncode = process.wait()
         
         print("✅ standby.py 実行完了")
-        print("📋 実行結果:")
-        if result.stdout:
-            print(result.stdout)
-        if result.stderr:
-            print("⚠️ エラー出力:", result.stderr)
-        
-        return result.returncode == 0
+        return returncode == 0
         
     except Exception as e:
         print(f"❌ standby.py 起動エラー: {e}")
         return False
 
+def run_conversation(client, camera=None):
+    """会話を1回実行（ワーカー優先、使えなければ standby.py を起動）"""
+    result = client.run_session(camera=camera)
+    if result is None:
+        print("⚠️ 会話ワーカーが使えないため standby.py を起動します")
+        return launch_standby()
+    
+    if result.get("error"):
+        print(f"⚠️ エラー: {result['error']}")
+    if result.get("duration") is not None:
+        print(f"📋 会話時間: {result['duration']}秒")
+    if result.get("session"):
+        print(f"📋 会話結果: {result['session']}")
+    return result["ok"]
+
 def main():
     """メイン処理 - 検知→起動のループ"""
     print("🎯 CareTalker 人検知システム開始")
     print("🔄 検知→会話→検知のサイクルを開始します")
     
+    # カスケードの読み込みとカメラの準備は最初の一度だけ
+    # 複数カメラは CARETALKER_CAMERAS="entrance=0,living=1" のように指定
+    cameras = parse_cameras(os.environ.get("CARETALKER_CAMERAS", "0"))
+    if not cameras:
+        print("⚠️ CARETALKER_CAMERAS にカメラの指定がないため、カメラ0を使用します")
+        cameras = [("camera0", 0)]
+    if len(cameras) > 1:
+        detector = MultiCameraDetector(cameras)
+    else:
+        detector = PersonDetector(cameras[0][1])
+    # 会話ワーカーは検知を待つ間に準備しておく
+    conversation = ConversationClient()
+    conversation.start_worker()
+    
     while True:
         try:
-            # 人検知開始
-            detector = PersonDetector()
+            # 人検知開始（会話中は一時停止していたものを再開）
             person_detected = detector.wait_for_person()
             
             if person_detected:
-                # standby.py を起動
-                standby_success = launch_standby()
+                # 常駐ワーカーで会話を開始（複数カメラならどのカメラで検知したかも渡す）
+                camera = person_detected.name if isinstance(person_detected, DetectionEvent) else None
+                standby_success = run_conversation(conversation, camera=camera)
                 
                 if standby_success:
                     print("✅ 会話セッション完了")
@@ -205,6 +916,9 @@ def main():
             print(f"❌ システムエラー: {e}")
             print("⏳ 5秒後に再試行...")
             time.sleep(5)
+    
+    conversation.stop()
+    detector.cleanup()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+detection_bench.py - 人検知の精度・速度ベンチマーク
+
+録画した動画またはフレーム画像のディレクトリに対して
+PersonDetector.detect_person と連続検知の確定判定（ConfirmationBuffer）を
+実行し、検出器・パラメータの組み合わせごとに fps、確定までの時間、
+誤検知率・見逃し率を報告する。
+
+実機は録画のフレームレートではなく検知スケジューラの間隔（既定は
+動きがある時 10fps）でフレームを処理し、確定判定のフレーム数や背景の
+更新速度もその間隔が前提なので、--detect-fps に合わせてフレームを
+間引いてから評価する。
+
+ラベル形式（人が映っている区間、秒）:
+    video.mp4  → video.json    [[開始秒, 終了秒], ...]
+    frames/    → frames/labels.json（フレーム番号は --fps で秒に換算）
+
+例:
+    python detection_bench.py data/hallway.mp4 --backends haar hog
+    python detection_bench.py data/frames/ --fps 10 --buffer-sizes 3 5 --required 2 3 --json report.json
+    python detection_bench.py data/hallway.mp4 --detect-fps 2   # 待機中（idle）の間隔で評価
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+
+import cv2
+
+from detection import ConfirmationBuffer, FrameScheduler, PersonDetector
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def load_labels(source):
+    """人が映っている区間（秒）のリストを読み込み"""
+    if os.path.isdir(source):
+        path = os.path.join(source, "labels.json")
+    else:
+        path = os.path.splitext(source)[0] + ".json"
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{source} のラベル（{path}）が見つかりません")
+    with open(path, encoding="utf-8") as f:
+        return [(float(start), float(end)) for start, end in json.load(f)]
+
+
+class FrameSampler:
+    """録画の時刻から、検知間隔（detect_fps）ごとに処理するフレームを選ぶ"""
+
+    def __init__(self, detect_fps=None):
+        self.interval = 1.0 / detect_fps if detect_fps else 0.0
+        self.next_time = 0.0
+
+    def keep(self, t):
+        # 浮動小数の誤差で1フレーム分ずれないよう少し余裕を持たせる
+        if t + 1e-6 < self.next_time:
+            return False
+        self.next_time = max(self.next_time + self.interval, t)
+        return True
+
+
+def iter_frames(source, fps, detect_fps=None):
+    """(時刻秒, フレーム) を順に返す（detect_fps があればその間隔に間引き、間引いたフレームはデコードしない）"""
+    sampler = FrameSampler(detect_fps)
+    if os.path.isdir(source):
+        names = sorted(n for n in os.listdir(source) if n.lower().endswith(IMAGE_EXTENSIONS))
+        for i, name in enumerate(names):
+            if not sampler.keep(i / fps):
+                continue
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is not None:
+                yield i / fps, frame
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError(f"動画を開けません: {source}")
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or fps
+    index = 0
+    try:
+        while capture.grab():
+            t = index / video_fps
+            index += 1
+            if not sampler.keep(t):
+                continue
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+            # カメラと同じ 640x480 にそろえる
+            if frame.shape[1] != 640 or frame.shape[0] != 480:
+                frame = cv2.resize(frame, (640, 480), interpolation=cv2.INTER_AREA)
+            yield t, frame
+    finally:
+        capture.release()
+
+
+def is_labelled(t, segments):
+    return any(start <= t < end for start, end in segments)
+
+
+def run_setting(frames, segments, backend, buffer_size, required, min_score):
+    """1つの設定で全フレームを評価"""
+    options = {"min_score": min_score} if backend == "haar" and min_score is not None else {}
+    detector = PersonDetector(backend=backend, backend_options=options)
+    confirmation = ConfirmationBuffer(buffer_size, required)
+
+    tp = fp = fn = tn = 0
+    confirmations = []
+    elapsed = 0.0
+    for t, frame in frames:
+        started = time.perf_counter()
+        detected = detector.detect_person(frame, now=t)
+        elapsed += time.perf_counter() - started
+
+        truth = is_labelled(t, segments)
+        if detected and truth:
+            tp += 1
+        elif detected:
+            fp += 1
+        elif truth:
+            fn += 1
+        else:
+            tn += 1
+
+        # 実機と同じく確定したら判定をやり直す（会話後の再開に相当）
+        if confirmation.add(detected):
+            confirmations.append(t)
+            confirmation.reset()
+
+    # 区間ごとの最初の確定までの時間と、人がいない時の確定（誤起動）
+    delays = []
+    missed = 0
+    for start, end in segments:
+        hits = [t for t in confirmations if start <= t < end]
+        if hits:
+            delays.append(hits[0] - start)
+        else:
+            missed += 1
+    false_confirmations = sum(1 for t in confirmations if not is_labelled(t, segments))
+
+    delays.sort()
+    n_frames = tp + fp + fn + tn
+    return {
+        "backend": detector.backend.name,
+        "buffer_size": buffer_size,
+        "required_detections": required,
+        "min_score": min_score,
+        "frames": n_frames,
+        "fps": round(n_frames / max(elapsed, 1e-9), 1),
+        "false_positive_rate": round(fp / max(1, fp + tn), 4),
+        "false_negative_rate": round(fn / max(1, fn + tp), 4),
+        "people": len(segments),
+        "missed_people": missed,
+        "false_confirmations": false_confirmations,
+        "median_time_to_confirm": round(delays[len(delays) // 2], 2) if delays else None,
+        "stages_ms": {
+            name: round(total / count * 1000, 2) for name, (count, total) in detector.stage_stats.items()
+        },
+    }
+
+
+def print_report(reports):
+    header = (f"{'backend':<8}{'buf':>4}{'req':>4}{'score':>6}{'fps':>8}{'FP率':>8}{'FN率':>8}"
+              f"{'見逃し':>7}{'誤起動':>7}{'確定(秒)':>9}")
+    for report in reports:
+        print(f"\n📄 {report['source']}（検知 {report['detect_fps'] or '全'}fps で {report['frames']}フレーム, "
+              f"人物 {report['people']}回）")
+        print(header)
+        for r in report["results"]:
+            score = "-" if r["min_score"] is None else r["min_score"]
+            confirm = "-" if r["median_time_to_confirm"] is None else f"{r['median_time_to_confirm']:.2f}"
+            print(f"{r['backend']:<8}{r['buffer_size']:>4}{r['required_detections']:>4}{score:>6}{r['fps']:>8}"
+                  f"{r['false_positive_rate']:>8.3f}{r['false_negative_rate']:>8.3f}"
+                  f"{r['missed_people']:>7}{r['false_confirmations']:>7}{confirm:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="人検知 精度・速度ベンチマーク")
+    parser.add_argument("sources", nargs="+", help="動画ファイルまたはフレーム画像のディレクトリ")
+    parser.add_argument("--backends", nargs="+", default=["haar"], help="評価する検出器（haar / hog / dnn）")
+    parser.add_argument("--buffer-sizes", nargs="+", type=int, default=[5], help="確定判定のフレーム数")
+    parser.add_argument("--required", nargs="+", type=int, default=[3], help="確定に必要な検知フレーム数")
+    parser.add_argument("--min-scores", nargs="+", type=float, default=[None],
+                        help="haarの信頼度しきい値（顔×2＋体）")
+    parser.add_argument("--fps", type=float, default=10.0, help="フレームディレクトリのフレームレート")
+    parser.add_argument("--detect-fps", type=float, default=FrameScheduler.DEFAULT_PROFILE["active_fps"],
+                        help="検知のフレームレート（既定は検知スケジューラの動きがある時の値、0で間引かない）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    reports = []
+    for source in args.sources:
+        segments = load_labels(source)
+        results = []
+        for backend, buffer_size, required, min_score in itertools.product(
+            args.backends, args.buffer_sizes, args.required, args.min_scores
+        ):
+            if required > buffer_size:
+                continue
+            # 長い録画でもメモリに載せないよう設定ごとに読み直す
+            frames = iter_frames(source, args.fps, args.detect_fps)
+            results.append(run_setting(frames, segments, backend, buffer_size, required, min_score))
+        reports.append({
+            "source": source,
+            "detect_fps": args.detect_fps,
+            "frames": results[0]["frames"] if results else 0,
+            "people": len(segments),
+            "results": results,
+        })
+
+    print_report(reports)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果を保存しました: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+detector_backends.py - 人検知の検出器バックエンド
+
+PersonDetector から差し替えて使える検出器をまとめたモジュール。
+どのバックエンドも detect() で DetectionResult（検知の有無・信頼度・
+処理時間）を返すので、設置先のハードウェアに合わせて精度とCPU負荷の
+バランスが良いものを選べる。
+
+    haar : 顔・人体のHaarカスケード（従来の方式）
+    hog  : OpenCV組み込みのHOG人物検出器
+    dnn  : ローカルファイルから読み込む小型DNN（MobileNet-SSD など）
+"""
+
+import os
+import time
+
+import cv2
+
+
+class DetectionResult:
+    """1フレーム分の検出結果"""
+
+    def __init__(self, found, confidence, boxes=(), cost_ms=0.0, stages=None, summary=""):
+        self.found = found
+        self.confidence = confidence
+        self.boxes = list(boxes)
+        # 検出にかかった時間と、その内訳（段階名 → 秒）
+        self.cost_ms = cost_ms
+        self.stages = stages or {}
+        self.summary = summary
+
+
+class DetectorBackend:
+    """検出器の共通インターフェース
+
+    detect() には縮小・切り出し済みのグレースケール画像（needs_color が
+    True ならカラー画像も）を渡す。scale は元の 640x480 に対する縮小率で、
+    最小・最大サイズの調整に使う。
+    """
+
+    name = "base"
+    needs_color = False
+
+    def __init__(self, scale=1.0):
+        self.scale = scale
+        self.calls = 0
+        self.total_seconds = 0.0
+
+    def _scaled(self, size):
+        return tuple(max(1, int(v * self.scale)) for v in size)
+
+    def detect(self, gray, color=None):
+        started = time.perf_counter()
+        result = self._detect(gray, color)
+        elapsed = time.perf_counter() - started
+        result.cost_ms = elapsed * 1000
+        self.calls += 1
+        self.total_seconds += elapsed
+        return result
+
+    def _detect(self, gray, color):
+        raise NotImplementedError
+
+    @property
+    def average_cost_ms(self):
+        return self.total_seconds / self.calls * 1000 if self.calls else 0.0
+
+
+class HaarBackend(DetectorBackend):
+    """顔・人体のHaarカスケード（顔が見つかれば人体検知は省略）"""
+
+    name = "haar"
+
+    def __init__(self, scale=1.0, face_weight=2, body_weight=1, min_score=2):
+        super().__init__(scale)
+        self.face_weight = face_weight
+        self.body_weight = body_weight
+        self.min_score = min_score
+        self.face_cascade = cv2.CascadeClassifier(
+            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        )
+        self.body_cascade = cv2.CascadeClassifier(
+            cv2.data.haarcascades + 'haarcascade_fullbody.xml'
+        )
+
+    def _detect(self, gray, color):
+        stages = {}
+
+        # 顔検知（厳しい条件）
+        started = time.perf_counter()
+        faces = self.face_cascade.detectMultiScale(
+            gray,
+            scaleFactor=1.2,
+            minNeighbors=8,
+            minSize=self._scaled((60, 60)),
+            maxSize=self._scaled((300, 300)),
+            flags=cv2.CASCADE_SCALE_IMAGE
+        )
+        stages["face"] = time.perf_counter() - started
+
+        bodies = ()
+        # 顔だけで信頼度が足りる場合は人体検知を省略
+        if len(faces) * self.face_weight < self.min_score:
+            # 人体検知（厳しい条件）
+            started = time.perf_counter()
+            bodies = self.body_cascade.detectMultiScale(
+                gray,
+                scaleFactor=1.3,
+                minNeighbors=6,
+                minSize=self._scaled((80, 120)),
+                maxSize=self._scaled((400, 600)),
+                flags=cv2.CASCADE_SCALE_IMAGE
+            )
+            stages["body"] = time.perf_counter() - started
+
+        score = len(faces) * self.face_weight + len(bodies) * self.body_weight
+        return DetectionResult(
+            found=score >= self.min_score,
+            confidence=float(score),
+            boxes=list(faces) + list(bodies),
+            stages=stages,
+            summary=f"顔={len(faces)}, 体={len(bodies)}",
+        )
+
+
+class HogBackend(DetectorBackend):
+    """OpenCV組み込みのHOG人物検出器（全身・立ち姿向け）"""
+
+    name = "hog"
+    # HOG検出器の窓サイズ（これより小さい画像は検出できない）
+    WINDOW = (64, 128)
+
+    def __init__(self, scale=1.0, min_weight=0.5, win_stride=(8, 8)):
+        super().__init__(scale)
+        self.min_weight = min_weight
+        self.win_stride = win_stride
+        self.hog = cv2.HOGDescriptor()
+        self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+
+    def _detect(self, gray, color):
+        h, w = gray.shape[:2]
+        if w < self.WINDOW[0] or h < self.WINDOW[1]:
+            return DetectionResult(False, 0.0, summary="領域が小さすぎます")
+
+        boxes, weights = self.hog.detectMultiScale(
+            gray, winStride=self.win_stride, padding=(8, 8), scale=1.05
+        )
+        confidence = float(max(weights.ravel())) if len(weights) else 0.0
+        return DetectionResult(
+            found=confidence >= self.min_weight,
+            confidence=confidence,
+            boxes=boxes,
+            summary=f"人物={len(boxes)}, 重み={confidence:.2f}",
+        )
+
+
+class DnnBackend(DetectorBackend):
+    """ローカルのDNNモデル（SSD形式の出力）による人物検出
+
+    既定値は MobileNet-SSD（Caffe、VOCの person = 15）向け。
+    """
+
+    name = "dnn"
+    needs_color = True
+
+    def __init__(self, scale=1.0, model=None, config=None, input_size=(300, 300),
+                 person_class=15, min_confidence=0.5, mean=127.5, scale_factor=0.007843):
+        super().__init__(scale)
+        model = model or os.environ.get("CARETALKER_DNN_MODEL", "")
+        config = config or os.environ.get("CARETALKER_DNN_CONFIG", "")
+        if not model or not os.path.exists(model):
+            raise FileNotFoundError(f"DNNモデルが見つかりません: {model or '(未設定)'}")
+
+        self.net = cv2.dnn.readNet(model, config) if config else cv2.dnn.readNet(model)
+        self.input_size = input_size
+        self.person_class = person_class
+        self.min_confidence = min_confidence
+        self.mean = mean
+        self.scale_factor = scale_factor
+
+    def _detect(self, gray, color):
+        image = color if color is not None else cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        blob = cv2.dnn.blobFromImage(
+            image, self.scale_factor, self.input_size, (self.mean, self.mean, self.mean)
+        )
+        self.net.setInput(blob)
+        detections = self.net.forward().reshape(-1, 7)
+
+        # 各行: [画像番号, クラス, 信頼度, x1, y1, x2, y2]（座標は0〜1）
+        people = detections[detections[:, 1] == self.person_class]
+        confidence = float(people[:, 2].max()) if len(people) else 0.0
+        h, w = image.shape[:2]
+        boxes = [
+            (int(x1 * w), int(y1 * h), int((x2 - x1) * w), int((y2 - y1) * h))
+            for _, _, score, x1, y1, x2, y2 in people if score >= self.min_confidence
+        ]
+        return DetectionResult(
+            found=confidence >= self.min_confidence,
+            confidence=confidence,
+            boxes=boxes,
+            summary=f"人物={len(boxes)}, 信頼度={confidence:.2f}",
+        )
+
+
+BACKENDS = {
+    "haar": HaarBackend,
+    "hog": HogBackend,
+    "dnn": DnnBackend,
+}
+
+
+def create_backend(name, scale=1.0, **options):
+    """名前からバックエンドを作成（不明な名前は ValueError）"""
+    if name not in BACKENDS:
+        raise ValueError(f"不明な検出器です: {name}（{', '.join(BACKENDS)}）")
+    return BACKENDS[name](scale=scale, **options)
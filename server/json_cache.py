@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+json_cache.py
+JSONファイルの読み込みキャッシュ
+
+ファイルのパスと (更新時刻, サイズ) をキーに、解析済みのデータを
+プロセス内で保持する。変更されていないファイルは読み直さない。
+同じプロセスでファイルを書き換えた場合は invalidate() を呼ぶ。
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+_cache: Dict[str, Tuple[int, int, Any]] = {}
+_lock = threading.Lock()
+
+
+def load_json(path: str) -> Any:
+    """
+    JSONファイルを読み込み（変更がなければキャッシュを返す）
+
+    返したデータはキャッシュと共有しているため、呼び出し側で変更しないこと。
+
+    Args:
+        path: JSONファイルのパス
+
+    Returns:
+        Any: 解析済みのJSONデータ
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    with open(key, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    with _lock:
+        _cache[key] = (stat.st_mtime_ns, stat.st_size, data)
+    return data
+
+
+def invalidate(path: Optional[str] = None) -> None:
+    """
+    キャッシュを破棄
+
+    Args:
+        path: 破棄するファイルのパス（省略時はすべて）
+    """
+    with _lock:
+        if path is None:
+            _cache.clear()
+        else:
+            _cache.pop(os.path.abspath(path), None)
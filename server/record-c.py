@@ -6,12 +6,14 @@ RAG用文書生成システム
 C:\CARE_TALKER\caretalker_jikkisyori\data\内のJSONファイルを統合してテキスト化
 """
 
-import json
+import hashlib
 import os
 import glob
 from typing import Dict, List, Any
 from datetime import datetime
 
+from json_cache import load_json
+
 class RecordCompiler:
     def __init__(self, data_dir: str = None):
         """
@@ -32,6 +34,7 @@ class RecordCompiler:
     def load_json_files(self) -> Dict[str, Any]:
         """
         dataディレクトリ内のすべてのJSONファイルを読み込み
+        （変更のないファイルはキャッシュから取得し、読み直さない）
         
         Returns:
             Dict[str, Any]: ファイル名をキーとした辞書
@@ -47,10 +50,8 @@ class RecordCompiler:
         for file_path in json_files:
             filename = os.path.basename(file_path)
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    json_data[filename] = data
-                    print(f"読み込み成功: {filename}")
+                json_data[filename] = load_json(file_path)
+                print(f"読み込み成功: {filename}")
             except Exception as e:
                 print(f"読み込みエラー: {filename} - {e}")
         
@@ -72,11 +73,6 @@ class RecordCompiler:
         name = user_data.get('name-f', '不明')
         age = user_data.get('age', '不明')
         text_parts.append(f"患者名: {name}さん（{age}歳）")
-        
-        # session_idを生成（名前と年齢から一意のセッションIDを作成）
-        import hashlib
-        session_string = f"{name}_{age}_{datetime.now().strftime('%Y%m%d')}"
-        session_id = hashlib.md5(session_string.encode('utf-8')).hexdigest()[:16]
         # session_idはヘッダーに表示するので、ここでは追加しない
         
         # その他の情報があれば追加
@@ -139,6 +135,21 @@ class RecordCompiler:
         
         return " / ".join(text_parts)
     
+    def generate_session_id(self, user_data: Dict[str, Any]) -> str:
+        """
+        名前・年齢・日付から一意のsession_idを生成
+        
+        Args:
+            user_data: user_profile.jsonの内容
+            
+        Returns:
+            str: 16桁のsession_id
+        """
+        name = user_data.get('name-f', '不明')
+        age = user_data.get('age', '不明')
+        session_string = f"{name}_{age}_{datetime.now().strftime('%Y%m%d')}"
+        return hashlib.md5(session_string.encode('utf-8')).hexdigest()[:16]
+    
     def extract_session_id_from_rag_text(self, rag_text: str) -> str:
         """
         RAGテキストからsession_idを抽出
@@ -167,12 +178,11 @@ class RecordCompiler:
         Returns:
             Dict[str, str]: session_id, name, age を含む辞書
         """
-        rag_text = self.generate_rag_text()
-        session_id = self.extract_session_id_from_rag_text(rag_text)
-        
-        # ユーザープロファイルから名前と年齢を取得
+        # RAGテキストは作らず、ユーザープロファイルから直接求める
         json_data = self.load_json_files()
-        user_profile = json_data.get('user_profile.json', {})
+        user_profile = json_data.get('user_profile.json')
+        session_id = self.generate_session_id(user_profile) if user_profile is not None else ""
+        user_profile = user_profile or {}
         
         return {
             'session_id': session_id,
@@ -233,11 +243,7 @@ class RecordCompiler:
         for filename, data in json_data.items():
             if filename == 'user_profile.json':
                 # ユーザープロファイルからsession_idを直接生成
-                name = data.get('name-f', '不明')
-                age = data.get('age', '不明')
-                import hashlib
-                session_string = f"{name}_{age}_{datetime.now().strftime('%Y%m%d')}"
-                session_id = hashlib.md5(session_string.encode('utf-8')).hexdigest()[:16]
+                session_id = self.generate_session_id(data)
                 
                 section = self.compile_user_profile(data)
                 text_sections.append(f"【ユーザー情報】{section}")
@@ -8,6 +8,8 @@ from datetime import datetime
 import requests
 import json
 
+from json_cache import invalidate
+
 def get_user_id():
     """serial.pyでハッシュ化されたユーザーID取得"""
     try:
@@ -81,6 +83,8 @@ def save_json(data, filename):
         print("削除後にファイル存在:", os.path.exists(file_path))
         with open(file_path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        # 同じプロセスで読み込み済みのデータを破棄（RAG用テキストの作成時に読み直す）
+        invalidate(file_path)
         print(f"💾 {filename} 保存完了（生データ）")
     except Exception as e:
         print(f"❌ {filename} 保存エラー: {e}")
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+stt_loadtest.py - stt_ws_server の /ws 負荷試験ツール
+
+WAVファイルを実機と同じ1024バイトのLINEAR16チャンクで実時間ペースで送信し、
+発話終了から認識結果受信までの時間・エラー率・イベントループ遅延を計測して
+JSONに出力する。
+
+例:
+    # オフライン（フェイクSTTエンジンのサーバーを起動して試験）
+    python stt_loadtest.py --spawn-fake-server -n 20 --wav sample.wav -o result.json
+
+    # 起動済みのサーバーに対して試験
+    python stt_loadtest.py --url ws://localhost:8080/ws -n 50 --wav a.wav b.wav
+
+    # Opus圧縮での帯域を計測（opuslib が必要）
+    python stt_loadtest.py --spawn-fake-server -n 20 --wav sample.wav --encoding opus
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+import wave
+
+import websockets
+
+SAMPLE_RATE = 16000
+CHUNK_BYTES = 1024  # 実機と同じチャンクサイズ（512サンプル = 32ms）
+CHUNK_SECONDS = CHUNK_BYTES / 2 / SAMPLE_RATE
+OPUS_FRAME_SECONDS = 0.02
+FLAC_SEGMENT_SECONDS = 0.256
+
+
+def load_wav(path):
+    """16kHz・モノラル・16bitのWAVをPCMバイト列として読み込み"""
+    with wave.open(path, "rb") as wf:
+        if wf.getframerate() != SAMPLE_RATE or wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+            raise ValueError(f"{path}: 16kHz/モノラル/16bitのWAVが必要です")
+        return wf.readframes(wf.getnframes())
+
+
+def split_chunks(pcm):
+    """PCMを送信チャンクに分割（最後のチャンクは無音で埋める）"""
+    chunks = []
+    for i in range(0, len(pcm), CHUNK_BYTES):
+        chunk = pcm[i:i + CHUNK_BYTES]
+        if len(chunk) < CHUNK_BYTES:
+            chunk += b"\x00" * (CHUNK_BYTES - len(chunk))
+        chunks.append(chunk)
+    return chunks
+
+
+def encode_chunks(pcm, encoding, opus_bitrate=24000):
+    """PCMを指定エンコーディングの送信メッセージ列に変換
+
+    Returns:
+        (メッセージのリスト, 1メッセージあたりの秒数)
+    """
+    if encoding == "linear16":
+        return split_chunks(pcm), CHUNK_SECONDS
+
+    if encoding == "opus":
+        import opuslib
+
+        encoder = opuslib.Encoder(SAMPLE_RATE, 1, opuslib.APPLICATION_VOIP)
+        encoder.bitrate = opus_bitrate
+        frame_samples = int(SAMPLE_RATE * OPUS_FRAME_SECONDS)
+        frame_bytes = frame_samples * 2
+        frames = []
+        for i in range(0, len(pcm), frame_bytes):
+            frame = pcm[i:i + frame_bytes].ljust(frame_bytes, b"\x00")
+            frames.append(encoder.encode(frame, frame_samples))
+        return frames, OPUS_FRAME_SECONDS
+
+    if encoding == "flac":
+        import io
+        import numpy as np
+        import soundfile as sf
+
+        segment_bytes = int(SAMPLE_RATE * FLAC_SEGMENT_SECONDS) * 2
+        segments = []
+        for i in range(0, len(pcm), segment_bytes):
+            samples = np.frombuffer(pcm[i:i + segment_bytes].ljust(segment_bytes, b"\x00"), dtype=np.int16)
+            buffer = io.BytesIO()
+            sf.write(buffer, samples, SAMPLE_RATE, format="FLAC", subtype="PCM_16")
+            segments.append(buffer.getvalue())
+        return segments, FLAC_SEGMENT_SECONDS
+
+    raise ValueError(f"非対応のエンコーディング: {encoding}")
+
+
+def percentile(values, pct):
+    """パーセンタイル（最近傍法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values, scale=1000.0):
+    """秒のリストをミリ秒の統計値に変換"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "avg_ms": round(sum(values) / len(values) * scale, 1),
+        "p50_ms": round(percentile(values, 50) * scale, 1),
+        "p90_ms": round(percentile(values, 90) * scale, 1),
+        "p99_ms": round(percentile(values, 99) * scale, 1),
+        "max_ms": round(max(values) * scale, 1),
+    }
+
+
+class LoopLagProbe:
+    """負荷生成側のイベントループ遅延を計測"""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+
+class SpeakerConnection:
+    """1話者分のWebSocket接続"""
+
+    def __init__(self, index, url, utterances, repeat, tail_seconds, speed,
+                 chunk_seconds=CHUNK_SECONDS, silence=b"\x00" * CHUNK_BYTES):
+        self.index = index
+        self.url = url
+        self.utterances = utterances
+        self.chunk_seconds = chunk_seconds
+        self.silence = silence
+        self.repeat = repeat
+        self.tail_seconds = tail_seconds
+        self.speed = speed
+
+        self.latencies = []
+        self.transcripts = 0
+        self.missed = 0
+        self.error_messages = []
+        self.connect_error = None
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+
+        self._utterance_end = None
+        self._transcript_event = asyncio.Event()
+
+    async def run(self):
+        try:
+            async with websockets.connect(self.url, max_size=None) as ws:
+                receiver = asyncio.create_task(self._receive(ws))
+                try:
+                    await self._send(ws)
+                finally:
+                    receiver.cancel()
+        except Exception as e:
+            if not self.chunks_sent:
+                self.connect_error = f"{type(e).__name__}: {e}"
+            else:
+                self.error_messages.append(f"{type(e).__name__}: {e}")
+
+    async def _send_paced(self, ws, chunks, start):
+        """開始時刻からの絶対スケジュールで送信（ドリフト防止）"""
+        interval = self.chunk_seconds / self.speed
+        for i, chunk in enumerate(chunks):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await ws.send(chunk)
+            self.bytes_sent += len(chunk)
+            self.chunks_sent += 1
+
+    async def _send(self, ws):
+        silence = self.silence
+        interval = self.chunk_seconds / self.speed
+        for _ in range(self.repeat):
+            for chunks in self.utterances:
+                self._transcript_event.clear()
+                self._utterance_end = None
+                await self._send_paced(ws, chunks, time.perf_counter())
+                self._utterance_end = time.perf_counter()
+
+                # 実機と同様に無音を送り続けながら認識結果を待つ
+                tail_chunks = int(self.tail_seconds / self.chunk_seconds)
+                start = time.perf_counter()
+                for i in range(tail_chunks):
+                    if self._transcript_event.is_set():
+                        break
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await ws.send(silence)
+                    self.bytes_sent += len(silence)
+                    self.chunks_sent += 1
+                else:
+                    if not self._transcript_event.is_set():
+                        self.missed += 1
+
+    async def _receive(self, ws):
+        async for message in ws:
+            if isinstance(message, bytes):
+                continue
+            if message.startswith("[セッション]"):
+                continue
+            if message.startswith("[システム]") or message.startswith("[認識エラー]"):
+                self.error_messages.append(message)
+                continue
+
+            self.transcripts += 1
+            if self._utterance_end is not None and not self._transcript_event.is_set():
+                self.latencies.append(time.perf_counter() - self._utterance_end)
+                self._transcript_event.set()
+
+
+def fetch_health(ws_url):
+    """サーバーの /health を取得（イベントループ遅延など）"""
+    http_url = ws_url.replace("wss://", "https://").replace("ws://", "http://")
+    http_url = http_url.rsplit("/ws", 1)[0] + "/health"
+    try:
+        with urllib.request.urlopen(http_url, timeout=5) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def spawn_fake_server(port, latency):
+    """フェイクSTTエンジンでstt_ws_serverを起動"""
+    env = dict(os.environ, STT_ENGINE="fake", STT_FAKE_LATENCY=str(latency), PORT=str(port))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "stt_ws_server:app",
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+
+    health_url = f"http://127.0.0.1:{port}/health"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("フェイクサーバーの起動に失敗しました")
+        try:
+            urllib.request.urlopen(health_url, timeout=1).close()
+            return process
+        except Exception:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError("フェイクサーバーが起動しませんでした")
+
+
+async def run_load_test(args, utterances, chunk_seconds, silence):
+    probe = LoopLagProbe()
+    probe_task = asyncio.create_task(probe.run())
+
+    url = args.url
+    if args.encoding != "linear16":
+        url += ("&" if "?" in url else "?") + f"encoding={args.encoding}"
+
+    speakers = [
+        SpeakerConnection(i, url, utterances, args.repeat, args.tail_seconds, args.speed,
+                          chunk_seconds=chunk_seconds, silence=silence)
+        for i in range(args.connections)
+    ]
+
+    async def start_speaker(speaker):
+        # 接続を段階的に開始（一斉接続による偏りを避ける）
+        if args.ramp_seconds > 0:
+            await asyncio.sleep(args.ramp_seconds * speaker.index / max(1, args.connections))
+        await speaker.run()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(start_speaker(s) for s in speakers))
+    wall_time = time.perf_counter() - started
+
+    probe_task.cancel()
+    server_health = await asyncio.get_running_loop().run_in_executor(None, fetch_health, args.url)
+
+    latencies = [lat for s in speakers for lat in s.latencies]
+    utterance_count = args.repeat * len(utterances) * args.connections
+    connect_errors = [s.connect_error for s in speakers if s.connect_error]
+    error_messages = [m for s in speakers for m in s.error_messages]
+    bytes_sent = sum(s.bytes_sent for s in speakers)
+
+    return {
+        "config": {
+            "url": args.url,
+            "connections": args.connections,
+            "encoding": args.encoding,
+            "wav_files": args.wav,
+            "repeat": args.repeat,
+            "speed": args.speed,
+            "tail_seconds": args.tail_seconds,
+            "ramp_seconds": args.ramp_seconds,
+        },
+        "wall_time_s": round(wall_time, 2),
+        "utterances": utterance_count,
+        "transcripts": sum(s.transcripts for s in speakers),
+        "missed_utterances": sum(s.missed for s in speakers),
+        "connect_errors": len(connect_errors),
+        "error_messages": len(error_messages),
+        "error_rate": round(
+            (sum(s.missed for s in speakers) + len(connect_errors)) / max(1, utterance_count), 4
+        ),
+        "end_of_utterance_to_transcript": summarize(latencies),
+        "client_loop_lag": summarize(probe.samples),
+        "bytes_sent": bytes_sent,
+        "kbps_per_connection": round(
+            bytes_sent * 8 / 1000 / max(wall_time, 1e-6) / max(1, args.connections), 1
+        ),
+        "server_health": server_health,
+        "errors_sample": (connect_errors + error_messages)[:20],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stt_ws_server /ws 負荷試験")
+    parser.add_argument("--url", default="ws://127.0.0.1:8080/ws", help="WebSocket URL")
+    parser.add_argument("-n", "--connections", type=int, default=10, help="同時接続数")
+    parser.add_argument("--wav", nargs="+", required=True, help="送信するWAVファイル（16kHz/モノラル/16bit）")
+    parser.add_argument("--repeat", type=int, default=1, help="各接続でWAVを繰り返す回数")
+    parser.add_argument("--speed", type=float, default=1.0, help="送信速度（1.0 = 実時間）")
+    parser.add_argument("--tail-seconds", type=float, default=8.0, help="発話後に無音を送りながら結果を待つ秒数")
+    parser.add_argument("--ramp-seconds", type=float, default=2.0, help="全接続を開始し終えるまでの秒数")
+    parser.add_argument("--encoding", choices=["linear16", "opus", "flac"], default="linear16",
+                        help="送信する音声エンコーディング")
+    parser.add_argument("--opus-bitrate", type=int, default=24000, help="Opusのビットレート（bps）")
+    parser.add_argument("-o", "--output", default="loadtest_result.json", help="結果JSONの出力先")
+    parser.add_argument("--spawn-fake-server", action="store_true", help="フェイクSTTエンジンのサーバーを起動して試験")
+    parser.add_argument("--fake-port", type=int, default=8765, help="フェイクサーバーのポート")
+    parser.add_argument("--fake-latency", type=float, default=0.3, help="フェイクSTTの応答遅延（秒）")
+    args = parser.parse_args()
+
+    utterances = []
+    for path in args.wav:
+        chunks, chunk_seconds = encode_chunks(load_wav(path), args.encoding, args.opus_bitrate)
+        utterances.append(chunks)
+    silence_pcm = b"\x00" * int(SAMPLE_RATE * chunk_seconds) * 2
+    silence = encode_chunks(silence_pcm, args.encoding, args.opus_bitrate)[0][0]
+
+    server = None
+    if args.spawn_fake_server:
+        server = spawn_fake_server(args.fake_port, args.fake_latency)
+        args.url = f"ws://127.0.0.1:{args.fake_port}/ws"
+
+    try:
+        print(f"🚀 負荷試験開始: {args.connections}接続 → {args.url}")
+        result = asyncio.run(run_load_test(args, utterances, chunk_seconds, silence))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    latency = result["end_of_utterance_to_transcript"]
+    print(f"✅ 完了: 発話 {result['utterances']}件, 認識 {result['transcripts']}件, "
+          f"取りこぼし {result['missed_utterances']}件, 接続エラー {result['connect_errors']}件")
+    if latency.get("count"):
+        print(f"⏱️ 発話終了→認識結果: p50={latency['p50_ms']}ms p90={latency['p90_ms']}ms max={latency['max_ms']}ms")
+    print(f"💾 結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
 from google.cloud import speech
 import google.oauth2.service_account
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+import array
 import asyncio
+import io
+import json
 import os
+import secrets
+import signal
+import socket
+import tempfile
 import time
 import logging
 
@@ -15,16 +25,444 @@ app = FastAPI(title="STT WebSocket Server for Cloud Run")
 # Cloud Run環境変数からポート取得
 PORT = int(os.environ.get("PORT", 8080))
 
+# STTエンジン選択（"fake" は負荷試験用のオフラインエンジン）
+STT_ENGINE = os.environ.get("STT_ENGINE", "google")
+
 # Google Cloud認証設定
 SERVICE_ACCOUNT_FILE = os.path.join(os.path.dirname(__file__), 'firebase-key.json')
 
-# firebase-key.jsonの存在確認
-if not os.path.exists(SERVICE_ACCOUNT_FILE):
+class FakeSpeechClient:
+    """負荷試験用のオフラインSTTエンジン（SpeechClient.recognizeと同じ形で応答）"""
+
+    def __init__(self, latency=0.3, transcript="テスト音声です", silence_peak=500):
+        self.latency = latency
+        self.transcript = transcript
+        self.silence_peak = silence_peak
+
+    def recognize(self, config, audio):
+        # 本物のクライアントと同じくブロッキングで待つ
+        time.sleep(self.latency)
+
+        content = audio.content
+        samples = array.array('h')
+        samples.frombytes(content[:len(content) - len(content) % 2])
+        peak = max(map(abs, samples), default=0)
+
+        results = []
+        if peak >= self.silence_peak:
+            alternative = SimpleNamespace(transcript=self.transcript, confidence=1.0)
+            results.append(SimpleNamespace(alternatives=[alternative]))
+        return SimpleNamespace(results=results)
+
+if STT_ENGINE == "fake":
+    logger.warning("STT_ENGINE=fake: 負荷試験用のオフラインSTTエンジンを使用します")
+elif not os.path.exists(SERVICE_ACCOUNT_FILE):
+    # firebase-key.jsonの存在確認（起動時に失敗させる）
     logger.error(f"firebase-key.json not found at {SERVICE_ACCOUNT_FILE}")
     raise FileNotFoundError("firebase-key.json is required for Google Cloud Speech API")
 
-credentials = google.oauth2.service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-speech_client = speech.SpeechClient(credentials=credentials)
+# STTクライアントは最初の認識時に作成する
+# （gRPCのチャネルはforkをまたいで使えないため、マルチワーカーでは各ワーカーで作る）
+speech_client = None
+
+def get_speech_client():
+    """このプロセスのSTTクライアントを取得（なければ作成）"""
+    global speech_client
+    if speech_client is None:
+        if STT_ENGINE == "fake":
+            speech_client = FakeSpeechClient(
+                latency=float(os.environ.get("STT_FAKE_LATENCY", 0.3)),
+                transcript=os.environ.get("STT_FAKE_TRANSCRIPT", "テスト音声です"),
+            )
+        else:
+            credentials = google.oauth2.service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+            speech_client = speech.SpeechClient(credentials=credentials)
+    return speech_client
+
+# 圧縮音声デコーダ（任意の依存関係）
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+
+SAMPLE_RATE = 16000
+# 認識を行うバッファ量（従来の1024バイト×93チャンク ≒ 3秒分のLINEAR16）
+RECOGNITION_BATCH_BYTES = 1024 * 93
+RECOGNITION_MIN_BYTES = 1024 * 10
+# 圧縮音声1メッセージあたりの上限（デコードのCPUコストを抑える）
+MAX_COMPRESSED_MESSAGE_BYTES = 16 * 1024
+MAX_DECODED_SECONDS_PER_MESSAGE = 1.0
+
+class AudioDecodeError(Exception):
+    """クライアントから受信した圧縮音声のデコード失敗"""
+
+
+class Linear16Decoder:
+    """無圧縮LINEAR16（従来の形式）"""
+
+    name = "linear16"
+
+    def decode(self, data):
+        return data
+
+
+class OpusDecoder:
+    """1メッセージ = 1つのOpusパケット（16kHz・モノラル）"""
+
+    name = "opus"
+    # Opusの最大フレーム長は120ms
+    MAX_FRAME_SAMPLES = SAMPLE_RATE * 120 // 1000
+
+    def __init__(self):
+        self._decoder = opuslib.Decoder(SAMPLE_RATE, 1)
+
+    def decode(self, data):
+        try:
+            return self._decoder.decode(data, self.MAX_FRAME_SAMPLES)
+        except Exception as e:
+            raise AudioDecodeError(f"Opusデコード失敗: {e}")
+
+
+class FlacDecoder:
+    """1メッセージ = 単独でデコード可能なFLACセグメント（16kHz・モノラル）"""
+
+    name = "flac"
+
+    def decode(self, data):
+        try:
+            samples, sample_rate = sf.read(io.BytesIO(data), dtype='int16')
+        except Exception as e:
+            raise AudioDecodeError(f"FLACデコード失敗: {e}")
+        if sample_rate != SAMPLE_RATE or samples.ndim != 1:
+            raise AudioDecodeError(f"非対応のFLAC形式: {sample_rate}Hz, {samples.ndim}ch")
+        return samples.tobytes()
+
+
+def create_decoder(encoding):
+    """接続時に指定されたエンコーディングのデコーダを作成（非対応ならNone）"""
+    encoding = (encoding or "linear16").lower()
+    if encoding == "linear16":
+        return Linear16Decoder()
+    if encoding == "opus" and opuslib is not None:
+        return OpusDecoder()
+    if encoding == "flac" and sf is not None:
+        return FlacDecoder()
+    return None
+
+
+def supported_encodings():
+    """このサーバーで受け付け可能なエンコーディング"""
+    encodings = ["linear16"]
+    if opuslib is not None:
+        encodings.append("opus")
+    if sf is not None:
+        encodings.append("flac")
+    return encodings
+
+# セッション再開設定（5分制限・タイムアウト後の再接続で音声バッファを引き継ぐ）
+SESSION_TTL_SECONDS = float(os.environ.get("STT_SESSION_TTL", 600))
+SESSION_STORE_MAX = int(os.environ.get("STT_SESSION_STORE_MAX", 500))
+TRANSCRIPT_HISTORY_SIZE = 50
+
+class SttSession:
+    """再接続をまたいで保持する論理セッションの状態"""
+
+    def __init__(self, token):
+        self.token = token
+        self.audio_buffer = []
+        self.buffered_bytes = 0
+        # 送信済み認識結果の履歴（再接続時の再送用）
+        self.transcripts = []
+        # 論理セッション開始からの認識結果の通し番号
+        self.transcript_offset = 0
+        self.chunk_count = 0
+        self.created_at = time.time()
+        self.last_seen = time.time()
+        self.last_recognition_time = time.time()
+        # 接続の世代番号（同じトークンで再接続されたら古い接続を止める）
+        self.generation = 0
+        self.active = False
+        # 現在のターンのトレースID（ターンごとに制御メッセージで更新）
+        self.trace_id = None
+
+    def add_transcript(self, transcript):
+        """認識結果を履歴に追加"""
+        self.transcripts.append((self.transcript_offset, transcript))
+        self.transcript_offset += 1
+        if len(self.transcripts) > TRANSCRIPT_HISTORY_SIZE:
+            del self.transcripts[0]
+
+    def transcripts_since(self, offset):
+        """指定した通し番号以降の認識結果を返す"""
+        return [text for index, text in self.transcripts if index >= offset]
+
+
+class SessionStore:
+    """TTLで失効する上限付きのセッションストア"""
+
+    def __init__(self, max_sessions=SESSION_STORE_MAX, ttl=SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self):
+        """新しいセッションを作成"""
+        self._evict()
+        token = secrets.token_urlsafe(16)
+        session = SttSession(token)
+        self._sessions[token] = session
+        return session
+
+    def get(self, token):
+        """トークンに対応するセッションを取得（失効済みならNone）"""
+        self._evict()
+        session = self._sessions.get(token)
+        if session is not None:
+            self._sessions.move_to_end(token)
+        return session
+
+    def release(self, session):
+        """接続終了時に呼び出し、TTLの計測を開始"""
+        session.active = False
+        session.last_seen = time.time()
+
+    def _evict(self):
+        now = time.time()
+        expired = [
+            token for token, session in self._sessions.items()
+            if not session.active and now - session.last_seen > self.ttl
+        ]
+        for token in expired:
+            del self._sessions[token]
+
+        # 上限超過時は最も古い非アクティブなセッションから削除
+        if len(self._sessions) >= self.max_sessions:
+            for token in [t for t, s in self._sessions.items() if not s.active]:
+                del self._sessions[token]
+                if len(self._sessions) < self.max_sessions:
+                    break
+
+
+session_store = SessionStore()
+
+class LoopLagMonitor:
+    """イベントループの遅延を定期的に計測"""
+
+    def __init__(self, interval=0.5, window=120):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def snapshot(self):
+        """直近の遅延（ミリ秒）を返す"""
+        if not self.samples:
+            return {"avg_ms": 0.0, "max_ms": 0.0}
+        return {
+            "avg_ms": round(sum(self.samples) / len(self.samples) * 1000, 2),
+            "max_ms": round(max(self.samples) * 1000, 2),
+        }
+
+
+loop_lag_monitor = LoopLagMonitor()
+
+# ターンごとのトレース（デバイス・STT・LLM・TTSの所要時間）
+# 複数ワーカー（STT_WORKERS）で同じ集計を返すよう、JSONLファイルに追記して共有する
+TRACE_STORE_MAX = int(os.environ.get("STT_TRACE_STORE_MAX", 2000))
+TRACE_FILE = os.environ.get("STT_TRACE_FILE", os.path.join(tempfile.gettempdir(), "stt_traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(float(os.environ.get("STT_TRACE_FILE_MAX_MB", 20)) * 1024 * 1024)
+
+class TraceStore:
+    """トレースを共有のJSONLファイルに追記し、直近分のスパンごとの所要時間を集計"""
+
+    # 1トレースあたりの行の長さの目安（末尾から読む範囲の見積もり用）
+    LINE_BYTES_ESTIMATE = 512
+
+    def __init__(self, path=TRACE_FILE, max_traces=TRACE_STORE_MAX, max_bytes=TRACE_FILE_MAX_BYTES):
+        self.path = path
+        self.max_traces = max_traces
+        self.max_bytes = max_bytes
+
+    def add(self, trace_id, spans, source="device", error=None):
+        """1件追記（O_APPEND の1回の書き込みで、他のワーカーの行と混ざらない）"""
+        line = json.dumps({
+            "trace_id": trace_id,
+            "source": source,
+            "timestamp": time.time(),
+            "spans": spans,
+            "error": error,
+            "pid": os.getpid(),
+        }, ensure_ascii=False) + "\n"
+        try:
+            self._rotate_if_needed()
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.warning(f"トレースの書き込みに失敗しました: {e}")
+
+    def _rotate_if_needed(self):
+        """上限を超えたら1世代だけ残して新しいファイルにする"""
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except FileNotFoundError:
+            pass
+
+    def _tail(self, path, count):
+        """ファイル末尾から最大 count 件のトレースを読む"""
+        try:
+            with open(path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                length = min(size, count * self.LINE_BYTES_ESTIMATE * 2)
+                f.seek(size - length)
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        if length < size:
+            # 途中から読んだ先頭行は欠けているので捨てる
+            lines = lines[1:]
+        traces = []
+        for line in lines[-count:]:
+            try:
+                traces.append(json.loads(line))
+            except ValueError:
+                continue
+        return traces
+
+    def recent(self):
+        """全ワーカー分の直近 max_traces 件"""
+        traces = self._tail(self.path, self.max_traces)
+        if len(traces) < self.max_traces:
+            # ローテーション直後は前の世代から補う
+            traces = self._tail(self.path + ".1", self.max_traces - len(traces)) + traces
+        return traces
+
+    def summary(self):
+        """スパンごとの件数・p50・p95・最大（ミリ秒）"""
+        traces = self.recent()
+        values = {}
+        errors = 0
+        for trace in traces:
+            if trace.get("error"):
+                errors += 1
+            for name, ms in (trace.get("spans") or {}).items():
+                values.setdefault(f"{trace.get('source')}.{name}", []).append(ms)
+
+        spans = {}
+        for name, samples in sorted(values.items()):
+            samples.sort()
+            spans[name] = {
+                "count": len(samples),
+                "p50_ms": samples[len(samples) // 2],
+                "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                "max_ms": samples[-1],
+            }
+        return {"traces": len(traces), "errors": errors, "spans": spans}
+
+
+trace_store = TraceStore()
+
+# ドレイン・スケーリング設定
+MAX_ACTIVE_SESSIONS = int(os.environ.get("STT_MAX_SESSIONS", 100))
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("STT_DRAIN_TIMEOUT", 8.0))
+
+class ServerState:
+    """接続数とドレイン（停止前の接続引き払い）状態を管理"""
+
+    def __init__(self):
+        self.active_sessions = 0
+        self.draining = False
+        self.loop = None
+        self.drain_event = None
+        self.idle_event = None
+
+    def bind_loop(self):
+        """起動したイベントループにイベントを結び付ける"""
+        self.loop = asyncio.get_running_loop()
+        self.drain_event = asyncio.Event()
+        self.idle_event = asyncio.Event()
+        self.idle_event.set()
+
+    def session_opened(self):
+        self.active_sessions += 1
+        self.idle_event.clear()
+
+    def session_closed(self):
+        self.active_sessions -= 1
+        if self.active_sessions <= 0:
+            self.idle_event.set()
+
+    def is_ready(self):
+        return not self.draining and self.active_sessions < MAX_ACTIVE_SESSIONS
+
+    async def drain(self, timeout=DRAIN_TIMEOUT_SECONDS):
+        """新規接続を断り、既存セッションに再接続を促して終了を待つ"""
+        self.draining = True
+        self.drain_event.set()
+        logger.info(f"ドレイン開始: アクティブセッション {self.active_sessions}件")
+        try:
+            await asyncio.wait_for(self.idle_event.wait(), timeout=timeout)
+            logger.info("ドレイン完了")
+        except asyncio.TimeoutError:
+            logger.warning(f"ドレインタイムアウト: {self.active_sessions}件のセッションが残っています")
+
+
+server_state = ServerState()
+
+async def receive_message(websocket: WebSocket):
+    """音声データ（bytes）または制御メッセージ（str）を受信"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return message["bytes"]
+    return message.get("text") or ""
+
+def parse_trace_message(text):
+    """ターン開始の制御メッセージ {"trace": "<id>"} からトレースIDを取り出す"""
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(message, dict) or "trace" not in message:
+        return None
+    return str(message["trace"] or "")[:64]
+
+async def receive_or_drain(websocket: WebSocket, drain_waiter, timeout):
+    """音声データまたは制御メッセージを受信（ドレイン開始時はNoneを返す）"""
+    receive = asyncio.ensure_future(receive_message(websocket))
+    done, _ = await asyncio.wait({receive, drain_waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    if receive in done:
+        return receive.result()
+    receive.cancel()
+    if drain_waiter in done:
+        return None
+    raise asyncio.TimeoutError
 
 @app.get("/")
 async def root():
@@ -35,8 +473,12 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "websocket": "/ws",
-            "health": "/health"
-        }
+            "health": "/health",
+            "ready": "/ready",
+            "traces": "/traces",
+            "trace_summary": "/traces/summary"
+        },
+        "audio_encodings": supported_encodings()
     }
 
 @app.get("/health")
@@ -53,6 +495,9 @@ async def health_check():
         return {
             "status": "healthy",
             "google_cloud_speech": "connected",
+            "sessions": len(session_store),
+            "stt_engine": STT_ENGINE,
+            "event_loop_lag": loop_lag_monitor.snapshot(),
             "timestamp": time.time(),
             "port": PORT
         }
@@ -64,26 +509,243 @@ async def health_check():
             "timestamp": time.time()
         }
 
+async def recognize_buffer(websocket: WebSocket, session: SttSession, client_id: str, trace_id=None):
+    """バッファした音声をGoogle STTで認識し、結果を送信"""
+    # 認識中に再接続したクライアントが追加したチャンクを消さないよう、
+    # 認識する分を先にバッファから取り出す
+    chunks, session.audio_buffer = session.audio_buffer, []
+    session.buffered_bytes = 0
+    try:
+        # バッファした音声データをまとめて処理
+        combined_audio = b''.join(chunks)
+
+        # Google STT用の設定（Cloud Run最適化）
+        config = speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=16000,
+            language_code="ja-JP",
+            enable_automatic_punctuation=True,
+            model="latest_long",  # 長い音声用
+            use_enhanced=True,
+            # Cloud Run用の最適化設定
+            max_alternatives=1,
+            profanity_filter=False,
+        )
+
+        # ストリーミングではなく、バッチ処理を使用（Cloud Run安定性重視）
+        audio = speech.RecognitionAudio(content=combined_audio)
+
+        # Google Cloud Speech API呼び出し
+        logger.info(f"[{client_id}] Google STT処理開始 (バッファサイズ: {len(combined_audio)} bytes, trace: {trace_id or '-'})")
+        # 同期APIはスレッドで実行し、他のセッションのイベントループを止めない
+        recognize_start = time.time()
+        client = get_speech_client()
+        response = await asyncio.to_thread(client.recognize, config=config, audio=audio)
+        recognize_ms = round((time.time() - recognize_start) * 1000, 1)
+        logger.info(f"[{client_id}] Google STT処理時間: {recognize_ms}ms (trace: {trace_id or '-'})")
+        await asyncio.to_thread(trace_store.add, trace_id, {"recognize": recognize_ms}, source="stt")
+
+        # 時間更新（送信前に行い、切断されても結果は履歴に残す）
+        session.last_recognition_time = time.time()
+
+        # 結果を送信
+        results_sent = 0
+        for result in response.results:
+            transcript = result.alternatives[0].transcript
+            if transcript.strip():
+                logger.info(f"[{client_id}] 認識結果: {transcript}")
+                session.add_transcript(transcript)
+                await websocket.send_text(transcript)
+                results_sent += 1
+
+        if results_sent == 0:
+            logger.info(f"[{client_id}] 認識結果なし（無音または不明瞭）")
+
+    except WebSocketDisconnect:
+        raise
+
+    except Exception as e:
+        logger.error(f"[{client_id}] Google STT処理エラー: {e}")
+        # 認識に失敗した分だけ破棄（認識中に届いたチャンクは残す）
+        session.last_recognition_time = time.time()
+
+        # クライアントにエラー通知（オプション）
+        try:
+            await websocket.send_text(f"[認識エラー] 音声を再度話してください")
+        except:
+            pass
+
+@app.post("/traces")
+async def post_trace(request: Request):
+    """デバイスからトレース（1件または配列）を受け取る"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "invalid json"}, status_code=400)
+
+    accepted = 0
+    for trace in body if isinstance(body, list) else [body]:
+        if not isinstance(trace, dict) or not isinstance(trace.get("spans"), dict):
+            continue
+        spans = {
+            str(name): float(ms) for name, ms in trace["spans"].items()
+            if isinstance(ms, (int, float)) and not isinstance(ms, bool)
+        }
+        await asyncio.to_thread(
+            trace_store.add,
+            str(trace.get("trace_id") or "")[:64] or None,
+            spans,
+            source=str(trace.get("source") or "device")[:32],
+            error=str(trace["error"])[:200] if trace.get("error") else None,
+        )
+        accepted += 1
+    return {"accepted": accepted}
+
+@app.get("/traces/summary")
+async def trace_summary():
+    """スパンごとの所要時間の集計（どの段階を改善すべきかの判断用）"""
+    return await asyncio.to_thread(trace_store.summary)
+
+@app.get("/ready")
+async def readiness_check():
+    """オートスケーラー用の準備状態（ドレイン中・満席時は503）"""
+    body = {
+        "ready": server_state.is_ready(),
+        "draining": server_state.draining,
+        "active_sessions": server_state.active_sessions,
+        "max_sessions": MAX_ACTIVE_SESSIONS,
+        "load": round(server_state.active_sessions / MAX_ACTIVE_SESSIONS, 3),
+        "pid": os.getpid(),
+    }
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket音声認識エンドポイント"""
+    """WebSocket音声認識エンドポイント
+
+    クエリパラメータ ``session`` に前回のトークンを渡すと、音声バッファと
+    認識結果の通し番号を引き継いで論理セッションを再開する。``offset`` を
+    渡すと、その番号以降で未受信の認識結果を再送する。``encoding`` で
+    音声形式（linear16 / opus / flac）を指定できる。
+
+    トレースIDはターンごとに、音声の前にテキストメッセージ
+    ``{"trace": "<id>"}`` で渡すと、以降の音声の認識処理に付ける。
+    ``trace`` クエリパラメータ（または X-Trace-Id ヘッダー）は最初の
+    ターンの既定値として使う。
+    """
     await websocket.accept()
     
     client_id = f"{websocket.client.host}:{websocket.client.port}"
-    logger.info(f"WebSocket接続開始: {client_id}")
-    
-    audio_buffer = []
+
+    # ドレイン中は新しいセッションを受け付けない
+    if server_state.draining:
+        await websocket.send_text("[システム] サーバー再起動中です。再接続してください。")
+        await websocket.close(code=1012)
+        return
+
+    # 音声エンコーディングのネゴシエーション
+    encoding = websocket.query_params.get("encoding", "linear16")
+    decoder = create_decoder(encoding)
+    if decoder is None:
+        logger.warning(f"[{client_id}] 非対応のエンコーディング: {encoding}")
+        await websocket.send_text(
+            f"[システム] 非対応の音声エンコーディングです: {encoding} "
+            f"(対応: {', '.join(supported_encodings())})"
+        )
+        await websocket.close(code=1003)
+        return
+
+    initial_trace_id = (websocket.query_params.get("trace") or websocket.headers.get("x-trace-id") or "")[:64] or None
+
+    # セッション再開またはセッション新規作成
+    token = websocket.query_params.get("session")
+    session = session_store.get(token) if token else None
+    resumed = session is not None
+    if session is None:
+        session = session_store.create()
+    session.generation += 1
+    session.active = True
+    generation = session.generation
+    if initial_trace_id:
+        session.trace_id = initial_trace_id
+
+    client_id = f"{client_id}/{session.token[:8]}"
+    if resumed:
+        logger.info(f"WebSocket接続再開: {client_id} (バッファ: {len(session.audio_buffer)}チャンク, 認識結果: {session.transcript_offset}件)")
+    else:
+        logger.info(f"WebSocket接続開始: {client_id} (エンコーディング: {decoder.name}, trace: {session.trace_id or '-'})")
+
     chunk_count = 0
-    last_recognition_time = time.time()
+    received_bytes = 0
+    decoded_bytes = 0
     session_start = time.time()
+    server_state.session_opened()
+    drain_waiter = asyncio.ensure_future(server_state.drain_event.wait())
     
     try:
+        await websocket.send_text(f"[セッション] {session.token} {session.transcript_offset} {decoder.name}")
+
+        # 切断中に確定した認識結果を再送
+        if resumed:
+            try:
+                offset = int(websocket.query_params.get("offset", session.transcript_offset))
+            except ValueError:
+                offset = session.transcript_offset
+            for transcript in session.transcripts_since(offset):
+                await websocket.send_text(transcript)
+
         while True:
             try:
                 # Cloud Runのタイムアウト対策（60秒制限）
-                data = await asyncio.wait_for(websocket.receive_bytes(), timeout=55.0)
+                data = await receive_or_drain(websocket, drain_waiter, timeout=55.0)
+
+                # サーバー停止前: 残りの音声を認識してから再接続を促す
+                if data is None:
+                    logger.info(f"[{client_id}] ドレインのため接続を終了します")
+                    if session.buffered_bytes > 0:
+                        await recognize_buffer(websocket, session, client_id, session.trace_id)
+                    await websocket.send_text("[システム] サーバー再起動のため再接続してください。")
+                    await websocket.close(code=1012)
+                    break
+
+                # 同じトークンで新しい接続が確立された場合はこの接続を終了
+                if session.generation != generation:
+                    logger.info(f"[{client_id}] 新しい接続にセッションを引き継ぎました")
+                    break
+
+                # ターン開始の制御メッセージ: 以降の音声に新しいトレースIDを付ける
+                if isinstance(data, str):
+                    trace_id = parse_trace_message(data)
+                    if trace_id is None:
+                        logger.warning(f"[{client_id}] 不明な制御メッセージ: {data[:100]}")
+                        continue
+                    # 前のターンの残りは前のトレースIDで認識する
+                    if session.buffered_bytes > 0 and trace_id != session.trace_id:
+                        await recognize_buffer(websocket, session, client_id, session.trace_id)
+                    session.trace_id = trace_id or None
+                    continue
+
                 chunk_count += 1
-                audio_buffer.append(data)
+                session.chunk_count += 1
+                received_bytes += len(data)
+
+                # 圧縮音声はLINEAR16にデコードしてからバッファ
+                if decoder.name != "linear16":
+                    if len(data) > MAX_COMPRESSED_MESSAGE_BYTES:
+                        logger.warning(f"[{client_id}] 圧縮音声メッセージが大きすぎます: {len(data)} bytes")
+                        continue
+                    try:
+                        data = decoder.decode(data)
+                    except AudioDecodeError as e:
+                        logger.warning(f"[{client_id}] {e}")
+                        continue
+                    if len(data) > SAMPLE_RATE * 2 * MAX_DECODED_SECONDS_PER_MESSAGE:
+                        logger.warning(f"[{client_id}] デコード後の音声が長すぎます: {len(data)} bytes")
+                        continue
+
+                decoded_bytes += len(data)
+                session.audio_buffer.append(data)
+                session.buffered_bytes += len(data)
                 
                 # 定期的なログ出力（Cloud Runのログ監視用）
                 if chunk_count <= 10 or chunk_count % 100 == 0:
@@ -91,61 +753,12 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 # 3秒分のデータ（約93チャンク）または5秒経過で処理
                 should_process = (
-                    len(audio_buffer) >= 93 or  # 3秒分
-                    (time.time() - last_recognition_time > 5.0 and len(audio_buffer) > 10)  # 5秒経過
+                    session.buffered_bytes >= RECOGNITION_BATCH_BYTES or  # 3秒分
+                    (time.time() - session.last_recognition_time > 5.0 and session.buffered_bytes > RECOGNITION_MIN_BYTES)  # 5秒経過
                 )
                 
                 if should_process:
-                    try:
-                        # バッファした音声データをまとめて処理
-                        combined_audio = b''.join(audio_buffer)
-                        
-                        # Google STT用の設定（Cloud Run最適化）
-                        config = speech.RecognitionConfig(
-                            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-                            sample_rate_hertz=16000,
-                            language_code="ja-JP",
-                            enable_automatic_punctuation=True,
-                            model="latest_long",  # 長い音声用
-                            use_enhanced=True,
-                            # Cloud Run用の最適化設定
-                            max_alternatives=1,
-                            profanity_filter=False,
-                        )
-                        
-                        # ストリーミングではなく、バッチ処理を使用（Cloud Run安定性重視）
-                        audio = speech.RecognitionAudio(content=combined_audio)
-                        
-                        # Google Cloud Speech API呼び出し
-                        logger.info(f"[{client_id}] Google STT処理開始 (バッファサイズ: {len(combined_audio)} bytes)")
-                        response = speech_client.recognize(config=config, audio=audio)
-                        
-                        # 結果を送信
-                        results_sent = 0
-                        for result in response.results:
-                            transcript = result.alternatives[0].transcript
-                            if transcript.strip():
-                                logger.info(f"[{client_id}] 認識結果: {transcript}")
-                                await websocket.send_text(transcript)
-                                results_sent += 1
-                        
-                        if results_sent == 0:
-                            logger.info(f"[{client_id}] 認識結果なし（無音または不明瞭）")
-                        
-                        # バッファクリアと時間更新
-                        audio_buffer = []
-                        last_recognition_time = time.time()
-                        
-                    except Exception as e:
-                        logger.error(f"[{client_id}] Google STT処理エラー: {e}")
-                        audio_buffer = []  # エラー時もバッファクリア
-                        last_recognition_time = time.time()
-                        
-                        # クライアントにエラー通知（オプション）
-                        try:
-                            await websocket.send_text(f"[認識エラー] 音声を再度話してください")
-                        except:
-                            pass
+                    await recognize_buffer(websocket, session, client_id, session.trace_id)
                 
                 # Cloud Runのリソース制限対策（長時間接続の制限）
                 session_duration = time.time() - session_start
@@ -167,32 +780,126 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"[{client_id}] WebSocketエラー: {e}")
     
     finally:
+        drain_waiter.cancel()
+        server_state.session_closed()
+        # 最新の接続でなければストアの状態は新しい接続に任せる
+        if session.generation == generation:
+            session_store.release(session)
         session_duration = time.time() - session_start
-        logger.info(f"[{client_id}] 接続終了 - セッション時間: {session_duration:.1f}秒, 処理チャンク数: {chunk_count}")
+        compression = f", 圧縮率: {decoded_bytes / received_bytes:.1f}x" if received_bytes and decoder.name != "linear16" else ""
+        logger.info(
+            f"[{client_id}] 接続終了 - セッション時間: {session_duration:.1f}秒, 処理チャンク数: {chunk_count}, "
+            f"受信: {received_bytes} bytes{compression}, 保持バッファ: {len(session.audio_buffer)}チャンク"
+        )
 
 # Cloud Run用のスタートアップイベント
 @app.on_event("startup")
 async def startup_event():
     logger.info("STT WebSocket Server starting up...")
     logger.info(f"Port: {PORT}")
+    logger.info(f"STT engine: {STT_ENGINE}")
     logger.info(f"Firebase key file: {SERVICE_ACCOUNT_FILE}")
+    server_state.bind_loop()
+    loop_lag_monitor.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("STT WebSocket Server shutting down...")
+    loop_lag_monitor.stop()
 
-if __name__ == "__main__":
+def create_server():
+    """ドレイン対応のuvicornサーバーを作成"""
     import uvicorn
-    
+
+    class DrainingServer(uvicorn.Server):
+        """SIGTERM受信時にセッションをドレインしてから停止するサーバー"""
+
+        def handle_exit(self, sig, frame):
+            # 2回目のシグナル、またはループ未起動時は即時停止
+            if server_state.draining or server_state.loop is None:
+                return super().handle_exit(sig, frame)
+
+            server_state.draining = True
+
+            async def drain_then_exit():
+                await server_state.drain()
+                super(DrainingServer, self).handle_exit(sig, frame)
+
+            server_state.loop.call_soon_threadsafe(
+                lambda: server_state.loop.create_task(drain_then_exit())
+            )
+
     # Cloud Run用の設定
-    uvicorn.run(
-        app, 
+    config = uvicorn.Config(
+        app,
         host="0.0.0.0",  # Cloud Runでは必須
         port=PORT,
         log_level="info",
         access_log=True,
         # Cloud Run最適化設定
         timeout_keep_alive=30,
-        limit_concurrency=100,
-        limit_max_requests=1000
+        limit_concurrency=MAX_ACTIVE_SESSIONS,
+        timeout_graceful_shutdown=DRAIN_TIMEOUT_SECONDS,
     )
+    return DrainingServer(config)
+
+def create_reuseport_socket(host, port):
+    """SO_REUSEPORTで複数プロセスが同じポートを待ち受けるソケット"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker():
+    """ワーカープロセス: 自分専用のSO_REUSEPORTソケットで待ち受け"""
+    sock = create_reuseport_socket("0.0.0.0", PORT)
+    create_server().run(sockets=[sock])
+
+def run_multi_worker(workers):
+    """複数ワーカーを起動し、停止シグナルを各ワーカーに転送して監視"""
+    import multiprocessing
+
+    processes = {}
+    stopping = False
+
+    def start_worker(index):
+        process = multiprocessing.Process(target=run_worker, name=f"stt-worker-{index}")
+        process.start()
+        processes[index] = process
+        logger.info(f"ワーカー{index}起動 (pid={process.pid})")
+
+    def handle_signal(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, sig)
+
+    for index in range(workers):
+        start_worker(index)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # 異常終了したワーカーは再起動（停止中を除く）
+    while processes:
+        for index, process in list(processes.items()):
+            process.join(timeout=1.0)
+            if process.is_alive():
+                continue
+            if stopping:
+                del processes[index]
+            else:
+                logger.warning(f"ワーカー{index}が終了しました (exitcode={process.exitcode})。再起動します")
+                start_worker(index)
+
+if __name__ == "__main__":
+    # STT_WORKERS > 1 でSO_REUSEPORTを使ったマルチワーカー起動
+    workers = int(os.environ.get("STT_WORKERS", 1))
+
+    if workers > 1:
+        run_multi_worker(workers)
+    else:
+        create_server().run()
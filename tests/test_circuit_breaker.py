@@ -0,0 +1,166 @@
+"""CircuitBreaker と RobustAIClient._post_audio の状態遷移"""
+
+import pytest
+
+pytest.importorskip("sounddevice")
+pytest.importorskip("soundfile")
+pytest.importorskip("pyttsx3")
+
+import numpy as np
+import requests
+
+import rokuon
+
+
+class RaisingSession:
+    """post() で指定の例外を投げるセッション"""
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+        self.adapters = {}
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        raise self.error
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == 'open'
+
+
+def expire(breaker):
+    """reset_timeout が経過した状態にする"""
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_opens_after_threshold_and_blocks():
+    breaker = rokuon.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_half_open_probe_success_closes():
+    breaker = rokuon.CircuitBreaker(reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    # 試行中は他の呼び出しを通さない
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_half_open_probe_failure_reopens():
+    breaker = rokuon.CircuitBreaker(reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_unrecorded_half_open_probe_times_out():
+    breaker = rokuon.CircuitBreaker(reset_timeout=30)
+    open_breaker(breaker)
+    expire(breaker)
+    assert breaker.allow()
+    # 結果が記録されなくても reset_timeout 後には次の試行を許可
+    expire(breaker)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+
+
+@pytest.fixture
+def client():
+    client = rokuon.RobustAIClient("http://127.0.0.1:9")
+    client.url_saved = True
+    return client
+
+
+def test_unexpected_error_during_probe_reopens(client):
+    client.session = RaisingSession(requests.exceptions.ChunkedEncodingError("broken"))
+    open_breaker(client.breaker)
+    expire(client.breaker)
+
+    response, error = client._post_audio(np.zeros(1600, dtype=np.float32))
+
+    assert response is None and error
+    assert client.session.calls == 1
+    assert client.breaker.state == 'open'
+
+
+def test_encode_error_during_probe_reopens(client, monkeypatch):
+    def broken_encode(*args, **kwargs):
+        raise RuntimeError("codec")
+
+    monkeypatch.setattr(client, "encode_audio", broken_encode)
+    open_breaker(client.breaker)
+    expire(client.breaker)
+
+    response, error = client._post_audio(np.zeros(1600, dtype=np.float32))
+
+    assert response is None and error
+    assert client.breaker.state == 'open'
+
+
+def test_http_4xx_closes_breaker(client):
+    response = requests.Response()
+    response.status_code = 404
+    response.url = "http://127.0.0.1:9/voice-chat/"
+
+    class Session(RaisingSession):
+        def post(self, *args, **kwargs):
+            self.calls += 1
+            return response
+
+    client.audio_codec = 'wav'
+    client.session = Session(None)
+    open_breaker(client.breaker)
+    expire(client.breaker)
+
+    _, error = client._post_audio(np.zeros(1600, dtype=np.float32))
+
+    assert error
+    assert client.breaker.state == 'closed'
+
+
+def test_codec_fallback_does_not_use_an_attempt(client):
+    class Response(requests.Response):
+        def __init__(self, status_code):
+            super().__init__()
+            self.status_code = status_code
+            self.url = "http://127.0.0.1:9/voice-chat/"
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    responses = [Response(415), Response(200)]
+    sent = []
+
+    class Session(RaisingSession):
+        def post(self, *args, files=None, **kwargs):
+            self.calls += 1
+            sent.append(files['audio'][0])
+            return responses[self.calls - 1]
+
+    client.audio_codec = 'flac'
+    client.retry_count = 1
+    client.session = Session(None)
+
+    response, error = client._post_audio(np.zeros(1600, dtype=np.float32))
+
+    assert error is None and response is responses[1]
+    assert sent == ['recording.flac', 'recording.wav']
+    assert responses[0].closed
+    assert client.breaker.state == 'closed' and client.breaker.failures == 0
@@ -0,0 +1,27 @@
+"""ConversationState の状態遷移"""
+
+import pytest
+
+pytest.importorskip("sounddevice")
+pytest.importorskip("soundfile")
+pytest.importorskip("pyttsx3")
+
+import rokuon
+
+
+def test_recording_does_not_overwrite_speaking():
+    state = rokuon.ConversationState()
+    state.set_tts_playing(True)
+    state.set_recording(True)
+    assert state.is_tts_playing
+    state.set_tts_playing(False)
+    assert state.state == rokuon.ConversationState.IDLE
+
+
+def test_recording_starts_from_idle_only():
+    state = rokuon.ConversationState()
+    state.set_recording(True)
+    assert state.is_recording
+    state.transition(rokuon.ConversationState.UPLOADING)
+    state.set_recording(True)
+    assert state.state == rokuon.ConversationState.UPLOADING
@@ -0,0 +1,48 @@
+"""FrameScheduler の時間帯の選択と検知間隔"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("cv2")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+
+from detection import FrameScheduler
+
+
+NIGHT = {"start": "22:00", "end": "06:00", "active_fps": 5, "idle_fps": 0.5, "idle_after": 20}
+DAY = {"start": "09:00", "end": "17:00", "active_fps": 8, "idle_fps": 1}
+
+
+def at(hour, minute=0):
+    return datetime(2024, 1, 15, hour, minute).timestamp()
+
+
+@pytest.mark.parametrize("hour, minute", [(22, 0), (23, 59), (0, 0), (5, 59)])
+def test_profile_wraps_midnight(hour, minute):
+    scheduler = FrameScheduler([NIGHT, DAY])
+    assert scheduler.profile(at(hour, minute))["active_fps"] == 5
+
+
+@pytest.mark.parametrize("hour, minute", [(6, 0), (8, 59), (17, 0), (21, 59)])
+def test_profile_outside_ranges_uses_default(hour, minute):
+    scheduler = FrameScheduler([NIGHT, DAY])
+    assert scheduler.profile(at(hour, minute)) == FrameScheduler.DEFAULT_PROFILE
+
+
+def test_profile_without_range_replaces_default():
+    scheduler = FrameScheduler([NIGHT, {"active_fps": 3, "idle_fps": 0.2}])
+    profile = scheduler.profile(at(12))
+    assert profile["active_fps"] == 3
+    assert profile["idle_after"] == FrameScheduler.DEFAULT_PROFILE["idle_after"]
+    assert scheduler.profile(at(23))["active_fps"] == 5
+
+
+def test_interval_switches_to_idle_after_no_motion():
+    scheduler = FrameScheduler([NIGHT])
+    now = at(23)
+    assert scheduler.interval(now - 5, now) == (0.2, "active")
+    assert scheduler.interval(now - 25, now) == (2.0, "idle")
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+vad_bench.py - VADの精度・速度ベンチマーク
+
+ラベル付きWAVに対して、従来の固定閾値VAD（rokuon.ImprovedVAD 相当）と
+vad_engine.AdaptiveVAD を比較し、フレーム単位の精度と処理速度を報告する。
+
+ラベル形式（WAVと同じ名前で拡張子違い）:
+    sample.txt  … Audacityのラベル形式（開始秒<TAB>終了秒[<TAB>ラベル]）
+    sample.json … [[開始秒, 終了秒], ...]
+
+例:
+    python vad_bench.py data/vad/*.wav
+    python vad_bench.py --synthetic --json vad_report.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from vad_engine import AdaptiveVAD, frame_rms, frame_signal
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+FRAME_LENGTH = SAMPLE_RATE * FRAME_MS // 1000
+
+
+class FixedThresholdVAD:
+    """比較用: 旧ImprovedVADと同じ判定（起動時に一度だけキャリブレーション）"""
+
+    def __init__(self, calibration_seconds=3, voice_threshold_multiplier=3.0):
+        self.samples_needed = calibration_seconds * 1000 // FRAME_MS
+        self.voice_threshold_multiplier = voice_threshold_multiplier
+        self.calibration_samples = []
+        self.voice_threshold = None
+
+    def process(self, frames):
+        decisions = np.zeros(len(frames), dtype=bool)
+        for i, rms in enumerate(frame_rms(frames)):
+            if self.voice_threshold is None:
+                self.calibration_samples.append(rms)
+                if len(self.calibration_samples) >= self.samples_needed:
+                    sorted_samples = np.sort(self.calibration_samples)
+                    trim = len(sorted_samples) // 10
+                    trimmed = sorted_samples[trim:-trim] if trim > 0 else sorted_samples
+                    self.voice_threshold = max(np.mean(trimmed) * self.voice_threshold_multiplier, 0.001)
+                continue
+            decisions[i] = self.voice_threshold < rms <= self.voice_threshold * 10
+        return decisions
+
+
+ENGINES = {
+    "fixed": lambda: FixedThresholdVAD(),
+    "adaptive": lambda: AdaptiveVAD(),
+    "adaptive+spectral": lambda: AdaptiveVAD(use_spectral=True),
+}
+
+
+def load_labels(wav_path):
+    """WAVに対応するラベル（音声区間のリスト）を読み込み"""
+    base = os.path.splitext(wav_path)[0]
+    if os.path.exists(base + ".json"):
+        with open(base + ".json", encoding="utf-8") as f:
+            return [(float(start), float(end)) for start, end in json.load(f)]
+    if os.path.exists(base + ".txt"):
+        segments = []
+        with open(base + ".txt", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2:
+                    segments.append((float(parts[0]), float(parts[1])))
+        return segments
+    raise FileNotFoundError(f"{wav_path} のラベル（.txt / .json）が見つかりません")
+
+
+def load_wav(path):
+    """WAVを16kHzモノラルのfloat32で読み込み"""
+    import soundfile as sf
+
+    audio, sample_rate = sf.read(path, dtype="float32", always_2d=True)
+    if sample_rate != SAMPLE_RATE:
+        raise ValueError(f"{path}: {SAMPLE_RATE}Hzのみ対応しています（{sample_rate}Hz）")
+    return audio[:, 0]
+
+
+def labels_to_frames(segments, n_frames):
+    """音声区間をフレーム単位の正解ラベルに変換"""
+    truth = np.zeros(n_frames, dtype=bool)
+    for start, end in segments:
+        first = int(start * 1000 / FRAME_MS)
+        last = int(np.ceil(end * 1000 / FRAME_MS))
+        truth[max(0, first):min(n_frames, last)] = True
+    return truth
+
+
+def synthetic_recording(seconds=120, seed=0):
+    """騒音が徐々に大きくなる部屋での発話を模した合成音声とラベル"""
+    rng = np.random.default_rng(seed)
+    n = seconds * SAMPLE_RATE
+    t = np.arange(n) / SAMPLE_RATE
+
+    # 騒音: 0.002 → 0.02 まで上昇（昼間に部屋がうるさくなる想定）
+    noise_level = np.linspace(0.002, 0.02, n)
+    signal = rng.normal(0, 1, n).astype(np.float32) * noise_level
+
+    segments = []
+    position = 4.0
+    while position < seconds - 3:
+        length = rng.uniform(0.8, 2.5)
+        start, end = position, position + length
+        index = slice(int(start * SAMPLE_RATE), int(end * SAMPLE_RATE))
+        # 音声に似た信号: 基本周波数と倍音を音節のリズムで振幅変調
+        f0 = rng.uniform(110, 220)
+        tt = t[index]
+        voiced = sum(np.sin(2 * np.pi * f0 * k * tt) / k for k in range(1, 6))
+        envelope = 0.5 * (1 - np.cos(2 * np.pi * 4 * (tt - start))) * 0.8 + 0.2
+        level = noise_level[index] * rng.uniform(6, 12)
+        signal[index] += (voiced * envelope * level).astype(np.float32)
+        segments.append((start, end))
+        position = end + rng.uniform(1.5, 5.0)
+
+    return signal, segments
+
+
+def score(decisions, truth):
+    """フレーム単位の精度指標"""
+    tp = int(np.sum(decisions & truth))
+    fp = int(np.sum(decisions & ~truth))
+    fn = int(np.sum(~decisions & truth))
+    tn = int(np.sum(~decisions & ~truth))
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        "accuracy": round((tp + tn) / max(1, len(truth)), 4),
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(f1, 4),
+        "false_alarm_rate": round(fp / max(1, fp + tn), 4),
+        "miss_rate": round(fn / max(1, fn + tp), 4),
+    }
+
+
+def onset_delays(decisions, segments):
+    """各発話の開始から検出までの遅延（ミリ秒、未検出は除外）"""
+    delays = []
+    for start, end in segments:
+        first = int(start * 1000 / FRAME_MS)
+        last = int(np.ceil(end * 1000 / FRAME_MS))
+        hits = np.flatnonzero(decisions[first:last])
+        if len(hits):
+            delays.append(float(hits[0] * FRAME_MS))
+    return delays
+
+
+def missed_utterances(decisions, segments):
+    """一度も検出されなかった発話の数"""
+    missed = 0
+    for start, end in segments:
+        first = int(start * 1000 / FRAME_MS)
+        last = int(np.ceil(end * 1000 / FRAME_MS))
+        if not decisions[first:last].any():
+            missed += 1
+    return missed
+
+
+def phantom_turns(decisions, segments):
+    """正解の発話区間と重ならない誤検出区間の数"""
+    truth = labels_to_frames(segments, len(decisions))
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], decisions.astype(np.int8), [0]))))
+    count = 0
+    for start, end in zip(edges[::2], edges[1::2]):
+        if not truth[start:end].any():
+            count += 1
+    return count
+
+
+def run_engine(name, frames, block_frames=1):
+    """エンジンでフレームを判定し、判定結果と処理時間を返す"""
+    engine = ENGINES[name]()
+    decisions = np.zeros(len(frames), dtype=bool)
+    started = time.perf_counter()
+    for i in range(0, len(frames), block_frames):
+        decisions[i:i + block_frames] = engine.process(frames[i:i + block_frames])
+    return decisions, time.perf_counter() - started
+
+
+def benchmark_file(name, signal, segments, engines, block_frames):
+    frames = frame_signal(signal, FRAME_LENGTH)
+    truth = labels_to_frames(segments, len(frames))
+    audio_seconds = len(frames) * FRAME_MS / 1000
+
+    results = {}
+    for engine_name in engines:
+        decisions, elapsed = run_engine(engine_name, frames, block_frames)
+        delays = onset_delays(decisions, segments)
+        results[engine_name] = {
+            **score(decisions, truth),
+            "utterances": len(segments),
+            "missed_utterances": missed_utterances(decisions, segments),
+            "phantom_turns": phantom_turns(decisions, segments),
+            "median_onset_delay_ms": float(np.median(delays)) if delays else None,
+            "processing_ms": round(elapsed * 1000, 2),
+            "realtime_factor": round(audio_seconds / max(elapsed, 1e-9), 1),
+        }
+    return {"file": name, "audio_seconds": round(audio_seconds, 1), "engines": results}
+
+
+def print_report(reports, engines):
+    header = f"{'engine':<20}{'F1':>7}{'prec':>7}{'recall':>8}{'missed':>8}{'phantom':>9}{'onset':>8}{'x RT':>10}"
+    for report in reports:
+        print(f"\n📄 {report['file']} ({report['audio_seconds']}秒)")
+        print(header)
+        for engine_name in engines:
+            r = report["engines"][engine_name]
+            onset = f"{r['median_onset_delay_ms']:.0f}ms" if r["median_onset_delay_ms"] is not None else "-"
+            print(f"{engine_name:<20}{r['f1']:>7.3f}{r['precision']:>7.3f}{r['recall']:>8.3f}"
+                  f"{r['missed_utterances']:>8}{r['phantom_turns']:>9}{onset:>8}{r['realtime_factor']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VAD 精度・速度ベンチマーク")
+    parser.add_argument("wav", nargs="*", help="ラベル付きWAVファイル（16kHz）")
+    parser.add_argument("--synthetic", action="store_true", help="騒音が上昇する合成音声で評価")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument("--block-frames", type=int, default=8,
+                        help="一度に処理するフレーム数（録音ループで溜まったブロック数に相当）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    if not args.wav and not args.synthetic:
+        parser.error("WAVファイルを指定するか --synthetic を付けてください")
+
+    reports = []
+    if args.synthetic:
+        signal, segments = synthetic_recording()
+        reports.append(benchmark_file("synthetic", signal, segments, args.engines, args.block_frames))
+    for path in args.wav:
+        reports.append(benchmark_file(path, load_wav(path), load_labels(path), args.engines, args.block_frames))
+
+    print_report(reports, args.engines)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果を保存しました: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
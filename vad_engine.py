@@ -0,0 +1,205 @@
+"""
+vad_engine.py - 騒音レベル追従型の音声活動検出（VAD）
+
+rokuon.ImprovedVAD の置き換えとして使う。フレームの特徴量はNumPyで
+まとめて計算し、ノイズフロアを指数移動平均で追従し続けるため、
+一日の中で部屋の騒音が変わっても閾値が古くならない。
+"""
+
+import numpy as np
+
+
+def frame_signal(signal, frame_length):
+    """1次元の信号をフレーム（行）に分割（端数は切り捨て）"""
+    signal = np.asarray(signal, dtype=np.float32).reshape(-1)
+    n_frames = len(signal) // frame_length
+    return signal[:n_frames * frame_length].reshape(n_frames, frame_length)
+
+
+def frame_rms(frames):
+    """各フレームのRMSを一括計算"""
+    frames = np.asarray(frames, dtype=np.float32)
+    if frames.ndim == 1:
+        frames = frames.reshape(1, -1)
+    return np.sqrt(np.mean(np.square(frames), axis=1))
+
+
+def spectral_flatness(frames, eps=1e-10):
+    """各フレームのスペクトル平坦度（0: 音声・楽音的 〜 1: 白色雑音的）"""
+    frames = np.asarray(frames, dtype=np.float32)
+    if frames.ndim == 1:
+        frames = frames.reshape(1, -1)
+    window = np.hanning(frames.shape[1]).astype(np.float32)
+    power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2 + eps
+    return np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+
+
+def _smoothing(frame_seconds, time_constant):
+    """時定数（秒）から1フレームあたりの指数移動平均の係数を求める"""
+    if time_constant <= 0:
+        return 1.0
+    return float(1.0 - np.exp(-frame_seconds / time_constant))
+
+
+class AdaptiveVAD:
+    """ノイズフロア追従・ヒステリシス・ハングオーバー付きVAD
+
+    - ノイズフロア: 非音声フレームで指数移動平均（下がる時は速く、上がる時は
+      ゆっくり）。音声中もごく遅く追従し、騒音の段差で張り付かない。
+    - ヒステリシス: 開始は voice_threshold_multiplier 倍、継続は
+      release_multiplier 倍の閾値で判定。
+    - ハングオーバー: 音声が閾値を下回っても hangover_ms の間は音声とみなす。
+    - use_spectral=True で、スペクトル平坦度が高い（雑音的な）フレームを
+      音声の開始から除外する。
+
+    ImprovedVAD と同じ calibrate / is_voice / is_calibrated / voice_threshold
+    を備え、まとめて処理する process() を追加で持つ。
+    """
+
+    def __init__(self, calibration_seconds=1.0, voice_threshold_multiplier=3.0,
+                 release_multiplier=2.0, hangover_ms=200, onset_frames=2,
+                 floor_rise_seconds=8.0, floor_fall_seconds=0.5, floor_rise_in_speech_seconds=60.0,
+                 min_threshold=0.001, max_ratio=None, use_spectral=False,
+                 flatness_threshold=0.45, sample_rate=16000, frame_ms=30):
+        self.calibration_seconds = calibration_seconds
+        self.voice_threshold_multiplier = voice_threshold_multiplier
+        self.release_multiplier = release_multiplier
+        self.min_threshold = min_threshold
+        # 旧ImprovedVADの「閾値の10倍以上は音声ではない」判定（Noneで無効）
+        self.max_ratio = max_ratio
+        self.use_spectral = use_spectral
+        self.flatness_threshold = flatness_threshold
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+
+        frame_seconds = frame_ms / 1000
+        self.samples_needed = max(1, int(round(calibration_seconds / frame_seconds)))
+        self.hangover_frames = int(round(hangover_ms / frame_ms))
+        self.onset_frames = max(1, onset_frames)
+        self._rise = _smoothing(frame_seconds, floor_rise_seconds)
+        self._fall = _smoothing(frame_seconds, floor_fall_seconds)
+        self._rise_in_speech = _smoothing(frame_seconds, floor_rise_in_speech_seconds)
+
+        self.calibration_samples = []
+        self.is_calibrated = False
+        self.baseline_rms = None
+        self.noise_floor = None
+
+        self._in_speech = False
+        self._onset_count = 0
+        self._hangover = 0
+
+    @property
+    def voice_threshold(self):
+        """現在の音声開始閾値"""
+        if self.noise_floor is None:
+            return 0.01
+        return max(self.noise_floor * self.voice_threshold_multiplier, self.min_threshold)
+
+    @property
+    def release_threshold(self):
+        """現在の音声継続閾値"""
+        if self.noise_floor is None:
+            return 0.01
+        return max(self.noise_floor * self.release_multiplier, self.min_threshold)
+
+    def calibrate(self, rms_value):
+        """キャリブレーション（ノイズフロアの初期値を決める）"""
+        self.calibration_samples.append(float(rms_value))
+
+        if len(self.calibration_samples) >= self.samples_needed:
+            sorted_samples = np.sort(np.asarray(self.calibration_samples, dtype=np.float32))
+            trim_count = len(sorted_samples) // 10
+            trimmed_samples = sorted_samples[trim_count:-trim_count] if trim_count > 0 else sorted_samples
+
+            self.baseline_rms = float(np.mean(trimmed_samples))
+            self.noise_floor = self.baseline_rms
+            self.calibration_samples = []
+            self.is_calibrated = True
+            print(f"\n[VAD] キャリブレーション完了！")
+            print(f"  ベースライン: {self.baseline_rms:.6f}")
+            print(f"  音声閾値: {self.voice_threshold:.6f}")
+            return True
+        return False
+
+    def calibrate_frames(self, frames):
+        """フレームをまとめてキャリブレーション（完了したらTrue）"""
+        for rms_value in frame_rms(frames):
+            if self.calibrate(rms_value):
+                return True
+        return False
+
+    def reset(self):
+        """音声区間の状態をリセット（ノイズフロアは保持）"""
+        self._in_speech = False
+        self._onset_count = 0
+        self._hangover = 0
+
+    def is_voice(self, rms_value):
+        """1フレーム分のRMSで判定"""
+        if not self.is_calibrated:
+            return False
+        return bool(self._step(float(rms_value), True))
+
+    def process(self, frames):
+        """フレーム（行列）をまとめて判定し、フレームごとの真偽値配列を返す"""
+        frames = np.asarray(frames, dtype=np.float32)
+        if frames.ndim == 1:
+            frames = frames.reshape(1, -1)
+        rms_values = frame_rms(frames)
+        if self.use_spectral:
+            voiced_like = spectral_flatness(frames) < self.flatness_threshold
+        else:
+            voiced_like = np.ones(len(rms_values), dtype=bool)
+        return self.process_features(rms_values, voiced_like)
+
+    def process_features(self, rms_values, voiced_like=None):
+        """計算済みの特徴量（RMS・スペクトル判定）から判定"""
+        rms_values = np.asarray(rms_values, dtype=np.float64)
+        decisions = np.zeros(len(rms_values), dtype=bool)
+        if voiced_like is None:
+            voiced_like = np.ones(len(rms_values), dtype=bool)
+
+        start = 0
+        # 未キャリブレーションなら先頭フレームでキャリブレーション
+        while not self.is_calibrated and start < len(rms_values):
+            self.calibrate(rms_values[start])
+            start += 1
+
+        for i in range(start, len(rms_values)):
+            decisions[i] = self._step(rms_values[i], voiced_like[i])
+        return decisions
+
+    def _step(self, rms_value, voiced_like):
+        """状態を1フレーム進める"""
+        threshold = self.release_threshold if self._in_speech else self.voice_threshold
+        above = rms_value > threshold and (self._in_speech or voiced_like)
+        if above and self.max_ratio is not None and rms_value > self.voice_threshold * self.max_ratio:
+            above = False
+
+        if above:
+            if self._in_speech:
+                self._hangover = self.hangover_frames
+            else:
+                self._onset_count += 1
+                if self._onset_count >= self.onset_frames:
+                    self._in_speech = True
+                    self._hangover = self.hangover_frames
+        else:
+            self._onset_count = 0
+            if self._in_speech:
+                if self._hangover > 0:
+                    self._hangover -= 1
+                else:
+                    self._in_speech = False
+
+        # ノイズフロアの追従
+        if self._in_speech or self._onset_count:
+            if rms_value > self.noise_floor:
+                self.noise_floor += self._rise_in_speech * (rms_value - self.noise_floor)
+        elif rms_value < self.noise_floor:
+            self.noise_floor += self._fall * (rms_value - self.noise_floor)
+        else:
+            self.noise_floor += self._rise * (rms_value - self.noise_floor)
+
+        return self._in_speech